@@ -0,0 +1,111 @@
+# asset_memory.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Bytes per asset held in memory, before and after the compact Asset.
+
+>>> python -m benchmarks.asset_memory --count 50000
+"""
+
+import argparse, gc, hashlib, json, tracemalloc
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from weeb.backend.primitives import Asset, Variant
+
+
+@dataclass(init=True)
+class LegacyVariant:
+
+    width: int
+    height: int
+    url: str
+
+@dataclass(init=True)
+class LegacyAsset:
+
+    def __hash__(self) -> int:
+        return hash(self.id) + hash(self.hash)
+
+    id: int
+    hash: str
+
+    variants: list[LegacyVariant]
+
+    preview: LegacyVariant
+    sample: Optional[LegacyVariant]
+    original: LegacyVariant
+
+
+SIZES = [("180x180", 180, 120), ("360x360", 360, 240), ("720x720", 720, 480), ("sample", 850, 567), ("original", 3000, 2000)]
+
+def make_variants(index: int, variant_type: type) -> tuple[str, list]:
+
+    md5 = hashlib.md5(str(index).encode()).hexdigest()
+    shard = f"{md5[0:2]}/{md5[2:4]}/"
+
+    variants = []
+
+    for name, width, height in SIZES:
+        extension = "webp" if name in ("360x360", "720x720") else "jpg"
+        # Samples keep a prefix in front of the md5, like the real CDN
+        prefix = "sample-" if name == "sample" else ""
+        url = f"https://cdn.donmai.us/{name}/{shard}{prefix}{md5}.{extension}"
+        variants.append(variant_type(width=width, height=height, url=url))
+
+    return md5, variants
+
+def make_legacy(index: int) -> LegacyAsset:
+    md5, variants = make_variants(index, LegacyVariant)
+    return LegacyAsset(id=index, hash=md5, variants=variants, preview=variants[0], sample=variants[3], original=variants[-1])
+
+def make_compact(index: int) -> Asset:
+    md5, variants = make_variants(index, Variant)
+    return Asset(provider="DanBooru", id=index, hash=md5, variants=variants, sample=variants[3])
+
+def measure(factory: Callable[[int], object], count: int) -> float:
+
+    gc.collect()
+    tracemalloc.start()
+
+    before, _ = tracemalloc.get_traced_memory()
+    assets = {factory(index) for index in range(count)}
+    after, _ = tracemalloc.get_traced_memory()
+
+    tracemalloc.stop()
+
+    del assets
+    return (after - before) / count
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=20000)
+    args = parser.parse_args()
+
+    result = {
+        "count": args.count,
+        "legacy_bytes_per_asset": round(measure(make_legacy, args.count), 1),
+        "compact_bytes_per_asset": round(measure(make_compact, args.count), 1)
+    }
+
+    print(json.dumps(result, indent=4))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# cancellation.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+How many bytes of a streamed download still reach the callback after its Expected is cancelled.
+
+>>> python -m benchmarks.cancellation --size 8388608 --chunk-size 16384 --engine threaded
+
+With --check it exits with an error when more than one chunk arrived after cancel().
+"""
+
+import argparse, json, sys, threading, time
+
+from benchmarks.environment import isolate_paths, make_settings
+from benchmarks.h2_server import H2Server, Response, split
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=8 * 1024 * 1024)
+    parser.add_argument("--chunk-size", type=int, default=16 * 1024)
+    parser.add_argument("--chunk-delay", type=float, default=0.002)
+    parser.add_argument("--cancel-after", type=float, default=0.25, help="fraction of the body after which to cancel")
+    parser.add_argument("--trials", type=int, default=5)
+    parser.add_argument("--engine", choices=("threaded", "async"), default="threaded")
+    parser.add_argument("--check", action="store_true", help="fail if more than one chunk arrived after cancel()")
+    args = parser.parse_args()
+
+    isolate_paths()
+    make_settings({"downloader": {"engine": args.engine}})
+
+    from weeb.backend.downloader import Downloader
+
+    body = bytes(args.size)
+
+    def handler(method: str, path: str, headers: dict[str, str]) -> Response:
+        return Response(headers=[("content-length", str(args.size))], body=split(body, args.chunk_size), chunk_delay=args.chunk_delay)
+
+    trials = []
+
+    with H2Server(handler) as server:
+
+        downloader = Downloader()
+
+        for trial in range(args.trials):
+
+            received = 0
+            reached = threading.Event()
+
+            def on_chunk(chunk: bytes) -> None:
+                nonlocal received
+                received += len(chunk)
+                if received >= args.size * args.cancel_after: reached.set()
+
+            sent_before = server.snapshot()["bytes_sent"]
+
+            e_bytes = downloader.download_async(f"{server.url}/file/{trial}", on_chunk, stream=True)
+            reached.wait(30)
+
+            at_cancel = received
+            started = time.perf_counter()
+            e_bytes.cancel()
+            cancel_time = time.perf_counter() - started
+
+            # Long enough for a transfer that ignored the cancellation to show it
+            time.sleep(max(1.0, args.chunk_delay * 100))
+
+            trials.append({
+                "bytes_at_cancel": at_cancel,
+                "bytes_after_cancel": received - at_cancel,
+                "chunks_after_cancel": (received - at_cancel) / args.chunk_size,
+                "bytes_sent_by_server": server.snapshot()["bytes_sent"] - sent_before,
+                "cancel_ms": round(cancel_time * 1000, 3),
+            })
+
+        streams_reset = server.snapshot()["streams_reset"]
+
+    result = {
+        "engine": args.engine,
+        "size": args.size,
+        "chunk_size": args.chunk_size,
+        "max_chunks_after_cancel": max(trial["chunks_after_cancel"] for trial in trials),
+        "streams_reset": streams_reset,
+        "trials": trials,
+    }
+
+    print(json.dumps(result, indent=4))
+
+    if args.check and result["max_chunks_after_cancel"] > 1:
+        sys.exit(f"{result['max_chunks_after_cancel']} chunks arrived after cancel(), at most one may")
+
+if __name__ == "__main__":
+    main()
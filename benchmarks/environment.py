@@ -0,0 +1,75 @@
+# environment.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Headless stand-ins for the parts of the application benchmarks can't rely on"""
+
+import os, tempfile
+from typing import Any, Callable, Optional
+
+from weeb.backend.settings import Settings
+from weeb.backend.utils.singleton import Singleton
+
+
+def isolate_paths() -> str:
+    """Points the cache, config and data directories to a fresh temporary one, before anything resolves them"""
+
+    root = tempfile.mkdtemp(prefix="weeb-benchmark-")
+
+    for variable in ("XDG_CACHE_HOME", "XDG_CONFIG_HOME", "XDG_DATA_HOME"):
+        os.environ[variable] = root
+
+    return root
+
+def make_settings(config: Optional[dict] = None) -> Settings:
+    """In-memory settings, the GSettings schema is usually not installed where benchmarks run"""
+
+    # Replaces settings made by an earlier call
+    Singleton._instances.pop(Settings, None)
+
+    return Settings(config or {})
+
+def run_main_loop(start: Callable[[Callable[[], None]], Any], timeout: float = 60.0) -> bool:
+    """
+    Runs the default GLib main loop, where the app delivers its callbacks, around start(done).
+    Returns once done() is called, from any thread, or False if timeout ran out first.
+    """
+
+    from gi.repository import GLib
+
+    loop = GLib.MainLoop()
+    timed_out = False
+
+    def on_timeout() -> bool:
+        nonlocal timed_out
+        timed_out = True
+        loop.quit()
+        return False
+
+    def begin() -> bool:
+        start(loop.quit)
+        return False
+
+    timer = GLib.timeout_add(int(timeout * 1000), on_timeout)
+    GLib.idle_add(begin)
+
+    loop.run()
+
+    if not timed_out: GLib.source_remove(timer)
+
+    return not timed_out
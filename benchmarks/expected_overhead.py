@@ -0,0 +1,105 @@
+# expected_overhead.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Cost of the Expected lifecycle and combinators, with concurrent.futures.Future as a reference,
+plus a check that callbacks run exactly once when threads race to settle.
+
+>>> python -m benchmarks.expected_overhead --count 100000
+"""
+
+import argparse, json, threading, timeit
+
+from weeb.backend.utils.expected import Expected
+
+
+def measure(statement: str, count: int, namespace: dict) -> float:
+    """Best of five runs, in nanoseconds per statement"""
+    timer = timeit.Timer(statement, globals=namespace)
+    return min(timer.repeat(repeat=5, number=count)) / count * 1e9
+
+def race_settle(rounds: int, threads: int) -> dict:
+    """Settles every Expected from several threads at once while another one adds callbacks"""
+
+    calls = duplicates = missed = 0
+
+    for _ in range(rounds):
+
+        expected = Expected()
+        counter = [0, 0]
+
+        def on_done(_, slot: int) -> None:
+            counter[slot] += 1
+
+        barrier = threading.Barrier(threads + 1)
+
+        def settle(index: int) -> None:
+            barrier.wait()
+            if index % 2: expected.finish()
+            else: expected.cancel()
+
+        def subscribe() -> None:
+            barrier.wait()
+            expected.add_done_callback(lambda e: on_done(e, 1))
+
+        expected.add_done_callback(lambda e: on_done(e, 0))
+
+        workers = [threading.Thread(target=settle, args=(i,)) for i in range(threads)]
+        workers.append(threading.Thread(target=subscribe))
+
+        for worker in workers: worker.start()
+        for worker in workers: worker.join()
+
+        calls += sum(counter)
+        duplicates += sum(count > 1 for count in counter)
+        missed += sum(count == 0 for count in counter)
+
+    return {"rounds": rounds, "threads": threads, "callbacks": calls, "duplicates": duplicates, "missed": missed}
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=100000)
+    parser.add_argument("--rounds", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    from concurrent.futures import Future
+
+    callback = lambda e: None
+    namespace = {"Expected": Expected, "Future": Future, "callback": callback, "items": [Expected() for _ in range(100)]}
+    small = max(1, args.count // 100)
+
+    result = {
+        "count": args.count,
+        "create_finish_ns": round(measure("Expected().finish()", args.count, namespace), 1),
+        "future_create_finish_ns": round(measure("Future().set_result(None)", args.count, namespace), 1),
+        "callback_ns": round(measure("e = Expected(); e.add_done_callback(callback); e.finish()", args.count, namespace), 1),
+        "future_callback_ns": round(measure("f = Future(); f.add_done_callback(callback); f.set_result(None)", args.count, namespace), 1),
+        "late_callback_ns": round(measure("e = Expected(); e.finish(); e.add_done_callback(callback)", args.count, namespace), 1),
+        "then_ns": round(measure("e = Expected(1); t = e.then(lambda v: v + 1); e.finish()", args.count, namespace), 1),
+        "with_timeout_ns": round(measure("e = Expected(); t = e.with_timeout(60); e.finish()", args.count, namespace), 1),
+        "gather_100_ns": round(measure("items = [Expected() for _ in range(100)]; g = Expected.gather(items)\nfor e in items: e.finish()", small, namespace), 1),
+        "race_100_ns": round(measure("items = [Expected() for _ in range(100)]; r = Expected.race(items); items[0].finish()", small, namespace), 1),
+        "settle_race": race_settle(args.rounds, args.threads),
+    }
+
+    print(json.dumps(result, indent=4))
+
+if __name__ == "__main__":
+    main()
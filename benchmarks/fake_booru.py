@@ -0,0 +1,214 @@
+# fake_booru.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Local stand-in for the Danbooru API and its CDN, served over HTTP/2 by H2Server.
+
+/posts.json and /tags.json answer like Danbooru does for the parameters the
+app sends, images are served under /cdn/ as noise PNGs of a chosen size.
+Latency, bandwidth, error rate and payload sizes come from a Profile.
+
+>>> with FakeBooru(Profile(latency=0.05, bandwidth=4 * 1024 ** 2)) as booru:
+...     booru.url
+"""
+
+import email.utils, functools, hashlib, json, random, struct, threading, zlib
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+from benchmarks.h2_server import H2Server, Response, split
+
+
+@dataclass(init=True)
+class Profile:
+
+    # Seconds before the headers of every response
+    latency: float = 0.0
+    # Bytes per second for each response body, 0 for no limit
+    bandwidth: int = 0
+    # Fraction of requests answered with error_status instead
+    error_rate: float = 0.0
+    error_status: int = 500
+
+    posts: int = 1000
+    tags: int = 2000
+    image_bytes: int = 256 * 1024
+
+    chunk_size: int = 16 * 1024
+    seed: int = 0
+
+
+VARIANTS = [("180x180", 180, 180), ("360x360", 360, 360), ("720x720", 720, 720), ("sample", 850, 850), ("original", 2000, 2000)]
+
+SYLLABLES = ["ka", "ri", "mo", "su", "ne", "to", "ha", "yu", "mi", "ro", "sa", "ke"]
+
+
+def make_png(width: int, height: int, seed: int) -> bytes:
+    """Noise RGB image, it doesn't compress so its size is close to width * height * 3"""
+
+    generator = random.Random(seed)
+    rows = b"".join(b"\x00" + generator.randbytes(width * 3) for _ in range(height))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows, 1)) + chunk(b"IEND", b"")
+
+def get_hash(id: int) -> str:
+    return hashlib.md5(f"post-{id}".encode()).hexdigest()
+
+def get_image_url(base_url: str, id: int, kind: str = "original") -> str:
+    md5 = get_hash(id)
+    return f"{base_url}/cdn/{kind}/{md5[0:2]}/{md5[2:4]}/{md5}.png"
+
+def make_tag_name(index: int) -> str:
+
+    name = ""
+    while True:
+        index, rest = divmod(index, len(SYLLABLES))
+        name += SYLLABLES[rest]
+        if index == 0: break
+
+    return name
+
+
+class FakeBooru:
+
+    def __init__(self, profile: Optional[Profile] = None) -> None:
+
+        self.profile = profile or Profile()
+
+        self.server = H2Server(self.handle)
+
+        self.random = random.Random(self.profile.seed)
+        self.lock = threading.Lock()
+
+        # Highest id first, like Danbooru orders posts
+        self.ids = list(range(self.profile.posts, 0, -1))
+        self.hashes = {get_hash(id): id for id in self.ids}
+
+        self.tag_names = sorted(make_tag_name(index) for index in range(self.profile.tags))
+        self.errors = 0
+
+    @property
+    def url(self) -> str:
+        return self.server.url
+
+    @functools.lru_cache(maxsize=64)
+    def get_image(self, id: int) -> bytes:
+        side = max(1, int((self.profile.image_bytes / 3) ** 0.5))
+        return make_png(side, side, id)
+
+    def get_post(self, id: int) -> dict:
+
+        md5 = get_hash(id)
+
+        variants = [{
+            "type": kind,
+            "url": get_image_url(self.url, id, kind),
+            "width": width,
+            "height": height,
+            "file_ext": "png"
+        } for kind, width, height in VARIANTS]
+
+        return {"id": id, "md5": md5, "tag_string": "", "media_asset": {"md5": md5, "variants": variants}}
+
+    def get_posts(self, query: dict[str, list[str]]) -> list[dict]:
+
+        limit = int(query.get("limit", ["20"])[0])
+        page = query.get("page", [None])[0]
+
+        ids = self.ids
+        if page is not None and page.startswith("b"):
+            below = int(page[1:])
+            ids = [id for id in ids if id < below]
+
+        return [self.get_post(id) for id in ids[:limit]]
+
+    def get_tags(self, query: dict[str, list[str]]) -> list[dict]:
+
+        pattern = query.get("search[name_or_alias_matches]", ["*"])[0]
+        limit = int(query.get("limit", ["20"])[0])
+
+        prefix = pattern.rstrip("*")
+        names = [name for name in self.tag_names if name.startswith(prefix)]
+
+        tags = [{"name": name, "post_count": zlib.crc32(name.encode()) % 100000, "consequent_aliases": []} for name in names]
+        tags.sort(key=lambda tag: tag["post_count"], reverse=True)
+
+        return tags[:limit]
+
+    def is_error(self) -> bool:
+
+        if self.profile.error_rate <= 0: return False
+
+        with self.lock:
+            is_error = self.random.random() < self.profile.error_rate
+            if is_error: self.errors += 1
+
+        return is_error
+
+    def respond(self, body: bytes, content_type: str, method: str) -> Response:
+
+        headers = [("content-type", content_type), ("content-length", str(len(body))), ("date", email.utils.formatdate(usegmt=True))]
+
+        chunk_size = self.profile.chunk_size
+        chunk_delay = chunk_size / self.profile.bandwidth if self.profile.bandwidth else 0.0
+
+        if method == "HEAD": body = b""
+
+        return Response(200, headers, split(body, chunk_size), self.profile.latency, chunk_delay)
+
+    def handle(self, method: str, path: str, headers: dict[str, str]) -> Response:
+
+        if self.is_error():
+            body = json.dumps({"success": False, "message": "Injected failure"}).encode()
+            headers = [("content-type", "application/json"), ("date", email.utils.formatdate(usegmt=True))]
+            return Response(self.profile.error_status, headers, [body], self.profile.latency)
+
+        parts = urlsplit(path)
+        query = parse_qs(parts.query)
+
+        if parts.path == "/posts.json":
+            return self.respond(json.dumps(self.get_posts(query)).encode(), "application/json", method)
+
+        if parts.path == "/tags.json":
+            return self.respond(json.dumps(self.get_tags(query)).encode(), "application/json", method)
+
+        if parts.path.startswith("/cdn/"):
+            md5 = parts.path.rsplit("/", 1)[-1].split(".")[0]
+            if (id := self.hashes.get(md5)) is not None:
+                return self.respond(self.get_image(id), "image/png", method)
+
+        return Response(404, [("content-type", "text/plain")], [b"Not found"], self.profile.latency)
+
+    def start(self) -> "FakeBooru":
+        self.server.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.stop()
+
+    def __enter__(self) -> "FakeBooru":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
@@ -0,0 +1,198 @@
+# h2_server.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Minimal HTTP/2 cleartext server (prior knowledge, like the app's client uses) for benchmarks.
+
+Every request is answered on its own thread by a handler returning a Response,
+the body is sent as it is produced, respecting flow control, and a stream reset
+by the client stops it right away. Bytes sent and streams reset are counted.
+"""
+
+import socket, threading, time
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Optional
+
+import h2.config, h2.connection, h2.events, h2.exceptions
+
+
+@dataclass(init=True)
+class Response:
+
+    status: int = 200
+    headers: list[tuple[str, str]] = field(default_factory=list)
+    body: Iterable[bytes] = ()
+
+    # Seconds to wait before the headers, and between body chunks
+    latency: float = 0.0
+    chunk_delay: float = 0.0
+
+
+def split(data: bytes, chunk_size: int) -> Iterable[bytes]:
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
+
+
+class Connection:
+
+    def __init__(self, server: "H2Server", sock: socket.socket) -> None:
+
+        self.server = server
+        self.sock = sock
+
+        self.h2 = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding="utf-8"))
+
+        # Guards the h2 state machine and the socket, notified on window updates and resets
+        self.condition = threading.Condition()
+        self.reset: set[int] = set()
+        self.is_closed = False
+
+    def flush(self) -> None:
+        if data := self.h2.data_to_send():
+            self.sock.sendall(data)
+
+    def run(self) -> None:
+
+        with self.condition:
+            self.h2.initiate_connection()
+            self.flush()
+
+        try:
+            while data := self.sock.recv(65536):
+                with self.condition:
+                    for event in self.h2.receive_data(data):
+                        self.handle_event(event)
+                    self.flush()
+                    self.condition.notify_all()
+        except (OSError, h2.exceptions.ProtocolError): pass
+        finally:
+            with self.condition:
+                self.is_closed = True
+                self.condition.notify_all()
+            self.sock.close()
+
+    def handle_event(self, event: h2.events.Event) -> None:
+
+        match event:
+            case h2.events.RequestReceived():
+                headers = dict(event.headers)
+                threading.Thread(target=self.respond, args=(event.stream_id, headers), daemon=True).start()
+            case h2.events.DataReceived():
+                self.h2.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            case h2.events.StreamReset():
+                self.reset.add(event.stream_id)
+                self.server.count("streams_reset")
+
+    def respond(self, stream_id: int, headers: dict[str, str]) -> None:
+
+        response = self.server.handler(headers[":method"], headers[":path"], headers)
+        self.server.count("requests")
+
+        if response.latency: time.sleep(response.latency)
+
+        try:
+            with self.condition:
+                if stream_id in self.reset or self.is_closed: return
+                self.h2.send_headers(stream_id, [(":status", str(response.status)), *response.headers])
+                self.flush()
+
+            for chunk in response.body:
+                if response.chunk_delay: time.sleep(response.chunk_delay)
+                if not self.send_data(stream_id, chunk): return
+
+            with self.condition:
+                self.h2.end_stream(stream_id)
+                self.flush()
+
+        except (OSError, h2.exceptions.ProtocolError): return
+
+    def send_data(self, stream_id: int, data: bytes) -> bool:
+        """False once the client reset the stream or went away"""
+
+        while data:
+            with self.condition:
+
+                while not (stream_id in self.reset or self.is_closed) and self.h2.local_flow_control_window(stream_id) <= 0:
+                    self.condition.wait(0.1)
+
+                if stream_id in self.reset or self.is_closed: return False
+
+                size = min(len(data), self.h2.local_flow_control_window(stream_id), self.h2.max_outbound_frame_size)
+                self.h2.send_data(stream_id, data[:size])
+                self.flush()
+
+            self.server.count("bytes_sent", size)
+            data = data[size:]
+
+        return True
+
+
+class H2Server:
+    """
+    Serves handler(method, path, headers) -> Response on 127.0.0.1
+
+    >>> with H2Server(lambda method, path, headers: Response(body=[b"hi"])) as server:
+    ...     server.url
+    """
+
+    def __init__(self, handler: Callable[[str, str, dict[str, str]], Response], port: int = 0) -> None:
+
+        self.handler = handler
+
+        self.sock = socket.create_server(("127.0.0.1", port))
+        self.port = self.sock.getsockname()[1]
+
+        self.lock = threading.Lock()
+        self.counters: dict[str, int] = {"requests": 0, "bytes_sent": 0, "streams_reset": 0}
+
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counters[name] += amount
+
+    def snapshot(self) -> dict[str, int]:
+        with self.lock:
+            return dict(self.counters)
+
+    def serve(self) -> None:
+
+        while True:
+            try: sock, _ = self.sock.accept()
+            except OSError: break
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=Connection(self, sock).run, daemon=True).start()
+
+    def start(self) -> "H2Server":
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.sock.close()
+
+    def __enter__(self) -> "H2Server":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
@@ -0,0 +1,136 @@
+# metrics.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""Latency statistics and a sampler for the memory and threads of this process"""
+
+import math, os, resource, sys, threading, time
+from typing import Optional
+
+
+def percentile(values: list[float], fraction: float) -> Optional[float]:
+    """Nearest rank percentile, None without values"""
+
+    if not values: return None
+
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+
+    return ordered[index]
+
+def summarize(latencies: list[float]) -> dict:
+    """Milliseconds, rounded for the report"""
+
+    def to_ms(value: Optional[float]) -> Optional[float]:
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        "count": len(latencies),
+        "p50_ms": to_ms(percentile(latencies, 0.5)),
+        "p99_ms": to_ms(percentile(latencies, 0.99)),
+        "max_ms": to_ms(max(latencies, default=None)),
+    }
+
+def get_rss() -> Optional[int]:
+    """Current resident set size in bytes, Linux only"""
+
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError: return None
+
+def get_peak_rss() -> int:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def get_native_threads() -> Optional[int]:
+    """Every thread of the process, including the ones GLib and the TLS stack start, Linux only"""
+
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("Threads:"): return int(line.split()[1])
+    except OSError: pass
+
+    return None
+
+
+class Sampler:
+    """Polls RSS and thread counts in the background and keeps the peaks"""
+
+    def __init__(self, interval: float = 0.01) -> None:
+
+        self.interval = interval
+
+        self.peak_rss = get_rss() or 0
+        self.peak_threads = threading.active_count()
+        self.peak_native_threads = get_native_threads() or 0
+
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def sample(self) -> None:
+        self.peak_rss = max(self.peak_rss, get_rss() or 0)
+        # Not counting the sampler itself
+        self.peak_threads = max(self.peak_threads, threading.active_count() - 1)
+        self.peak_native_threads = max(self.peak_native_threads, (get_native_threads() or 1) - 1)
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self) -> "Sampler":
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> dict:
+
+        self.stopped.set()
+        if self.thread is not None: self.thread.join()
+
+        return {
+            "peak_rss_bytes": max(self.peak_rss, get_peak_rss()),
+            "peak_threads": self.peak_threads,
+            "peak_native_threads": self.peak_native_threads or None,
+            "threads_after": threading.active_count(),
+        }
+
+    def __enter__(self) -> "Sampler":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stopped.set()
+
+
+class Clock:
+    """Time since start, and time to the first result"""
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.first: Optional[float] = None
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def mark_first(self) -> None:
+        if self.first is None: self.first = self.elapsed()
+
+    @property
+    def first_ms(self) -> Optional[float]:
+        return None if self.first is None else round(self.first * 1000, 3)
@@ -0,0 +1,59 @@
+# settings_lookup.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Cost of one per-tile settings lookup, through Settings.get and through the cached schema.
+
+>>> python -m benchmarks.settings_lookup --count 1000000
+"""
+
+import argparse, json, timeit
+
+from benchmarks.environment import make_settings
+from weeb.backend.schema import BoardSettings
+
+
+def measure(statement: str, count: int, namespace: dict) -> float:
+    """Best of five runs, in nanoseconds per lookup"""
+    timer = timeit.Timer(statement, globals=namespace)
+    return min(timer.repeat(repeat=5, number=count)) / count * 1e9
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=200000)
+    args = parser.parse_args()
+
+    settings = make_settings({"board": {"orientation": 1, "lanes": 3, "tile": {"size": 200, "min_preview": 120}}})
+    board = BoardSettings()
+
+    namespace = {"settings": settings, "board": board}
+
+    result = {
+        "count": args.count,
+        "settings_get_ns": round(measure('settings.get("board/tile/size", 180)', args.count, namespace), 1),
+        "schema_ns": round(measure("board.tile_size", args.count, namespace), 1),
+        # The first read after a change goes through Settings.get again
+        "schema_after_change_ns": round(measure("board.invalidate(); board.tile_size", args.count, namespace), 1),
+    }
+
+    print(json.dumps(result, indent=4))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,453 @@
+# suite.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+End to end benchmarks of the backend against a local fake booru, without a display.
+
+Drives Downloader, DanBooru, ProvidersManager and the StreamImage decode path
+and reports time to first result, throughput, p50/p99 latencies, peak RSS and
+thread counts as JSON, meant to be compared between releases.
+
+The fake booru runs in this process while every scenario runs in a fresh
+interpreter with its own cache and config, so memory and threads are the app's alone.
+
+>>> python -m benchmarks.suite --latency 0.05 --bandwidth 8388608 --error-rate 0.01 --output results.json
+"""
+
+import argparse, json, platform, subprocess, sys, threading, time
+from dataclasses import asdict
+from typing import Callable, Optional
+
+from benchmarks.environment import isolate_paths, make_settings, run_main_loop
+from benchmarks.fake_booru import FakeBooru, Profile, get_image_url, make_tag_name
+from benchmarks.metrics import Clock, Sampler, summarize
+
+
+def get_throughput(amount: float, seconds: float) -> float:
+    return round(amount / seconds, 3) if seconds > 0 else 0.0
+
+def run_downloader(args: argparse.Namespace) -> dict:
+    """Every image requested at once through Downloader.get_async, like a board filling up"""
+
+    from weeb.backend.downloader import Downloader
+
+    downloader = Downloader()
+
+    latencies: list[float] = []
+    received = failures = 0
+
+    clock = Clock()
+
+    def start(done: Callable[[], None]) -> None:
+
+        remaining = args.requests
+
+        def get_callback(started: float) -> Callable:
+
+            def callback(e_response) -> None:
+                nonlocal remaining, received, failures
+
+                if e_response.is_failed() or e_response.value.status_code != 200: failures += 1
+                else:
+                    clock.mark_first()
+                    latencies.append(time.perf_counter() - started)
+                    received += len(e_response.value.content)
+
+                remaining -= 1
+                if remaining == 0: done()
+
+            return callback
+
+        for index in range(args.requests):
+            url = get_image_url(args.url, index % args.posts + 1, "720x720")
+            downloader.get_async(url, get_callback(time.perf_counter()))
+
+    completed = run_main_loop(start, args.timeout)
+    elapsed = clock.elapsed()
+
+    return {
+        "completed": completed,
+        "ttfr_ms": clock.first_ms,
+        "elapsed_s": round(elapsed, 3),
+        "bytes_per_s": get_throughput(received, elapsed),
+        "requests_per_s": get_throughput(len(latencies), elapsed),
+        "failures": failures,
+        "latency": summarize(latencies),
+    }
+
+def run_danbooru(args: argparse.Namespace) -> dict:
+    """Pages through posts with streaming on, one page after the other, then searches tags"""
+
+    from weeb.backend.providers.danbooru import DanBooru
+
+    provider = DanBooru()
+
+    page_latencies: list[float] = []
+    first_batches: list[float] = []
+    tag_latencies: list[float] = []
+
+    posts = failures = 0
+    clock = Clock()
+
+    def start(done: Callable[[], None]) -> None:
+
+        pages = iter(range(args.pages))
+        queries = iter(range(args.queries))
+
+        def next_tags() -> None:
+
+            index = next(queries, None)
+            if index is None:
+                done()
+                return
+
+            started = time.perf_counter()
+
+            def callback(e_tags) -> None:
+                nonlocal failures
+                if e_tags.is_failed(): failures += 1
+                else: tag_latencies.append(time.perf_counter() - started)
+                next_tags()
+
+            provider.search_tags_async(make_tag_name(index), callback)
+
+        def next_page(page) -> None:
+
+            if next(pages, None) is None:
+                next_tags()
+                return
+
+            started = time.perf_counter()
+            is_first = True
+
+            def on_batch(batch) -> None:
+                nonlocal is_first
+                clock.mark_first()
+                if is_first: first_batches.append(time.perf_counter() - started)
+                is_first = False
+
+            def callback(e_assets) -> None:
+                nonlocal posts, failures
+
+                if e_assets.is_failed():
+                    failures += 1
+                    next_page(page)
+                    return
+
+                page_latencies.append(time.perf_counter() - started)
+                posts += len(e_assets.value)
+                next_page(provider.get_next_page(e_assets.value))
+
+            provider.search_assets_async(["benchmark"], callback, page, args.page_size, on_batch)
+
+        next_page(None)
+
+    completed = run_main_loop(start, args.timeout)
+    elapsed = clock.elapsed()
+
+    return {
+        "completed": completed,
+        "ttfr_ms": clock.first_ms,
+        "elapsed_s": round(elapsed, 3),
+        "posts_per_s": get_throughput(posts, elapsed),
+        "failures": failures,
+        "page_latency": summarize(page_latencies),
+        "first_batch_latency": summarize(first_batches),
+        "tag_latency": summarize(tag_latencies),
+    }
+
+def run_providers(args: argparse.Namespace) -> dict:
+    """A search paged through ProvidersManager, deadlines, health and dedup included, then tag lookups"""
+
+    from weeb.backend.providers_manager import ProvidersManager
+
+    manager = ProvidersManager()
+
+    page_latencies: list[float] = []
+    first_batches: list[float] = []
+    tag_latencies: list[float] = []
+
+    assets = failures = 0
+    statuses: dict[str, int] = {}
+
+    clock = Clock()
+
+    def start(done: Callable[[], None]) -> None:
+
+        search = manager.create_search(["benchmark"])
+
+        pages = iter(range(args.pages))
+        queries = iter(range(args.queries))
+
+        def next_tags() -> None:
+
+            index = next(queries, None)
+            if index is None:
+                done()
+                return
+
+            started = time.perf_counter()
+
+            def callback(e_tags) -> None:
+                nonlocal failures
+                if e_tags.is_failed(): failures += 1
+                else: tag_latencies.append(time.perf_counter() - started)
+                next_tags()
+
+            manager.search_tags_async(make_tag_name(index), callback)
+
+        def next_page() -> None:
+
+            if next(pages, None) is None or search.is_exhausted():
+                next_tags()
+                return
+
+            started = time.perf_counter()
+            is_first = True
+
+            def on_batch(provider, batch) -> None:
+                nonlocal is_first
+                clock.mark_first()
+                if is_first: first_batches.append(time.perf_counter() - started)
+                is_first = False
+
+            def callback(e_assets) -> None:
+                nonlocal assets
+
+                page_latencies.append(time.perf_counter() - started)
+                assets += len(e_assets.value)
+
+                for status in search.statuses.values():
+                    statuses[status.value] = statuses.get(status.value, 0) + 1
+
+                next_page()
+
+            search.next_page_async(callback, on_batch)
+
+        next_page()
+
+    completed = run_main_loop(start, args.timeout)
+    elapsed = clock.elapsed()
+
+    return {
+        "completed": completed,
+        "ttfr_ms": clock.first_ms,
+        "elapsed_s": round(elapsed, 3),
+        "assets_per_s": get_throughput(assets, elapsed),
+        "failures": failures,
+        "provider_statuses": statuses,
+        "page_latency": summarize(page_latencies),
+        "first_batch_latency": summarize(first_batches),
+        "tag_latency": summarize(tag_latencies),
+    }
+
+def run_stream_image(args: argparse.Namespace) -> dict:
+    """What StreamImage.fetch() does for every tile, streamed download into the incremental decoder"""
+
+    from weeb.backend.downloader import Downloader
+    from weeb.backend.schema import DedupSettings
+    from weeb.backend.utils.threading import Lane
+    from weeb.frontend.widgets.image_decoder import ImageDecoder
+
+    downloader = Downloader()
+    fingerprint = DedupSettings().perceptual
+
+    lock = threading.Lock()
+
+    first_pixels: list[float] = []
+    decoded: list[float] = []
+
+    received = failures = 0
+    clock = Clock()
+
+    def start(done: Callable[[], None]) -> None:
+
+        remaining = args.requests
+
+        def settle(latency: Optional[float]) -> None:
+            nonlocal remaining, failures
+
+            with lock:
+                if latency is None: failures += 1
+                else: decoded.append(latency)
+                remaining -= 1
+                is_last = remaining == 0
+
+            if is_last: done()
+
+        def fetch(url: str) -> None:
+
+            decoder = ImageDecoder()
+            started = time.perf_counter()
+            has_pixels = False
+
+            def update_data(data: bytes) -> None:
+                nonlocal received, has_pixels
+
+                decoder.write(data)
+
+                with lock: received += len(data)
+
+                # The first partial frame a tile would present
+                if not has_pixels and decoder.has_update and decoder.snapshot() is not None:
+                    has_pixels = True
+                    clock.mark_first()
+                    with lock: first_pixels.append(time.perf_counter() - started)
+
+            def on_finish() -> None:
+                try: texture = decoder.close(fingerprint)
+                except Exception: texture = None
+                settle(None if texture is None else time.perf_counter() - started)
+
+            e_bytes = downloader.download_async(url, update_data, stream=True, lane=Lane.VISIBLE)
+            e_bytes.set_on_finish(on_finish)
+            e_bytes.set_on_fail(lambda: settle(None))
+
+        for index in range(args.requests):
+            fetch(get_image_url(args.url, index % args.posts + 1, "sample"))
+
+    completed = run_main_loop(start, args.timeout)
+    elapsed = clock.elapsed()
+
+    return {
+        "completed": completed,
+        "ttfr_ms": clock.first_ms,
+        "elapsed_s": round(elapsed, 3),
+        "bytes_per_s": get_throughput(received, elapsed),
+        "images_per_s": get_throughput(len(decoded), elapsed),
+        "failures": failures,
+        "first_pixels_latency": summarize(first_pixels),
+        "decode_latency": summarize(decoded),
+    }
+
+SCENARIOS: dict[str, Callable[[argparse.Namespace], dict]] = {
+    "downloader": run_downloader,
+    "danbooru": run_danbooru,
+    "providers": run_providers,
+    "stream_image": run_stream_image,
+}
+
+def run_scenario(args: argparse.Namespace) -> dict:
+    """Runs in the child interpreter, against the fake booru at args.url"""
+
+    isolate_paths()
+
+    config = {
+        "downloader": {"engine": args.engine},
+        "providers": {"page_size": args.page_size, "DanBooru": {"base_url": args.url}},
+    }
+
+    # The app's limits are meant for the real Danbooru, they would measure the limiter instead
+    if not args.keep_rate_limits:
+        unlimited = {"rate": 1e9, "burst": 1e9}
+        config["downloader"]["rate_limit"] = {"api": unlimited, "cdn": unlimited}
+
+    make_settings(config)
+
+    with Sampler() as sampler:
+        result = SCENARIOS[args.scenario](args)
+
+    return result | sampler.stop()
+
+def run_suite(args: argparse.Namespace, argv: list[str]) -> dict:
+
+    profile = Profile(args.latency, args.bandwidth, args.error_rate, args.error_status,
+        args.posts, args.tags, args.image_bytes, args.chunk_size, args.seed)
+
+    names = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+    results: dict[str, dict] = {}
+
+    with FakeBooru(profile) as booru:
+
+        for name in names:
+
+            before, errors = booru.server.snapshot(), booru.errors
+
+            # Later options win, so the child gets everything this run got
+            command = [sys.executable, "-m", "benchmarks.suite", *argv, "--scenario", name, "--url", booru.url]
+
+            try:
+                child = subprocess.run(command, stdout=subprocess.PIPE, text=True, timeout=args.timeout + 30)
+                if child.returncode == 0: result = json.loads(child.stdout)
+                else: result = {"error": f"Exited with {child.returncode}"}
+            except subprocess.TimeoutExpired: result = {"error": "Timed out"}
+
+            after = booru.server.snapshot()
+
+            result["server"] = {key: after[key] - before[key] for key in after}
+            result["server"]["injected_errors"] = booru.errors - errors
+
+            results[name] = result
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "profile": asdict(profile),
+        "workload": {
+            "engine": args.engine,
+            "requests": args.requests,
+            "pages": args.pages,
+            "page_size": args.page_size,
+            "queries": args.queries,
+            "rate_limits": args.keep_rate_limits,
+        },
+        "scenarios": results,
+    }
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=[*SCENARIOS, "all"], default="all")
+    parser.add_argument("--output", help="file to write the report to, stdout otherwise")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds each scenario may take")
+
+    server = parser.add_argument_group("fake booru")
+    server.add_argument("--latency", type=float, default=0.02, help="seconds before every response")
+    server.add_argument("--bandwidth", type=int, default=0, help="bytes per second for each response, 0 for no limit")
+    server.add_argument("--error-rate", type=float, default=0.0)
+    server.add_argument("--error-status", type=int, default=500)
+    server.add_argument("--posts", type=int, default=1000)
+    server.add_argument("--tags", type=int, default=2000)
+    server.add_argument("--image-bytes", type=int, default=256 * 1024)
+    server.add_argument("--chunk-size", type=int, default=16 * 1024)
+    server.add_argument("--seed", type=int, default=0)
+
+    workload = parser.add_argument_group("workload")
+    workload.add_argument("--engine", choices=("threaded", "async"), default="threaded")
+    workload.add_argument("--requests", type=int, default=64, help="images fetched by the downloader and stream_image scenarios")
+    workload.add_argument("--pages", type=int, default=5)
+    workload.add_argument("--page-size", type=int, default=30)
+    workload.add_argument("--queries", type=int, default=20, help="tag searches")
+    workload.add_argument("--keep-rate-limits", action="store_true", help="keep the app's per host rate limits")
+
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.url is not None: report = run_scenario(args)
+    else: report = run_suite(args, sys.argv[1:])
+
+    output = json.dumps(report, indent=4)
+
+    if args.url is not None or args.output is None: print(output)
+    else:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+# test_cancellation.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""Bytes of a streamed download stop within one chunk of cancel(), with either engine"""
+
+import subprocess, sys
+
+import pytest
+
+pytest.importorskip("h2")
+pytest.importorskip("gi")
+
+
+@pytest.mark.parametrize("engine", ["threaded", "async"])
+def test_cancel_stops_within_one_chunk(engine: str) -> None:
+
+    # A fresh interpreter each, the downloaders are singletons bound to their settings
+    command = [sys.executable, "-m", "benchmarks.cancellation", "--engine", engine, "--trials", "3", "--size", str(2 * 1024 ** 2), "--check"]
+    child = subprocess.run(command, capture_output=True, text=True, timeout=120)
+
+    assert child.returncode == 0, child.stderr.strip().splitlines()[-1] if child.stderr.strip() else child.stdout
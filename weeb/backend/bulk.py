@@ -0,0 +1,280 @@
+# bulk.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import enum, hashlib, logging, pathlib, sqlite3, threading, time
+from collections import deque
+from typing import Any, Callable, Iterable, Optional
+from urllib.parse import urlsplit
+
+from weeb.backend.downloader import Downloader
+from weeb.backend.primitives import Asset
+from weeb.backend.providers_manager import ProvidersManager
+from weeb.backend.settings import Settings
+from weeb.backend.utils.expected import Expected
+from weeb.backend.utils.paths import Paths
+from weeb.backend.utils.singleton import Singleton
+from weeb.backend.utils.threading import Lane
+
+
+class ItemState(enum.Enum):
+    PENDING = "pending"
+    DONE = "done"
+    FAILED = "failed"
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    created REAL NOT NULL,
+    cancelled INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS items (
+    job INTEGER NOT NULL REFERENCES jobs(id),
+    key TEXT NOT NULL,
+    url TEXT NOT NULL,
+    md5 TEXT,
+    state TEXT NOT NULL,
+    error TEXT,
+    PRIMARY KEY (job, key)
+);
+CREATE INDEX IF NOT EXISTS items_state ON items(state);
+"""
+
+
+class Journal:
+    """
+    SQLite record of bulk jobs and the state of every file in them.
+
+    Every state change is committed right away, so an interrupted job
+    continues after a restart exactly where it stopped.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def create_job(self, name: str) -> int:
+        with self.lock, self.connection:
+            cursor = self.connection.execute("INSERT INTO jobs (name, created) VALUES (?, ?)", (name, time.time()))
+            return cursor.lastrowid
+
+    def cancel_job(self, job: int) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE jobs SET cancelled = 1 WHERE id = ?", (job,))
+
+    def add_items(self, job: int, items: Iterable[tuple[str, str, Optional[str]]]) -> None:
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO items (job, key, url, md5, state) VALUES (?, ?, ?, ?, ?)",
+                [(job, key, url, md5, ItemState.PENDING.value) for key, url, md5 in items]
+            )
+
+    def set_state(self, job: int, key: str, state: ItemState, error: Optional[str] = None) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE items SET state = ?, error = ? WHERE job = ? AND key = ?", (state.value, error, job, key))
+
+    def get_pending(self) -> list[tuple[int, str, str, Optional[str]]]:
+        with self.lock:
+            return self.connection.execute(
+                "SELECT items.job, key, url, md5 FROM items JOIN jobs ON jobs.id = items.job "
+                "WHERE state = ? AND NOT cancelled ORDER BY items.job, items.rowid", (ItemState.PENDING.value,)
+            ).fetchall()
+
+    def get_progress(self, job: int) -> dict[str, int]:
+        with self.lock:
+            rows = self.connection.execute("SELECT state, COUNT(*) FROM items WHERE job = ? GROUP BY state", (job,)).fetchall()
+        return {state.value: 0 for state in ItemState} | dict(rows)
+
+
+class BulkDownloader(metaclass=Singleton):
+    """
+    Downloads many originals in the background.
+
+    At most "bulk/concurrency" transfers run at once and no more than
+    "bulk/per_host" of them against the same host. Files are stored by md5
+    under "bulk/library", so an image that is already there, from this job
+    or any other, is never fetched again. Pending work is read back from
+    the journal on start.
+    """
+
+    settings = Settings()
+
+    def __init__(self) -> None:
+
+        self.downloader = Downloader()
+        self.journal = Journal(Paths.get("bulk.sqlite3", parents=True))
+
+        self.library = pathlib.Path(self.settings.get("bulk/library", Paths.get("library").as_posix()))
+
+        # Queued items per host, so a busy host doesn't hold up the others
+        self.queues: dict[str, deque[tuple[int, str, str, Optional[str]]]] = {}
+        self.running: dict[str, tuple[int, Expected]] = {}
+        self.hosts: dict[str, int] = {}
+
+        self.listeners: list[Callable[[int, dict[str, int]], Any]] = []
+
+        if pending := self.journal.get_pending():
+            logging.info(f"Resuming {len(pending)} bulk downloads")
+            self.enqueue(pending)
+
+        self.pump()
+
+    def connect(self, callback: Callable[[int, dict[str, int]], Any]) -> None:
+        """Callback gets the job and its progress by state whenever an item of it settles"""
+        self.listeners.append(callback)
+
+    @staticmethod
+    def get_key(asset: Asset) -> str:
+        return asset.hash or hashlib.sha1(asset.original.url.encode()).hexdigest()
+
+    def get_path(self, key: str, url: str) -> pathlib.Path:
+        suffix = pathlib.PurePosixPath(urlsplit(url).path).suffix
+        return self.library / key[:2] / f"{key}{suffix}"
+
+    def get_progress(self, job: int) -> dict[str, int]:
+        return self.journal.get_progress(job)
+
+    def enqueue(self, items: Iterable[tuple[int, str, str, Optional[str]]]) -> None:
+        for item in items:
+            host = urlsplit(item[2]).hostname
+            self.queues.setdefault(host, deque()).append(item)
+
+    def add_assets(self, job: int, assets: Iterable[Asset]) -> None:
+
+        items = [(self.get_key(asset), asset.original.url, asset.hash) for asset in assets]
+
+        self.journal.add_items(job, items)
+        self.enqueue((job, *item) for item in items)
+
+        self.pump()
+
+    def download_assets(self, assets: Iterable[Asset], name: str) -> int:
+        job = self.journal.create_job(name)
+        self.add_assets(job, assets)
+        return job
+
+    def download_query(self, tags: list[str], limit: Optional[int] = None) -> int:
+        """Pages through a search and queues everything it finds, up to limit assets"""
+
+        job = self.journal.create_job(" ".join(tags))
+        search = ProvidersManager().create_search(tags)
+
+        found = 0
+
+        def on_page(e_assets: Expected[set[Asset]]) -> None:
+            nonlocal found
+
+            if e_assets.is_cancelled(): return
+
+            assets = list(e_assets.value or ())
+            if limit is not None: assets = assets[:limit - found]
+
+            found += len(assets)
+            self.add_assets(job, assets)
+
+            # Nothing at all means every provider is down or failed, don't spin on it
+            if not assets or search.is_exhausted(): return
+            if limit is not None and found >= limit: return
+
+            search.next_page_async(on_page)
+
+        search.next_page_async(on_page)
+
+        return job
+
+    def cancel(self, job: int) -> None:
+        """Stops a job, files already downloaded stay in the library"""
+
+        self.journal.cancel_job(job)
+
+        for host, queue in self.queues.items():
+            self.queues[host] = deque(item for item in queue if item[0] != job)
+
+        for item_job, e_path in list(self.running.values()):
+            if item_job == job: e_path.cancel()
+
+    def pump(self) -> None:
+        """Starts as many queued transfers as the limits allow"""
+
+        concurrency = self.settings.get("bulk/concurrency", 4)
+        per_host = self.settings.get("bulk/per_host", 2)
+
+        for host, queue in list(self.queues.items()):
+
+            while queue and len(self.running) < concurrency and self.hosts.get(host, 0) < per_host:
+
+                job, key, url, md5 = queue.popleft()
+                path = self.get_path(key, url)
+
+                if path.exists():
+                    self.settle(job, key, ItemState.DONE)
+                    continue
+
+                # The same file is being fetched for another job, look again once it is done
+                if key in self.running:
+                    queue.append((job, key, url, md5))
+                    break
+
+                self.start(job, key, url, md5, host, path)
+
+        for host in [host for host, queue in self.queues.items() if not queue]:
+            del self.queues[host]
+
+    def start(self, job: int, key: str, url: str, md5: Optional[str], host: str, path: pathlib.Path) -> None:
+
+        def release() -> bool:
+            if self.running.pop(key, None) is None: return False
+            self.hosts[host] -= 1
+            return True
+
+        def on_done(e_path: Expected[pathlib.Path]) -> None:
+
+            if not release(): return
+
+            if e_path.is_failed():
+                logging.error(f"Bulk download of {url} failed: {e_path.get_error()}")
+                self.settle(job, key, ItemState.FAILED, str(e_path.get_error()))
+            else: self.settle(job, key, ItemState.DONE)
+
+            self.pump()
+
+        def on_cancel() -> None:
+            # Cancelled transfers never call back, their slot is given back right away
+            if release(): self.pump()
+
+        self.hosts[host] = self.hosts.get(host, 0) + 1
+
+        # The pool runs only a few PREFETCH jobs at once, so transfers and their segments leave workers for the UI
+        e_path = self.downloader.download_file_async(url, path, on_done, md5, lane=Lane.PREFETCH)
+        e_path.set_on_cancel(on_cancel)
+
+        self.running[key] = (job, e_path)
+
+    def settle(self, job: int, key: str, state: ItemState, error: Optional[str] = None) -> None:
+
+        self.journal.set_state(job, key, state, error)
+        progress = self.journal.get_progress(job)
+
+        for listener in self.listeners:
+            listener(job, progress)
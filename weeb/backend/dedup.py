@@ -0,0 +1,82 @@
+# dedup.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from typing import Iterable, Optional
+
+from weeb.backend.primitives import Asset
+from weeb.backend.utils.perceptual import distance
+
+
+class Deduplicator:
+    """
+    Collapses the same image found more than once into a single asset.
+
+    Assets sharing an md5 are merged, the first one seen stays the primary and
+    the others become its mirrors. Perceptual fingerprints of decoded
+    thumbnails catch re-encodes and resizes that have a different md5.
+    """
+
+    def __init__(self, max_distance: int = 4) -> None:
+
+        self.max_distance = max_distance
+
+        self.by_hash: dict[str, Asset] = {}
+        self.fingerprints: list[tuple[int, Asset]] = []
+
+    def add(self, assets: Iterable[Asset]) -> tuple[list[Asset], list[Asset]]:
+        """Returns the assets never seen before and the already known ones that got new mirrors"""
+
+        fresh: list[Asset] = []
+        merged: dict[str, Asset] = {}
+
+        for asset in assets:
+
+            if not asset.hash:
+                fresh.append(asset)
+                continue
+
+            known = self.by_hash.get(asset.hash)
+
+            if known is None:
+                self.by_hash[asset.hash] = asset
+                fresh.append(asset)
+            elif known != asset and (asset.provider, asset.id) not in ((mirror.provider, mirror.id) for mirror in known.mirrors):
+                known = self.by_hash[asset.hash] = known.with_mirror(asset)
+                merged[asset.hash] = known
+
+        return fresh, list(merged.values())
+
+    def get(self, asset: Asset) -> Asset:
+        """Returns the merged asset asset is a part of"""
+        if not asset.hash: return asset
+        return self.by_hash.get(asset.hash, asset)
+
+    def add_fingerprint(self, asset: Asset, fingerprint: int) -> Optional[Asset]:
+        """Returns the asset that already has a close enough fingerprint, if any"""
+
+        match: Optional[Asset] = None
+
+        for known_fingerprint, known in self.fingerprints:
+            if known == asset: return None
+            if match is None and distance(fingerprint, known_fingerprint) <= self.max_distance:
+                match = known
+
+        if match is None: self.fingerprints.append((fingerprint, asset))
+
+        return match
@@ -17,18 +17,31 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from typing import Any, Callable
+import pathlib
+from typing import Any, Callable, Optional
 
 import hishel, httpx
 
+from weeb.backend.http_cache import STREAMED, AsyncPolicyTransport, AsyncSQLiteStorage, AsyncStaleWhileRevalidateTransport, AsyncStreamingTransport, PolicyTransport, StaleWhileRevalidateTransport, StreamingTransport, get_storage
+from weeb.backend.rate_limiter import AsyncRateLimitedTransport, RateLimitedTransport
 from weeb.backend.settings import Priority, Settings
-from weeb.backend.utils.expected import Expected
+from weeb.backend.transfer import RangedDownload
+from weeb.backend.utils.expected import CancellationToken, Expected
 from weeb.backend.utils.singleton import Singleton
-from weeb.backend.utils.threading import run_in_thread
+from weeb.backend.utils.threading import EventLoopThread, Job, Lane, WorkerPool, run_in_loop, run_in_pool, run_in_thread
 
 from weeb.backend.constants import version
 
 
+def create_controller() -> hishel.Controller:
+    # Freshness comes from the per route headers set by PolicyTransport
+    return hishel.Controller(
+        allow_heuristics=True,
+        cacheable_status_codes=hishel.HEURISTICALLY_CACHEABLE_STATUS_CODES,
+        allow_stale=True
+    )
+
+
 class Downloader(metaclass=Singleton):
 
     def __init__(self) -> None:
@@ -39,51 +52,141 @@ class Downloader(metaclass=Singleton):
 
         self.create_client(self.settings.get("proxy/uri"))
 
-    def create_client(self, proxy: str) -> None:
+    @property
+    def is_async(self) -> bool:
+        return self.settings.get("downloader/engine", "threaded") == "async"
 
-        controller = hishel.Controller(
-            allow_heuristics=True,
-            cacheable_status_codes=hishel.HEURISTICALLY_CACHEABLE_STATUS_CODES,
-            allow_stale=True,
-            always_revalidate=True
-        )
+    def create_client(self, proxy: str) -> None:
 
-        storage = hishel.FileStorage()
         limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
         transport = httpx.HTTPTransport(http1=False, http2=True, limits=limits, proxy=proxy)
+        # Below the cache, only requests that reach the network spend the host's budget or get a policy
+        transport = PolicyTransport(RateLimitedTransport(transport))
 
+        storage, controller = get_storage(), create_controller()
         cache_transport = hishel.CacheTransport(transport=transport, storage=storage, controller=controller)
-        
-        self.client = httpx.Client(transport=cache_transport)
+
+        self.client = httpx.Client(transport=StreamingTransport(StaleWhileRevalidateTransport(cache_transport), transport, storage, controller))
         self.client.headers.update({"User-Agent": f"RozeFound/Weeb/{version}"})
 
     def get(self, url: str, **kwargs) -> httpx.Response:
         return self.client.get(url, **kwargs)
 
-    def get_async(self, url: str, callback: Callable[[httpx.Response], Any], **kwargs) -> Expected[httpx.Response]:
-        return run_in_thread(self.get, callback, url, **kwargs)
+    def get_async(self, url: str, callback: Callable[[httpx.Response], Any], lane: Lane = Lane.INTERACTIVE, **kwargs) -> Expected[httpx.Response]:
+        if self.is_async: return AsyncDownloader().get_async(url, callback, lane, **kwargs)
+        return run_in_thread(self.get, callback, url, lane=lane, **kwargs)
 
     def stream(self, url: str, method: str = "GET", **kwargs):
+        # Cache misses arrive chunk by chunk and are stored once complete
+        kwargs["extensions"] = kwargs.get("extensions", {}) | STREAMED
         return self.client.stream(method, url, **kwargs)
 
-    def stream_async(self, url: str, callback: Callable[[httpx.Response], Any], **kwargs) -> Expected[httpx.Response]:
-        return run_in_thread(self.stream, callback, url, **kwargs)
+    def stream_async(self, url: str, callback: Callable[[httpx.Response], Any], lane: Lane = Lane.INTERACTIVE, **kwargs) -> Expected[httpx.Response]:
+        if self.is_async: return AsyncDownloader().stream_async(url, callback, lane, **kwargs)
+        return run_in_thread(self.stream, callback, url, lane=lane, **kwargs)
 
     def download(self, url: str, stream = False, **kwargs) -> bytes | httpx.Response:
         if stream: return self.stream(url, **kwargs)
         else: return self.get(url, **kwargs).content
   
-    def download_async(self, url: str, callback: Callable[[bytes], Any], stream = False, **kwargs) -> Expected[bytes]:
+    def download_async(self, url: str, callback: Callable[[bytes], Any], stream = False, lane: Lane = Lane.VISIBLE, **kwargs) -> Expected[bytes]:
 
-        e_bytes: Expected = None
+        if self.is_async: return AsyncDownloader().download_async(url, callback, stream, lane, **kwargs)
+
+        if not stream:
+            return run_in_thread(self.download, callback, url, False, lane=lane, **kwargs)
+
+        e_bytes: Expected = Expected()
 
         def helper(url: str, callback: Callable[[bytes], Any], **kwargs):
             with self.stream(url, "GET", **kwargs) as response:
-                for chunk in response.iter_bytes():
-                    callback(chunk)
+                # Closing from the cancelling thread aborts a read that is still waiting for data
+                remove = e_bytes.token.add_callback(response.close)
+                try:
+                    for chunk in response.iter_bytes():
+                        if e_bytes.is_cancelled(): break
+                        callback(chunk)
+                finally: remove()
 
-        if stream: e_bytes = run_in_thread(helper, None, url, callback, **kwargs)
-        else: e_bytes = run_in_thread(self.download, callback, url, False, **kwargs)
+        WorkerPool().submit(Job(helper, e_bytes, None, url, callback, **kwargs), lane)
 
         return e_bytes
-        
\ No newline at end of file
+
+    def download_file(self, url: str, destination: pathlib.Path, md5: Optional[str] = None, on_progress: Optional[Callable[[int, Optional[int]], Any]] = None, token: Optional[CancellationToken] = None) -> pathlib.Path:
+        """Resumable download straight to disk, meant for originals and other big files"""
+        return RangedDownload(self.client, url, md5, on_progress, token).run(destination)
+
+    def download_file_async(self, url: str, destination: pathlib.Path, callback: Callable[[Expected[pathlib.Path]], Any], md5: Optional[str] = None, on_progress: Optional[Callable[[int, Optional[int]], Any]] = None, lane: Lane = Lane.PREFETCH) -> Expected[pathlib.Path]:
+        """
+        Same as download_file on a worker, on_progress is called from that worker.
+        Cancelling stops the transfer after the current chunk and keeps the partial file for later.
+        """
+
+        e_path: Expected = Expected()
+        WorkerPool().submit(Job(self.download_file, e_path, callback, url, destination, md5, on_progress, e_path.token), lane)
+
+        return e_path
+
+
+class AsyncDownloader(metaclass=Singleton):
+    """
+    Same async contract as Downloader, but every transfer is a coroutine
+    on one shared event loop, so concurrent requests don't cost a thread each.
+
+    Enabled for Downloader with the "downloader/engine" setting set to "async"
+    """
+
+    def __init__(self) -> None:
+
+        self.settings = Settings()
+        self.event_loop = EventLoopThread()
+
+        self.client: httpx.AsyncClient = None
+
+        self.settings.connect("proxy/uri", self.create_client, Priority.HIGH)
+
+        self.create_client(self.settings.get("proxy/uri"))
+
+    def create_client(self, proxy: str) -> None:
+
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        transport = httpx.AsyncHTTPTransport(http1=False, http2=True, limits=limits, proxy=proxy)
+        transport = AsyncPolicyTransport(AsyncRateLimitedTransport(transport))
+
+        storage, controller = AsyncSQLiteStorage(get_storage()), create_controller()
+        cache_transport = hishel.AsyncCacheTransport(transport=transport, storage=storage, controller=controller)
+
+        old_client, self.client = self.client, httpx.AsyncClient(transport=AsyncStreamingTransport(AsyncStaleWhileRevalidateTransport(cache_transport), transport, storage, controller))
+        self.client.headers.update({"User-Agent": f"RozeFound/Weeb/{version}"})
+
+        if old_client is not None:
+            self.event_loop.submit(old_client.aclose())
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.client.get(url, **kwargs)
+
+    def get_async(self, url: str, callback: Callable[[httpx.Response], Any], lane: Lane = Lane.INTERACTIVE, **kwargs) -> Expected[httpx.Response]:
+        return run_in_loop(self.get, callback, url, lane=lane, **kwargs)
+
+    async def stream(self, url: str, method: str = "GET", **kwargs):
+        kwargs["extensions"] = kwargs.get("extensions", {}) | STREAMED
+        return self.client.stream(method, url, **kwargs)
+
+    def stream_async(self, url: str, callback: Callable[[httpx.Response], Any], lane: Lane = Lane.INTERACTIVE, **kwargs) -> Expected[httpx.Response]:
+        return run_in_loop(self.stream, callback, url, lane=lane, **kwargs)
+
+    async def download(self, url: str, **kwargs) -> bytes:
+        response = await self.get(url, **kwargs)
+        return response.content
+
+    def download_async(self, url: str, callback: Callable[[bytes], Any], stream = False, lane: Lane = Lane.VISIBLE, **kwargs) -> Expected[bytes]:
+        """Chunks are handed to callback on a worker of lane, one at a time and in order, as is finishing"""
+
+        async def helper(url: str, callback: Callable[[bytes], Any], **kwargs):
+            async with self.client.stream("GET", url, extensions=STREAMED, **kwargs) as response:
+                async for chunk in response.aiter_bytes():
+                    # Callbacks like decoders block, the loop only waits for them
+                    await run_in_pool(callback, chunk, lane=lane)
+
+        if stream: return run_in_loop(helper, None, url, callback, lane=lane, **kwargs)
+        else: return run_in_loop(self.download, callback, url, lane=lane, **kwargs)
@@ -0,0 +1,252 @@
+# health.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import enum, logging, time
+from typing import Any, Callable, Optional
+
+from gi.repository import GLib
+
+from weeb.backend.primitives import Booru
+from weeb.backend.settings import Settings
+from weeb.backend.utils.expected import Expected
+
+
+class CircuitState(enum.Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class ProviderHealth:
+    """
+    Latency and error statistics of one provider, taken from real requests.
+
+    Latency and its deviation are exponentially weighted moving averages,
+    the same way TCP estimates its retransmission timeout. Repeated failures
+    open the circuit, after a cooldown a single request is let through
+    to probe whether the provider has recovered. A probe that is cancelled
+    releases its slot, one that never reports back expires after the cooldown.
+    """
+
+    settings = Settings()
+
+    def __init__(self, name: str) -> None:
+
+        self.name = name
+
+        self.alpha = self.settings.get("providers/health/alpha", 0.2)
+        self.failure_threshold = self.settings.get("providers/health/failure_threshold", 3)
+        self.cooldown = self.settings.get("providers/health/cooldown", 30.0)
+
+        self.latency: Optional[float] = None
+        self.deviation = 0.0
+
+        self.failures = 0
+        self.state = CircuitState.CLOSED
+        self.opened_at = 0.0
+
+        # Identifies the running probe, so only its owner can release it
+        self.probe: Optional[int] = None
+        self.probe_started = 0.0
+        self.probes = 0
+
+    def record_success(self, latency: float) -> None:
+
+        if self.latency is None:
+            self.latency, self.deviation = latency, latency / 2
+        else:
+            self.deviation += self.alpha * (abs(latency - self.latency) - self.deviation)
+            self.latency += self.alpha * (latency - self.latency)
+
+        self.failures = 0
+        self.probe = None
+
+        if self.state != CircuitState.CLOSED:
+            logging.info(f"{self.name} recovered, closing its circuit")
+            self.state = CircuitState.CLOSED
+
+    def record_failure(self) -> None:
+
+        self.failures += 1
+        self.probe = None
+
+        if self.state == CircuitState.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != CircuitState.OPEN:
+                logging.warning(f"{self.name} failed {self.failures} times, opening its circuit")
+            self.open()
+
+    def record_unreachable(self) -> None:
+        """The availability test failed, requests wait for a probe after the cooldown like after repeated failures"""
+
+        logging.warning(f"{self.name} is unreachable, opening its circuit")
+
+        self.failures = max(self.failures, self.failure_threshold)
+        self.probe = None
+        self.open()
+
+    def open(self) -> None:
+        self.state = CircuitState.OPEN
+        self.opened_at = time.monotonic()
+
+    def is_probing(self) -> bool:
+        return self.probe is not None and time.monotonic() - self.probe_started < self.cooldown
+
+    def allow_request(self) -> bool:
+        """Whether a request may be started now, without claiming anything"""
+
+        if self.state == CircuitState.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = CircuitState.HALF_OPEN
+
+        if self.state == CircuitState.HALF_OPEN: return not self.is_probing()
+
+        return self.state == CircuitState.CLOSED
+
+    def start_probe(self) -> Optional[int]:
+        """Claims the probe if the circuit is half open, returns its id to release it with"""
+
+        if self.state != CircuitState.HALF_OPEN or self.is_probing(): return None
+
+        self.probes += 1
+        self.probe, self.probe_started = self.probes, time.monotonic()
+
+        return self.probe
+
+    def release_probe(self, probe: int) -> None:
+        if self.probe == probe: self.probe = None
+
+    def get_timeout(self, default: float) -> float:
+        """Adaptive deadline, the default until there are samples"""
+
+        if self.latency is None: return default
+
+        minimum = self.settings.get("providers/health/min_timeout", 2.0)
+        maximum = self.settings.get("providers/health/max_timeout", 30.0)
+
+        return min(maximum, max(minimum, self.latency + 4 * self.deviation))
+
+    def get_hedge_delay(self) -> Optional[float]:
+        """Time after which a request is slower than usual, None until there are samples"""
+        if self.latency is None: return None
+        return self.latency + 2 * self.deviation
+
+
+class HealthMonitor:
+    """Keeps ProviderHealth for every provider and runs requests through it"""
+
+    settings = Settings()
+
+    def __init__(self) -> None:
+        self.providers: dict[str, ProviderHealth] = {}
+
+    def get(self, provider: Booru) -> ProviderHealth:
+        if provider.name not in self.providers:
+            self.providers[provider.name] = ProviderHealth(provider.name)
+        return self.providers[provider.name]
+
+    def reset(self) -> None:
+        self.providers.clear()
+
+    def is_available(self, provider: Booru) -> bool:
+        return self.get(provider).allow_request()
+
+    def test(self, provider: Booru) -> None:
+        """Runs the provider's availability test, failing it opens the circuit until a probe gets through"""
+
+        health = self.get(provider)
+        started = time.monotonic()
+
+        def on_tested(e_test: Expected) -> None:
+            # Statistics reset since, the result is about a route no longer used
+            if self.providers.get(provider.name) is not health: return
+            if e_test.is_failed(): health.record_unreachable()
+            elif e_test.is_finished(): health.record_success(time.monotonic() - started)
+
+        e_test = provider.test_availability()
+        e_test.add_done_callback(lambda e_test: GLib.idle_add(on_tested, e_test))
+
+    def get_mirrors(self, provider: Booru) -> list[str]:
+        return self.settings.get(f"providers/{provider.name}/mirrors", provider.mirrors)
+
+    def track(self, provider: Booru, run: Callable[[Booru, Callable[[Expected], Any]], Expected], callback: Callable[[Expected], Any]) -> Expected:
+        """
+        Runs a request against provider and records how it went.
+
+        With providers/hedge enabled, a request that takes longer than usual
+        is repeated against the provider's first mirror and whichever answers
+        first wins, the other one is cancelled.
+        """
+
+        health = self.get(provider)
+
+        attempts: list[Expected] = []
+        timer: Optional[int] = None
+
+        started = time.monotonic()
+
+        # Only a request that actually runs takes the probe, and gives it back when cancelled
+        probe = health.start_probe()
+
+        def stop() -> None:
+            nonlocal timer
+            if timer is not None: GLib.source_remove(timer)
+            timer = None
+            for attempt in attempts:
+                attempt.cancel()
+
+        def on_cancel() -> None:
+            stop()
+            if probe is not None: health.release_probe(probe)
+
+        e_result = Expected(on_cancel=on_cancel)
+
+        def on_attempt_done(e_attempt: Expected) -> None:
+
+            if not e_result.is_running(): return
+
+            if e_attempt.is_failed():
+                health.record_failure()
+                # Let a hedge that is still running have its say
+                if any(attempt.is_running() for attempt in attempts): return
+            else: health.record_success(time.monotonic() - started)
+
+            e_result.value = e_attempt.value
+            e_result.set_error(e_attempt.get_error())
+
+            if e_attempt.is_failed(): e_result.fail()
+            else: e_result.finish()
+
+            stop()
+            callback(e_result)
+
+        def launch_hedge(mirror: str) -> None:
+            nonlocal timer
+            timer = None
+            if not e_result.is_running(): return
+            logging.info(f"{provider.name} is slow, hedging with {mirror}")
+            attempts.append(run(provider.mirror(mirror), on_attempt_done))
+
+        attempts.append(run(provider, on_attempt_done))
+
+        mirrors = self.get_mirrors(provider)
+        delay = health.get_hedge_delay()
+
+        if self.settings.get("providers/hedge", False) and mirrors and delay is not None:
+            timer = GLib.timeout_add(int(delay * 1000), launch_hedge, mirrors[0])
+
+        return e_result
@@ -0,0 +1,497 @@
+# http_cache.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import asyncio, datetime, functools, logging, pickle, re, sqlite3, threading, time, weakref
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Optional
+
+import hishel, httpcore, httpx
+# Not exported by hishel, but the transports only accept their subclasses
+from hishel._async._storages import AsyncBaseStorage
+from hishel._serializers import Metadata
+from hishel._sync._storages import BaseStorage
+
+from weeb.backend.settings import Settings
+from weeb.backend.utils.paths import Paths
+from weeb.backend.utils.expected import Expected
+from weeb.backend.utils.threading import Job, Lane, WorkerPool, run_in_loop
+
+
+# Booru media is addressed by its md5, the same url never changes its content.
+# Samples prefix it, as in sample/ab/cd/sample-<md5>.jpg
+MEDIA_PATH = re.compile(r"[-_/][0-9a-f]{32}\.\w+$")
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# Request extensions of transfers that have to arrive chunk by chunk, API responses among them are still cached
+STREAMED = {"streamed": True}
+# Request extensions of transfers that must never touch the cache, like ranged downloads
+UNCACHED = {"cache_disabled": True}
+
+
+def get_route(url: httpx.URL) -> str:
+    """Either "media" for content addressed files or "api" for everything else"""
+    return "media" if MEDIA_PATH.search(url.path) else "api"
+
+
+def get_age(response: httpx.Response) -> float:
+
+    try: date = parsedate_to_datetime(response.headers["Date"]).timestamp()
+    except (KeyError, TypeError, ValueError): return float("inf")
+
+    return time.time() - date
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    HTTP cache in a single SQLite file, bounded by max_size bytes.
+
+    Least recently used responses are evicted first, hits and misses
+    are counted so the cache's usefulness can be checked with stats().
+
+    hishel stores every fresh hit again only to count its use. A response handed
+    back unchanged since retrieve() gets just its metadata updated, the body isn't rewritten.
+    """
+
+    def __init__(self, path: str, max_size: int) -> None:
+        super().__init__(serializer=hishel.PickleSerializer())
+
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL, metadata BLOB)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)")
+
+        # Caches created before metadata was kept apart
+        if "metadata" not in [row[1] for row in self.connection.execute("PRAGMA table_info(responses)")]:
+            self.connection.execute("ALTER TABLE responses ADD COLUMN metadata BLOB")
+
+        # What retrieve() handed out per key, to recognize it when it comes back unchanged
+        self.served: dict[str, tuple[weakref.ref, weakref.ref, int, list]] = {}
+
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            count = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return {"hits": self.hits, "misses": self.misses, "entries": count, "size": self.size}
+
+    def is_unchanged(self, key: str, response: Any, request: Any) -> bool:
+        """Whether response and request are the ones retrieve() returned for key, as they were then. Lock must be held"""
+
+        if (served := self.served.pop(key, None)) is None: return False
+
+        response_ref, request_ref, status, headers = served
+
+        # A 304 revalidation updates the headers of the same response object
+        return response_ref() is response and request_ref() is request and response.status == status and response.headers == headers
+
+    def store(self, key: str, response: Any, request: Any, metadata: Any) -> None:
+
+        with self.lock:
+            if self.is_unchanged(key, response, request):
+                with self.connection:
+                    cursor = self.connection.execute("UPDATE responses SET metadata = ?, accessed = ? WHERE key = ?", (pickle.dumps(metadata), time.time(), key))
+                # Evicted meanwhile, stored whole below
+                if cursor.rowcount: return
+
+        data = self._serializer.dumps(response=response, request=request, metadata=metadata)
+
+        with self.lock, self.connection:
+
+            if row := self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone():
+                self.size -= row[0]
+
+            self.connection.execute("INSERT OR REPLACE INTO responses (key, data, size, accessed) VALUES (?, ?, ?, ?)", (key, data, len(data), time.time()))
+            self.size += len(data)
+
+            if self.size > self.max_size: self.evict()
+
+    def retrieve(self, key: str) -> Optional[Any]:
+
+        with self.lock, self.connection:
+
+            row = self.connection.execute("SELECT data, metadata FROM responses WHERE key = ?", (key,)).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+
+        response, request, metadata = self._serializer.loads(row[0])
+        if row[1] is not None: metadata = pickle.loads(row[1])
+
+        with self.lock:
+            self.served[key] = (weakref.ref(response), weakref.ref(request), response.status, list(response.headers))
+
+        return response, request, metadata
+
+    def evict(self) -> None:
+        """Drops least recently used responses until 90% of the budget is left, lock must be held"""
+
+        target = self.max_size * 0.9
+        rows = self.connection.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+
+        evicted = []
+        for key, size in rows:
+            if self.size <= target: break
+            evicted.append((key,))
+            self.served.pop(key, None)
+            self.size -= size
+
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        logging.debug(f"Evicted {len(evicted)} responses from the HTTP cache")
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class AsyncSQLiteStorage(AsyncBaseStorage):
+    """SQLiteStorage for the async client, queries run on a thread to keep the loop free"""
+
+    def __init__(self, storage: SQLiteStorage) -> None:
+        super().__init__(serializer=storage._serializer)
+        self.storage = storage
+
+    def stats(self) -> dict[str, int]:
+        return self.storage.stats()
+
+    async def store(self, key: str, response: Any, request: Any, metadata: Any) -> None:
+        await asyncio.to_thread(self.storage.store, key, response, request, metadata)
+
+    async def retrieve(self, key: str) -> Optional[Any]:
+        return await asyncio.to_thread(self.storage.retrieve, key)
+
+    async def aclose(self) -> None:
+        pass
+
+
+class PolicyTransport(httpx.BaseTransport):
+    """
+    Rewrites caching headers of responses by route before the cache sees them.
+
+    Media never changes and is cached for good. API responses may be served
+    from the cache for "cache/http/api_ttl" plus "cache/http/stale_while_revalidate"
+    seconds, StaleWhileRevalidateTransport refreshes them after the first part.
+    """
+
+    settings = Settings()
+
+    def __init__(self, transport: httpx.BaseTransport) -> None:
+        self.transport = transport
+
+    def apply(self, request: httpx.Request, response: httpx.Response) -> None:
+
+        if response.status_code != 200 or "Range" in request.headers: return
+
+        if get_route(request.url) == "media":
+            response.headers["Cache-Control"] = IMMUTABLE
+        else:
+            max_age = self.settings.get("cache/http/api_ttl", 60) + self.settings.get("cache/http/stale_while_revalidate", 300)
+            response.headers["Cache-Control"] = f"max-age={max_age}"
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        response = self.transport.handle_request(request)
+        self.apply(request, response)
+        return response
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class AsyncPolicyTransport(httpx.AsyncBaseTransport):
+
+    apply = PolicyTransport.apply
+    settings = Settings()
+
+    def __init__(self, transport: httpx.AsyncBaseTransport) -> None:
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response = await self.transport.handle_async_request(request)
+        self.apply(request, response)
+        return response
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class StaleWhileRevalidateTransport(httpx.BaseTransport):
+    """
+    Sits above the cache and keeps API responses warm.
+
+    A response older than "cache/http/api_ttl" is still answered from the cache,
+    PolicyTransport allows that for "cache/http/stale_while_revalidate" more seconds,
+    but it is also revalidated in the background, so the next caller gets a fresh one.
+    """
+
+    settings = Settings()
+
+    def __init__(self, transport: httpx.BaseTransport) -> None:
+
+        self.transport = transport
+
+        self.lock = threading.Lock()
+        self.revalidating: set[str] = set()
+
+    def is_stale(self, request: httpx.Request, response: httpx.Response) -> bool:
+        if request.method != "GET" or get_route(request.url) != "api": return False
+        if not response.extensions.get("from_cache"): return False
+        return get_age(response) > self.settings.get("cache/http/api_ttl", 60)
+
+    def claim(self, request: httpx.Request) -> Optional[httpx.Request]:
+        """The background request for a url, None if one is already running"""
+
+        with self.lock:
+            if str(request.url) in self.revalidating: return None
+            self.revalidating.add(str(request.url))
+
+        headers = request.headers.copy()
+        headers["Cache-Control"] = "no-cache"
+
+        return httpx.Request(request.method, request.url, headers=headers)
+
+    def release(self, request: httpx.Request) -> None:
+        with self.lock:
+            self.revalidating.discard(str(request.url))
+
+    def revalidate(self, request: httpx.Request) -> None:
+
+        background = self.claim(request)
+        if background is None: return
+
+        def helper() -> None:
+            try: self.transport.handle_request(background).close()
+            finally: self.release(request)
+
+        WorkerPool().submit(Job(helper, Expected()), Lane.PREFETCH)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+
+        response = self.transport.handle_request(request)
+        if self.is_stale(request, response): self.revalidate(request)
+
+        return response
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class AsyncStaleWhileRevalidateTransport(httpx.AsyncBaseTransport):
+
+    is_stale = StaleWhileRevalidateTransport.is_stale
+    claim = StaleWhileRevalidateTransport.claim
+    release = StaleWhileRevalidateTransport.release
+
+    settings = Settings()
+
+    def __init__(self, transport: httpx.AsyncBaseTransport) -> None:
+
+        self.transport = transport
+
+        self.lock = threading.Lock()
+        self.revalidating: set[str] = set()
+
+    def revalidate(self, request: httpx.Request) -> None:
+
+        background = self.claim(request)
+        if background is None: return
+
+        async def helper() -> None:
+            try: await (await self.transport.handle_async_request(background)).aclose()
+            finally: self.release(request)
+
+        run_in_loop(helper)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+
+        response = await self.transport.handle_async_request(request)
+        if self.is_stale(request, response): self.revalidate(request)
+
+        return response
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+def make_cache_entry(controller: hishel.Controller, request: httpx.Request, response: httpx.Response, body: bytes) -> Optional[tuple[str, httpcore.Response, httpcore.Request, Metadata]]:
+    """What hishel would have stored for a response read whole, None if it may not be cached"""
+
+    url = httpcore.URL(scheme=request.url.raw_scheme, host=request.url.raw_host, port=request.url.port, target=request.url.raw_path)
+    httpcore_request = httpcore.Request(request.method, url, headers=request.headers.raw, extensions=request.extensions)
+
+    httpcore_response = httpcore.Response(response.status_code, headers=response.headers.raw, content=body, extensions=response.extensions)
+    httpcore_response.read()
+
+    if not controller.is_cachable(request=httpcore_request, response=httpcore_response): return None
+
+    key = controller._key_generator(httpcore_request, b"")
+    metadata = Metadata(cache_key=key, created_at=datetime.datetime.now(datetime.timezone.utc), number_of_uses=0)
+
+    return key, httpcore_response, httpcore_request, metadata
+
+def get_cache_request(request: httpx.Request) -> httpx.Request:
+    """Same request, answered only if the cache has a usable response"""
+
+    headers = request.headers.copy()
+    headers["Cache-Control"] = "only-if-cached"
+
+    return httpx.Request(request.method, request.url, headers=headers, extensions=request.extensions)
+
+def is_cache_miss(response: httpx.Response) -> bool:
+    # hishel answers only-if-cached requests it can't serve with a bare 504
+    return response.status_code == 504 and not response.extensions.get("from_cache")
+
+
+class TeeStream(httpx.SyncByteStream):
+    """Hands the body out as it arrives and passes the whole of it to on_complete, unless it was closed early"""
+
+    def __init__(self, stream: httpx.SyncByteStream, on_complete: Callable[[bytes], Any]) -> None:
+        self.stream = stream
+        self.on_complete = on_complete
+
+    def __iter__(self) -> Iterator[bytes]:
+
+        chunks = []
+
+        for chunk in self.stream:
+            chunks.append(chunk)
+            yield chunk
+
+        try: self.on_complete(b"".join(chunks))
+        except Exception as e: logging.error(f"Failed to cache a streamed response: {e}")
+
+    def close(self) -> None:
+        self.stream.close()
+
+
+class AsyncTeeStream(httpx.AsyncByteStream):
+
+    def __init__(self, stream: httpx.AsyncByteStream, on_complete: Callable[[bytes], Awaitable]) -> None:
+        self.stream = stream
+        self.on_complete = on_complete
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+
+        chunks = []
+
+        async for chunk in self.stream:
+            chunks.append(chunk)
+            yield chunk
+
+        try: await self.on_complete(b"".join(chunks))
+        except Exception as e: logging.error(f"Failed to cache a streamed response: {e}")
+
+    async def aclose(self) -> None:
+        await self.stream.aclose()
+
+
+class StreamingTransport(httpx.BaseTransport):
+    """
+    hishel reads a response whole before handing it out, which defeats streaming and cancellation.
+
+    Requests with the STREAMED extensions are answered by the cache only if it already
+    holds a usable response, otherwise the body comes from the network chunk by chunk,
+    so closing it stops the transfer, and is stored once it arrived whole. The route
+    policies apply as usual. UNCACHED requests go straight to the network.
+
+    Streamed media is never stored, StreamImage keeps those bytes in the texture DiskCache
+    and a second copy here would only double the disk use.
+    """
+
+    def __init__(self, cached: httpx.BaseTransport, network: httpx.BaseTransport, storage: BaseStorage, controller: hishel.Controller) -> None:
+        self.cached = cached
+        self.network = network
+        self.storage = storage
+        self.controller = controller
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+
+        if request.extensions.get("cache_disabled"): return self.network.handle_request(request)
+        if not request.extensions.get("streamed") or request.method != "GET": return self.cached.handle_request(request)
+
+        response = self.cached.handle_request(get_cache_request(request))
+        if not is_cache_miss(response): return response
+        response.close()
+
+        response = self.network.handle_request(request)
+        response.extensions["from_cache"] = False
+
+        if get_route(request.url) == "media": return response
+
+        def store(body: bytes) -> None:
+            if entry := make_cache_entry(self.controller, request, response, body):
+                key, httpcore_response, httpcore_request, metadata = entry
+                self.storage.store(key, response=httpcore_response, request=httpcore_request, metadata=metadata)
+
+        response.stream = TeeStream(response.stream, store)
+
+        return response
+
+    def close(self) -> None:
+        self.cached.close()
+
+
+class AsyncStreamingTransport(httpx.AsyncBaseTransport):
+
+    def __init__(self, cached: httpx.AsyncBaseTransport, network: httpx.AsyncBaseTransport, storage: AsyncBaseStorage, controller: hishel.Controller) -> None:
+        self.cached = cached
+        self.network = network
+        self.storage = storage
+        self.controller = controller
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+
+        if request.extensions.get("cache_disabled"): return await self.network.handle_async_request(request)
+        if not request.extensions.get("streamed") or request.method != "GET": return await self.cached.handle_async_request(request)
+
+        response = await self.cached.handle_async_request(get_cache_request(request))
+        if not is_cache_miss(response): return response
+        await response.aclose()
+
+        response = await self.network.handle_async_request(request)
+        response.extensions["from_cache"] = False
+
+        if get_route(request.url) == "media": return response
+
+        async def store(body: bytes) -> None:
+            if entry := make_cache_entry(self.controller, request, response, body):
+                key, httpcore_response, httpcore_request, metadata = entry
+                await self.storage.store(key, response=httpcore_response, request=httpcore_request, metadata=metadata)
+
+        response.stream = AsyncTeeStream(response.stream, store)
+
+        return response
+
+    async def aclose(self) -> None:
+        await self.cached.aclose()
+
+
+@functools.cache
+def get_storage() -> SQLiteStorage:
+    """The storage shared by both clients and kept across proxy changes"""
+    path = Paths.get("cache/http.sqlite3", parents=True)
+    return SQLiteStorage(path.as_posix(), Settings().get("cache/http/max_size", 256 * 1024 * 1024))
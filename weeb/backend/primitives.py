@@ -17,46 +17,157 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import array, copy, re, sys
 from abc import ABC
-from dataclasses import dataclass
-from typing import Callable, Optional
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
 
 from weeb.backend.downloader import Downloader
 from weeb.backend.settings import Settings
 from weeb.backend.utils.expected import Expected
 
 
-@dataclass(init=True)
+@dataclass(init=True, frozen=True, slots=True)
 class Variant:
 
     width: int
     height: int
     url: str
 
-@dataclass(init=True)
+
+HASH, SHARD = "{hash}", "{shard}"
+
+# Interned tuples of URL templates, shared by every asset with the same layout
+_templates: dict[tuple[str, ...], tuple[str, ...]] = {}
+
+def get_shard(hash: str) -> str:
+    return f"{hash[0:2]}/{hash[2:4]}/"
+
+def make_template(url: str, hash: Optional[str]) -> str:
+    """Replaces the parts of url derived from hash with placeholders"""
+
+    if hash:
+        # The shard directory may be followed by a prefix first, as in ".../sample/ab/cd/sample-abcd...jpg"
+        url = re.sub(re.escape(get_shard(hash)) + r"([^/]*)" + hash, lambda match: SHARD + match[1] + HASH, url)
+        url = url.replace(hash, HASH)
+
+    return sys.intern(url)
+
+@dataclass(init=False, eq=False, frozen=True, slots=True)
 class Asset:
+    """
+    Compact record of one post.
 
-    def __hash__(self) -> int:
-        return hash(self.id) + hash(self.hash)
+    Variant sizes are packed into a single array and URLs are kept as
+    shared templates with the md5 left out, Variant objects are built on access.
+    Assets are identified by provider and id only, the same image found on
+    other providers is kept in mirrors.
+    """
 
+    provider: str
     id: int
-    hash: str 
+    hash: Optional[str]
+
+    sizes: array.array
+    templates: tuple[str, ...]
+    sample_index: int
+
+    mirrors: tuple["Asset", ...]
+
+    def __init__(self, provider: str, id: int, hash: Optional[str], variants: list[Variant], sample: Optional[Variant] = None) -> None:
+
+        sizes = array.array("I")
+        for variant in variants:
+            sizes.append(variant.width or 0)
+            sizes.append(variant.height or 0)
+
+        templates = tuple(make_template(variant.url, hash) for variant in variants)
+        templates = _templates.setdefault(templates, templates)
+
+        set_field = object.__setattr__
+
+        set_field(self, "provider", sys.intern(provider))
+        set_field(self, "id", id)
+        set_field(self, "hash", hash)
+        set_field(self, "sizes", sizes)
+        set_field(self, "templates", templates)
+        set_field(self, "sample_index", variants.index(sample) if sample is not None else -1)
+        set_field(self, "mirrors", ())
+
+    def __hash__(self) -> int:
+        return hash((self.provider, self.id))
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Asset): return NotImplemented
+        return self.id == other.id and self.provider == other.provider
+
+    def replace(self, **changes) -> "Asset":
+
+        asset = object.__new__(Asset)
+
+        for name in Asset.__slots__:
+            object.__setattr__(asset, name, changes.get(name, getattr(self, name)))
+
+        return asset
+
+    def with_mirror(self, mirror: "Asset") -> "Asset":
+        """Returns a copy of this asset that also keeps mirror and its own mirrors"""
+        return self.replace(mirrors=(*self.mirrors, mirror.replace(mirrors=()), *mirror.mirrors))
+
+    @property
+    def providers(self) -> list[str]:
+        return [self.provider] + [mirror.provider for mirror in self.mirrors]
+
+    def get_url(self, index: int) -> str:
+
+        url = self.templates[index]
+        if self.hash: url = url.replace(SHARD, get_shard(self.hash)).replace(HASH, self.hash)
+
+        return url
+
+    def get_variant(self, index: int) -> Variant:
+        index %= len(self.templates)
+        return Variant(self.sizes[index * 2], self.sizes[index * 2 + 1], self.get_url(index))
+
+    @property
+    def variants(self) -> list[Variant]:
+        return [self.get_variant(index) for index in range(len(self.templates))]
+
+    @property
+    def preview(self) -> Variant:
+        return self.get_variant(0)
+
+    @property
+    def sample(self) -> Optional[Variant]:
+        if self.sample_index < 0: return None
+        return self.get_variant(self.sample_index)
+
+    @property
+    def original(self) -> Variant:
+        return self.get_variant(-1)
 
-    variants: list[Variant]
+@dataclass(init=True)
+class Tag:
+
+    name: str
+    count: int
 
-    preview: Variant
-    sample: Optional[Variant]
-    original: Variant
+    aliases: list[str] = field(default_factory=list)
 
 
 class Booru(ABC):
 
-    def __init__(self, name: str, base_url: str) -> None:
+    # Most tags one search_tags_async() answers with, fewer means every match was returned
+    tag_limit = 1000
+
+    def __init__(self, name: str, base_url: str, mirrors: Optional[list[str]] = None) -> None:
 
         self.__name = name
         self.__is_alive: bool = None
 
         self.base_url = base_url
+        # Base URLs serving the same data, used to hedge slow requests
+        self.mirrors = mirrors or []
 
         self.downloader = Downloader()
         self.settings = Settings()
@@ -75,11 +186,39 @@ class Booru(ABC):
     def is_alive(self, value: bool) -> None:
         self.__is_alive = value
 
+    def mirror(self, base_url: str) -> "Booru":
+        """Returns a copy of this provider talking to base_url instead"""
+
+        provider = copy.copy(self)
+        provider.base_url = base_url
+
+        return provider
+
+    def handle_failure(self, e_response: Expected, e_result: Expected, callback: Callable) -> bool:
+        """Fails e_result and hands it to the callback if the request behind it did not succeed"""
+
+        response = e_response.value
+        if not e_response.is_failed() and response.status_code == 200:
+            return False
+
+        error = e_response.get_error()
+        if error is None: error = RuntimeError(f"{self.name} responded with {response.status_code}: {response.text}")
+
+        e_result.set_error(error)
+        e_result.fail()
+        callback(e_result)
+
+        return True
+
     def test_availability(self) -> Expected:
         raise NotImplementedError("Derived classes must implement this method")
 
-    def search_assets_async(self, tags: list, callback: Callable) -> Expected[set[Asset]]:
+    def search_assets_async(self, tags: list, callback: Callable, page: Optional[str] = None, limit: int = 30, on_batch: Optional[Callable[[set[Asset]], Any]] = None) -> Expected[set[Asset]]:
+        raise NotImplementedError("Derived classes must implement this method")
+
+    def get_next_page(self, assets: set[Asset]) -> Optional[str]:
+        """Returns the page following the one that yielded assets, None if there are no more"""
         raise NotImplementedError("Derived classes must implement this method")
 
-    def search_tags_async(self, query: str, callback: Callable) -> Expected[set[str]]:
+    def search_tags_async(self, query: str, callback: Callable) -> Expected[list[Tag]]:
         raise NotImplementedError("Derived classes must implement this method")
\ No newline at end of file
@@ -18,13 +18,16 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import logging
-from typing import Callable
+from typing import Any, Callable, Optional
 
+from gi.repository import GLib
 from httpx import Response
 
 from weeb.backend.constants import debug
-from weeb.backend.primitives import Asset, Booru, Variant
+from weeb.backend.primitives import Asset, Booru, Tag, Variant
 from weeb.backend.utils.expected import Expected
+from weeb.backend.utils.json_stream import JSONArrayStream, get_loads
+from weeb.backend.utils.threading import Job, Lane, WorkerPool
 
 
 class DanBooru(Booru):
@@ -33,6 +36,9 @@ class DanBooru(Booru):
         base_url = "https://testbooru.donmai.us" if debug else "https://danbooru.donmai.us"
         super().__init__(name="DanBooru", base_url=base_url)
 
+        # Self-hosted instances, or a local stand-in when benchmarking
+        self.base_url = self.settings.get(f"providers/{self.name}/base_url", self.base_url)
+
         self.params = dict()
 
         if auth := self.settings.get(f"providers/{self.name}/auth"):
@@ -41,6 +47,11 @@ class DanBooru(Booru):
                 self.params["login"] = login
                 self.params["api_key"] = api_key
 
+    @property
+    def loads(self) -> Callable[[bytes], Any]:
+        # Whole responses are where orjson pays off, streamed pages are split by json's own C scanner
+        return get_loads(self.settings.get("providers/fast_json", True))
+
     def test_availability(self) -> Expected:
 
         params = { "limit": 1 }
@@ -58,6 +69,8 @@ class DanBooru(Booru):
     def parse_post(self, post: dict) -> Asset | None:
 
         media_asset = post.get("media_asset")
+        if media_asset is None: return None
+
         variants: list[Variant] = []
 
         sample: Variant = None
@@ -75,62 +88,112 @@ class DanBooru(Booru):
         if not variants: return None
 
         asset = Asset(
-            id=media_asset.get("id"),
+            provider=self.name,
+            id=post.get("id"),
             hash=media_asset.get("md5"),
             variants=variants,
-            preview=variants[0],
-            sample=sample,
-            original=variants[-1]
+            sample=sample
         )
 
         return asset
             
-    def search_assets_async(self, tags: list, callback: Callable) -> Expected[set[Asset]]:
+    def get_next_page(self, assets: set[Asset]) -> Optional[str]:
+        """Danbooru pages by post id, "b<id>" yields the posts right below it"""
+
+        if not assets: return None
+        return f"b{min(asset.id for asset in assets)}"
+
+    def search_assets_async(self, tags: list, callback: Callable, page: Optional[str] = None, limit: int = 30, on_batch: Optional[Callable[[set[Asset]], Any]] = None) -> Expected[set[Asset]]:
+
+        params = {
+            "tags": " ".join(tags),
+            "limit": limit
+        }
+
+        if page is not None: params["page"] = page
+
+        url = self.base_url + "/posts.json"
+
+        if on_batch is not None and self.settings.get("providers/streaming", True):
+            return self.stream_assets_async(url, self.params|params, callback, on_batch)
 
         e_assets = Expected(set())
 
         def helper(e_response: Expected[Response]) -> None:
 
-            response = e_response.value
+            if self.handle_failure(e_response, e_assets, callback): return
 
-            if response.status_code != 200:
-                e_assets.error(response.text)
-                return
-
-            for post in response.json():
+            for post in self.loads(e_response.value.content):
                 asset = self.parse_post(post)
                 if asset is None: continue
                 e_assets.value.add(asset)
 
             e_assets.finish()
             callback(e_assets)
-            
-        
-        params = {
-            "tags": " ".join(tags),
-            "limit": 30
-        }
 
-        url = self.base_url + "/posts.json"
+        e_response = self.downloader.get_async(url, helper, params=self.params|params)
+        e_assets.set_on_cancel(e_response.cancel)
 
-        self.downloader.get_async(url, helper, params=self.params|params)
+        return e_assets
+
+    def stream_assets_async(self, url: str, params: dict, callback: Callable, on_batch: Callable[[set[Asset]], Any]) -> Expected[set[Asset]]:
+        """Parses posts while the response is still arriving and hands them over in small batches"""
+
+        e_assets: Expected[set[Asset]] = Expected(set())
+
+        batch_size = self.settings.get("providers/batch_size", 10)
+
+        def helper() -> set[Asset]:
+
+            assets: set[Asset] = set()
+            batch: set[Asset] = set()
+
+            parser = JSONArrayStream()
+
+            with self.downloader.stream(url, params=params) as response:
+
+                if response.status_code != 200:
+                    response.read()
+                    raise RuntimeError(f"{self.name} responded with {response.status_code}: {response.text}")
+
+                remove = e_assets.token.add_callback(response.close)
+
+                try:
+                    for chunk in response.iter_bytes():
+                        if e_assets.is_cancelled(): break
+
+                        for post in parser.feed(chunk):
+                            asset = self.parse_post(post)
+                            if asset is not None: batch.add(asset)
+
+                        if len(batch) >= batch_size:
+                            GLib.idle_add(on_batch, batch)
+                            assets |= batch
+                            batch = set()
+                finally: remove()
+
+                # A page that was cut short or is malformed fails instead of passing for a short one
+                if not e_assets.is_cancelled(): parser.close()
+
+            if batch and not e_assets.is_cancelled(): GLib.idle_add(on_batch, batch)
+
+            return assets | batch
+
+        WorkerPool().submit(Job(helper, e_assets, callback), Lane.INTERACTIVE)
 
         return e_assets
 
-    def search_tags_async(self, query: str, callback: Callable) -> Expected[set[str]]:
+    def search_tags_async(self, query: str, callback: Callable) -> Expected[list[Tag]]:
 
-        e_tags = Expected(set())
+        e_tags = Expected(list())
 
         def helper(e_response: Expected[Response]) -> None:
 
-            response = e_response.value
-
-            if response.status_code != 200:
-                e_tags.error(response.text)
-                return
+            if self.handle_failure(e_response, e_tags, callback): return
 
-            for tag in response.json():
-                e_tags.value.add(tag["name"])
+            for tag in self.loads(e_response.value.content):
+                aliases = [alias["antecedent_name"] for alias in tag.get("consequent_aliases", [])]
+                e_tags.value.append(Tag(name=tag["name"], count=tag["post_count"], aliases=aliases))
 
             e_tags.finish()
             callback(e_tags)
@@ -140,11 +203,13 @@ class DanBooru(Booru):
             "search[name_or_alias_matches]": query + "*",
             "search[order]": "count",
             "search[hide_empty]": True,
-            "limit": 1000
+            "only": "name,post_count,consequent_aliases[antecedent_name]",
+            "limit": self.tag_limit
         }
 
         url = self.base_url + "/tags.json"
 
-        self.downloader.get_async(url, helper, params=self.params|params)
+        e_response = self.downloader.get_async(url, helper, params=self.params|params)
+        e_tags.set_on_cancel(e_response.cancel)
 
         return e_tags
\ No newline at end of file
@@ -17,13 +17,163 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from typing import Any, Callable
+import enum, logging
+from typing import Any, Callable, Optional
 
-from weeb.backend.primitives import Asset, Booru
+from gi.repository import GLib
+
+from weeb.backend.dedup import Deduplicator
+from weeb.backend.health import HealthMonitor
+from weeb.backend.primitives import Asset, Booru, Tag
 from weeb.backend.providers.danbooru import DanBooru
+from weeb.backend.query_coordinator import QueryCoordinator
+from weeb.backend.schema import DedupSettings
 from weeb.backend.settings import Settings
+from weeb.backend.tag_index import TagIndex
 from weeb.backend.utils.expected import Expected
 from weeb.backend.utils.singleton import Singleton
+from weeb.backend.utils.threading import Lane, run_in_thread
+
+
+class ProviderStatus(enum.Enum):
+    FINISHED = "finished"
+    FAILED = "failed"
+    TIMED_OUT = "timed_out"
+
+
+class Search:
+    """
+    Paged asset search over every provider, each one keeps its own cursor.
+
+    Every provider's batch is handed over as soon as it arrives, a provider
+    that misses its deadline is cancelled, and statuses holds how each
+    provider did on the last page.
+    """
+
+    settings = Settings()
+
+    def __init__(self, providers: list[Booru], tags: list[str], coordinator: QueryCoordinator, health: HealthMonitor) -> None:
+
+        self.tags = tags
+        self.coordinator = coordinator
+        self.health = health
+        self.pages: dict[Booru, Optional[str]] = {provider: None for provider in providers}
+
+        self.exhausted: set[Booru] = set()
+        self.statuses: dict[str, ProviderStatus] = {}
+
+        self.deduplicator = Deduplicator(DedupSettings().perceptual_distance)
+
+    def is_exhausted(self) -> bool:
+        return len(self.exhausted) == len(self.pages)
+
+    def get_deadline(self, provider: Booru) -> float:
+        default = self.settings.get("providers/deadline", 10.0)
+        default = self.settings.get(f"providers/{provider.name}/deadline", default)
+        return self.health.get(provider).get_timeout(default)
+
+    def next_page_async(self, callback: Callable[[Expected[set[Asset]]], Any], on_batch: Optional[Callable[[Booru, set[Asset]], Any]] = None) -> Expected[set[Asset]]:
+
+        tasks: dict[Booru, Expected] = {}
+        timers: dict[Booru, int] = {}
+
+        limit = self.settings.get("providers/page_size", 30)
+        self.statuses = {}
+
+        def remove_timers() -> None:
+            for timer in timers.values():
+                GLib.source_remove(timer)
+            timers.clear()
+
+        e_assets: Expected[set[Asset]] = Expected(set(), remove_timers)
+
+        def finish() -> None:
+            remove_timers()
+            e_assets.finish()
+            callback(e_assets)
+
+        def settle(provider: Booru, status: ProviderStatus) -> None:
+
+            if provider in timers:
+                GLib.source_remove(timers.pop(provider))
+
+            self.statuses[provider.name] = status
+
+            if status != ProviderStatus.FINISHED:
+                logging.warning(f"{provider.name} {status.value}: {tasks[provider].get_error()}")
+
+            if len(self.statuses) == len(tasks) and e_assets.is_running():
+                finish()
+
+        def get_batch_handler(provider: Booru, emitted: set[Asset]) -> Callable[[set[Asset]], None]:
+
+            def on_provider_batch(batch: set[Asset]) -> None:
+
+                emitted.update(batch)
+                fresh, merged = self.deduplicator.add(batch)
+
+                # Merged assets compare equal to the copies they replace
+                e_assets.value.difference_update(merged)
+                e_assets.value.update(merged, fresh)
+
+                if on_batch is not None and fresh: on_batch(provider, set(fresh))
+
+            return on_provider_batch
+
+        def get_helper(provider: Booru, emitted: set[Asset]) -> Callable[[Expected[set[Asset]]], None]:
+
+            def helper(_e_assets: Expected[set[Asset]]) -> None:
+
+                if _e_assets.is_failed():
+                    settle(provider, ProviderStatus.FAILED)
+                    return
+
+                page = provider.get_next_page(_e_assets.value)
+                self.pages[provider] = page
+                if page is None: self.exhausted.add(provider)
+
+                # Whatever was not streamed in batches goes out now
+                if rest := _e_assets.value - emitted:
+                    get_batch_handler(provider, emitted)(rest)
+
+                settle(provider, ProviderStatus.FINISHED)
+
+            return helper
+
+        def get_deadline_handler(provider: Booru) -> Callable[[], None]:
+
+            def on_deadline() -> None:
+                timers.pop(provider, None)
+                tasks[provider].cancel()
+                self.health.get(provider).record_failure()
+                settle(provider, ProviderStatus.TIMED_OUT)
+
+            return on_deadline
+
+        for provider, page in self.pages.items():
+            if provider in self.exhausted: continue
+            if not self.health.is_available(provider): continue
+            if e_assets.is_cancelled(): break
+            emitted: set[Asset] = set()
+            tasks[provider] = self.request_page(provider, page, limit, get_helper(provider, emitted), get_batch_handler(provider, emitted))
+            e_assets.token.add_callback(tasks[provider].cancel)
+            timers[provider] = GLib.timeout_add(int(self.get_deadline(provider) * 1000), get_deadline_handler(provider))
+
+        if not tasks: GLib.idle_add(finish)
+
+        return e_assets
+
+    def request_page(self, provider: Booru, page: Optional[str], limit: int, callback: Callable[[Expected[set[Asset]]], Any], on_batch: Optional[Callable[[set[Asset]], Any]] = None) -> Expected[set[Asset]]:
+
+        key = ("assets", provider.name, tuple(self.tags), page, limit)
+
+        def run(target: Booru, on_done: Callable, on_batch: Callable) -> Expected[set[Asset]]:
+            return target.search_assets_async(self.tags, on_done, page, limit, on_batch)
+
+        def start(on_done: Callable, on_batch: Callable) -> Expected[set[Asset]]:
+            return self.health.track(provider, lambda target, on_attempt_done: run(target, on_attempt_done, on_batch), on_done)
+
+        return self.coordinator.request(key, start, callback, on_batch=on_batch)
 
 
 class ProvidersManager(metaclass=Singleton):
@@ -31,59 +181,118 @@ class ProvidersManager(metaclass=Singleton):
     def __init__(self) -> None:
         
         self.settings = Settings()
-        self.settings.connect("proxy/uri", lambda *args: self.test_stability())
+        self.settings.connect("proxy/uri", self.on_proxy_changed)
 
         self.providers: list[Booru] = [DanBooru()]
+        self.tag_index = TagIndex()
+        self.coordinator = QueryCoordinator()
+        self.health = HealthMonitor()
+
+        self.test_stability()
+
+    def on_proxy_changed(self, *args) -> None:
+        # Statistics gathered through another route say nothing about this one
+        self.health.reset()
         self.test_stability()
 
     def test_stability(self) -> None:
         for provider in self.providers:
-            provider.test_availability()
+            self.health.test(provider)
 
-    def search_assets_async(self, tags: list[str], callback: Callable[[Expected[set[Asset]]], Any]) -> Expected[set[Asset]]:
+    def create_search(self, tags: list[str]) -> Search:
+        return Search(self.providers, tags, self.coordinator, self.health)
 
-        tasks: list[Expected] = []
+    def search_assets_async(self, tags: list[str], callback: Callable[[Expected[set[Asset]]], Any], on_batch: Optional[Callable[[Booru, set[Asset]], Any]] = None) -> Expected[set[Asset]]:
+        return self.create_search(tags).next_page_async(callback, on_batch)
 
-        def on_cancel() -> None:
-            for task in tasks:
-                task.cancel()
+    def search_tags_async(self, query: str, callback: Callable[[Expected[list[Tag]]], Any], channel: Optional[str] = None) -> Expected[list[Tag]]:
+        """
+        Answers from the local tag index, results are ranked by post count.
 
-        e_assets: Expected[set[Asset]] = Expected(set(), on_cancel)
+        Stale queries are refreshed from the providers in the background,
+        the callback waits for them only if the index has nothing yet.
+        Queries sharing a channel, like the ones typed into one entry, are
+        debounced and every new one cancels the previous.
+        """
 
-        def helper(_e_assets: Expected[set[Asset]]) -> None:
-            e_assets.value |= _e_assets.value
+        delay = self.settings.get("tags/debounce", 150) if channel else 0
 
-            if all(task.is_finished() for task in tasks):
-                e_assets.finish()
-                callback(e_assets)
+        def start(on_done: Callable, on_batch: Callable) -> Expected[list[Tag]]:
+            return self.lookup_tags_async(query, on_done)
 
-        for provider in self.providers:
-            if not provider.is_alive: continue
-            if e_assets.is_cancelled(): break
-            tasks.append(provider.search_assets_async(tags, helper))
+        return self.coordinator.request(("tags", query), start, callback, channel, delay)
 
-        return e_assets
+    def lookup_tags_async(self, query: str, callback: Callable[[Expected[list[Tag]]], Any]) -> Expected[list[Tag]]:
 
-    def search_tags_async(self, query: str, callback: Callable[[Expected[set[str]]], Any]) -> Expected[set[str]]:
+        limit = self.settings.get("tags/limit", 20)
+        max_age = self.settings.get("tags/refresh_interval", 3600)
 
-        tasks: list[Expected] = []
+        e_tags: Expected[list[Tag]] = Expected(list(self.tag_index.search(query, limit)))
+
+        def answer() -> None:
+            if e_tags.is_cancelled(): return
+            e_tags.value = list(self.tag_index.search(query, limit))
+            e_tags.finish()
+            callback(e_tags)
+
+        if not self.tag_index.is_stale(query, max_age):
+            GLib.idle_add(answer)
+            return e_tags
+
+        def on_refreshed(*args) -> None:
+            if not e_tags.is_finished(): answer()
+
+        e_refresh = self.refresh_tags_async(query, on_refreshed)
+        e_tags.token.add_callback(e_refresh.cancel)
+
+        if e_tags.value: GLib.idle_add(answer)
 
-        def on_cancel() -> None:
-            for task in tasks:
-                task.cancel()
+        return e_tags
 
-        e_tags: Expected[set[str]] = Expected(set(), on_cancel)
+    def refresh_tags_async(self, query: str, callback: Callable[[Expected[list[Tag]]], Any]) -> Expected[list[Tag]]:
 
-        def helper(_e_tags: Expected[set[str]]) -> None:
-            e_tags.value |= _e_tags.value
+        providers: list[Booru] = []
+        tasks: list[Expected] = []
 
-            if all(task.is_finished() for task in tasks):
-                e_tags.finish()
-                callback(e_tags)
+        e_tags: Expected[list[Tag]] = Expected(list())
 
         for provider in self.providers:
-            if not provider.is_alive: continue
-            if e_tags.is_cancelled(): break
-            tasks.append(provider.search_tags_async(query, helper))
+            if not self.health.is_available(provider): continue
+            key = ("tags", provider.name, query)
+            start = lambda on_done, on_batch, provider=provider: self.health.track(provider, lambda target, on_attempt_done: target.search_tags_async(query, on_attempt_done), on_done)
+            providers.append(provider)
+            tasks.append(self.coordinator.request(key, start, lambda *args: None))
+
+        def on_gathered(e_all: Expected[list]) -> None:
+
+            if e_tags.is_cancelled(): return
+
+            # Only if every provider answered with all it has, longer queries can skip the network
+            complete = len(providers) == len(self.providers)
+
+            for provider, tags in zip(providers, e_all.value):
+                if tags is None or len(tags) >= provider.tag_limit: complete = False
+                if tags: e_tags.value += tags
+
+            self.tag_index.update(e_tags.value)
+            self.tag_index.mark_refreshed(query, complete)
+            run_in_thread(self.tag_index.save, lane=Lane.PREFETCH)
+            e_tags.finish()
+            callback(e_tags)
+
+        def on_unavailable() -> None:
+            if e_tags.is_cancelled(): return
+            e_tags.finish()
+            callback(e_tags)
+
+        # With every provider down there's nothing to wait for, the callback still gets its empty answer
+        if not tasks:
+            GLib.idle_add(on_unavailable)
+            return e_tags
+
+        # Providers that fail only leave their share out, the rest still gets indexed
+        e_all = Expected.gather(tasks, tolerate_failures=True)
+        e_tags.token.add_callback(e_all.cancel)
+        e_all.add_done_callback(on_gathered)
 
-        return e_tags
\ No newline at end of file
+        return e_tags
@@ -0,0 +1,126 @@
+# query_coordinator.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from typing import Any, Callable, Hashable, Optional
+
+from gi.repository import GLib
+
+from weeb.backend.utils.expected import Expected
+
+
+class Flight:
+    """One network request shared by every subscriber asking for the same thing"""
+
+    def __init__(self) -> None:
+        self.task: Optional[Expected] = None
+        self.subscribers: list[tuple[Expected, Callable, Optional[Callable]]] = []
+
+
+class QueryCoordinator:
+    """
+    Joins identical in-flight queries and debounces query channels.
+
+    Every request() returns its own Expected, identical keys share one
+    underlying task which is cancelled once nobody is waiting for it anymore.
+    A new request on a channel supersedes and cancels the previous one,
+    with a delay it also waits for the input to settle before starting.
+
+    start() gets the completion and the partial batch handlers of the task,
+    batches are forwarded to every subscriber that wants them, subscribers
+    joining a running task only see the batches that arrive after them.
+    """
+
+    def __init__(self) -> None:
+
+        self.flights: dict[Hashable, Flight] = {}
+
+        self.channels: dict[str, Expected] = {}
+        self.timers: dict[str, int] = {}
+
+    def request(self, key: Hashable, start: Callable[[Callable[[Expected], Any], Callable[[Any], Any]], Expected], callback: Callable[[Expected], Any], channel: Optional[str] = None, delay: int = 0, on_batch: Optional[Callable[[Any], Any]] = None) -> Expected:
+
+        e_result = Expected()
+        e_result.set_on_cancel(lambda: self.unsubscribe(key, e_result))
+
+        if channel is not None:
+
+            if (previous := self.channels.get(channel)) and previous.is_running():
+                previous.cancel()
+
+            if (timer := self.timers.pop(channel, None)) is not None:
+                GLib.source_remove(timer)
+
+            self.channels[channel] = e_result
+
+        def subscribe() -> None:
+
+            if channel is not None:
+                self.timers.pop(channel, None)
+
+            if e_result.is_cancelled(): return
+
+            flight = self.flights.get(key)
+            is_new = flight is None
+
+            if is_new: flight = self.flights[key] = Flight()
+            flight.subscribers.append((e_result, callback, on_batch))
+
+            if is_new: flight.task = start(lambda e_task: self.land(key, e_task), lambda batch: self.forward(key, batch))
+
+        if channel is not None and delay > 0:
+            self.timers[channel] = GLib.timeout_add(delay, subscribe)
+        else: subscribe()
+
+        return e_result
+
+    def forward(self, key: Hashable, batch: Any) -> None:
+
+        flight = self.flights.get(key)
+        if flight is None: return
+
+        for e_result, _, on_batch in flight.subscribers:
+            if on_batch is not None and e_result.is_running():
+                on_batch(batch)
+
+    def land(self, key: Hashable, e_task: Expected) -> None:
+
+        flight = self.flights.pop(key, None)
+        if flight is None: return
+
+        for e_result, callback, _ in flight.subscribers:
+            if e_result.is_cancelled(): continue
+
+            e_result.value = e_task.value
+            e_result.set_error(e_task.get_error())
+
+            if e_task.is_failed(): e_result.fail()
+            else: e_result.finish()
+
+            callback(e_result)
+
+    def unsubscribe(self, key: Hashable, e_result: Expected) -> None:
+
+        flight = self.flights.get(key)
+        if flight is None: return
+
+        flight.subscribers = [subscriber for subscriber in flight.subscribers if subscriber[0] is not e_result]
+
+        if not any(e.is_running() for e, _, _ in flight.subscribers):
+            del self.flights[key]
+            if flight.task is not None: flight.task.cancel()
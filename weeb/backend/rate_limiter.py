@@ -0,0 +1,294 @@
+# rate_limiter.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import asyncio, logging, threading, time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Optional
+
+import httpx
+from gi.repository import GLib
+
+from weeb.backend.settings import Settings
+from weeb.backend.utils.singleton import Singleton
+from weeb.backend.utils.threading import Deferred, get_current_job
+
+
+THROTTLE_STATUS_CODES = (429, 503)
+RETRYABLE_METHODS = ("GET", "HEAD")
+
+DEFAULT_LIMITS = {
+    # Danbooru allows 10 reads per second, stay a bit below that
+    "api": {"rate": 5.0, "burst": 10},
+    "cdn": {"rate": 30.0, "burst": 60},
+}
+
+
+class Cancelled(Exception):
+    pass
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After is either a number of seconds or an HTTP date"""
+
+    if not value: return None
+
+    try: return max(0.0, float(value))
+    except ValueError: pass
+
+    try: date = parsedate_to_datetime(value)
+    except (TypeError, ValueError): return None
+
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket:
+    """
+    Classic token bucket, tokens refill at rate per second up to burst.
+
+    Every call to reserve takes a token even if there is none yet and returns
+    how long the caller has to wait for it, so waiting callers are served in order.
+    """
+
+    def __init__(self, rate: float, burst: int) -> None:
+
+        self.rate = rate
+        self.burst = burst
+
+        self.tokens = float(burst)
+        # Refill starts from here, lies in the future while backing off
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        if now <= self.updated: return
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+
+        now = time.monotonic()
+        self.refill(now)
+        self.tokens -= 1
+
+        return max(0.0, self.updated - now) + max(0.0, -self.tokens) / self.rate
+
+    def refund(self) -> None:
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def get_block(self) -> float:
+        return max(0.0, self.updated - time.monotonic())
+
+    def block(self, delay: float) -> None:
+
+        until = time.monotonic() + delay
+        if until <= self.updated: return
+
+        self.refill(time.monotonic())
+        self.tokens = min(self.tokens, 0.0)
+        self.updated = until
+
+
+class RateLimiter(metaclass=Singleton):
+    """
+    Per host request budgets, shared by every client of the application.
+
+    API hosts and CDN hosts get separate limits, set with
+    "downloader/rate_limit/api" and "downloader/rate_limit/cdn".
+    A 429 or 503 blocks the host for Retry-After seconds,
+    or an exponentially growing delay if the server didn't say.
+    """
+
+    settings = Settings()
+
+    def __init__(self) -> None:
+
+        self.lock = threading.Lock()
+        self.buckets: dict[str, TokenBucket] = {}
+        self.strikes: dict[str, int] = {}
+        self.listeners: list[Callable[[str, float], Any]] = []
+
+        self.settings.connect("downloader/rate_limit", lambda *args: self.reset())
+
+    def reset(self) -> None:
+        with self.lock:
+            self.buckets.clear()
+            self.strikes.clear()
+
+    def connect(self, callback: Callable[[str, float], Any]) -> None:
+        """Callback is invoked on the main thread with the host and delay whenever a host gets throttled"""
+        self.listeners.append(callback)
+
+    def get_kind(self, host: str) -> str:
+        cdn_hosts = self.settings.get("downloader/rate_limit/cdn_hosts", ["cdn.donmai.us"])
+        return "cdn" if host in cdn_hosts or host.startswith("cdn.") else "api"
+
+    def get_bucket(self, host: str) -> TokenBucket:
+
+        if host not in self.buckets:
+            kind = self.get_kind(host)
+            rate = self.settings.get(f"downloader/rate_limit/{kind}/rate", DEFAULT_LIMITS[kind]["rate"])
+            burst = self.settings.get(f"downloader/rate_limit/{kind}/burst", DEFAULT_LIMITS[kind]["burst"])
+            self.buckets[host] = TokenBucket(rate, burst)
+
+        return self.buckets[host]
+
+    def is_throttled(self, host: str) -> bool:
+        with self.lock:
+            return host in self.buckets and self.buckets[host].get_block() > 0
+
+    def reserve(self, host: str) -> float:
+        with self.lock:
+            return self.get_bucket(host).reserve()
+
+    def get_block(self, host: str) -> float:
+        with self.lock:
+            return self.get_bucket(host).get_block()
+
+    def refund(self, host: str) -> None:
+        with self.lock:
+            self.get_bucket(host).refund()
+
+    def acquire(self, host: str) -> None:
+        """
+        Waits until a request to host is allowed. On a worker, a longer wait
+        raises Deferred so the job is queued again later instead of holding
+        the worker, shorter ones end early when the job is cancelled.
+        """
+
+        delay = self.reserve(host)
+        job = get_current_job()
+
+        if job is not None and delay > self.settings.get("downloader/rate_limit/defer_after", 1.0):
+            self.refund(host)
+            raise Deferred(delay)
+
+        token = job.expected.token if job is not None else None
+
+        # A backoff may have started while waiting for the token
+        while delay > 0:
+            if token is None: time.sleep(delay)
+            elif token.wait(delay): raise Cancelled(f"Request to {host} cancelled while throttled")
+            delay = self.get_block(host)
+
+    async def acquire_async(self, host: str) -> None:
+
+        delay = self.reserve(host)
+
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.get_block(host)
+
+    def observe(self, host: str, response: httpx.Response) -> Optional[float]:
+        """Feeds a response back, returns how long the host is blocked for if it was a throttling response"""
+
+        with self.lock:
+
+            if response.status_code not in THROTTLE_STATUS_CODES:
+                self.strikes.pop(host, None)
+                return None
+
+            strikes = self.strikes.get(host, 0)
+            self.strikes[host] = strikes + 1
+
+            delay = parse_retry_after(response.headers.get("Retry-After"))
+
+            if delay is None:
+                base = self.settings.get("downloader/rate_limit/backoff", 1.0)
+                delay = base * 2 ** strikes
+
+            delay = min(delay, self.settings.get("downloader/rate_limit/max_backoff", 300.0))
+            self.get_bucket(host).block(delay)
+
+        self.report(host, delay, response.status_code)
+
+        return delay
+
+    def report(self, host: str, delay: float, status_code: int) -> None:
+
+        logging.warning(f"{host} responded with {status_code}, throttling it for {delay:.1f}s")
+
+        for listener in self.listeners:
+            GLib.idle_add(listener, host, delay)
+
+
+class RateLimitedTransport(httpx.BaseTransport):
+    """
+    Waits for the host's budget before every request that reaches the network
+    and transparently retries idempotent requests that got throttled.
+    """
+
+    settings = Settings()
+
+    def __init__(self, transport: httpx.BaseTransport) -> None:
+        self.transport = transport
+        self.limiter = RateLimiter()
+
+    def should_retry(self, request: httpx.Request, delay: Optional[float], retries: int) -> bool:
+        if delay is None or retries <= 0: return False
+        if request.method not in RETRYABLE_METHODS: return False
+        return delay <= self.settings.get("downloader/rate_limit/max_retry_after", 60.0)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+
+        host = request.url.host
+        retries = self.settings.get("downloader/rate_limit/retries", 3)
+
+        while True:
+
+            self.limiter.acquire(host)
+            response = self.transport.handle_request(request)
+            delay = self.limiter.observe(host, response)
+
+            if not self.should_retry(request, delay, retries): return response
+
+            response.close()
+            retries -= 1
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class AsyncRateLimitedTransport(httpx.AsyncBaseTransport):
+    """Same as RateLimitedTransport, for the async client"""
+
+    should_retry = RateLimitedTransport.should_retry
+    settings = Settings()
+
+    def __init__(self, transport: httpx.AsyncBaseTransport) -> None:
+        self.transport = transport
+        self.limiter = RateLimiter()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+
+        host = request.url.host
+        retries = self.settings.get("downloader/rate_limit/retries", 3)
+
+        while True:
+
+            await self.limiter.acquire_async(host)
+            response = await self.transport.handle_async_request(request)
+            delay = self.limiter.observe(host, response)
+
+            if not self.should_retry(request, delay, retries): return response
+
+            await response.aclose()
+            retries -= 1
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
@@ -0,0 +1,48 @@
+# schema.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from gi.repository import Gtk
+
+from weeb.backend.settings import Option, Schema
+from weeb.backend.utils.singleton import Singleton
+
+
+class BoardSettings(Schema, metaclass=Singleton):
+
+    orientation = Option("board/orientation", Gtk.Orientation.HORIZONTAL, Gtk.Orientation)
+    lanes = Option("board/lanes", 3, int)
+
+    tile_size = Option("board/tile/size", 180)
+    min_preview = Option("board/tile/min_preview", 120)
+
+    virtual_margin = Option("board/virtual_margin", 1.0)
+    lookahead_screens = Option("board/lookahead_screens", 2.0)
+
+    # Seconds to wait before paging again after a page that brought nothing new, doubled each time
+    retry_delay = Option("board/retry_delay", 2.0, float)
+    max_retry_delay = Option("board/max_retry_delay", 60.0, float)
+
+    max_in_flight = Option("board/fetch/max_in_flight", 6, int)
+    prefetch_screens = Option("board/fetch/prefetch_screens", 1.0)
+
+
+class DedupSettings(Schema, metaclass=Singleton):
+
+    perceptual = Option("dedup/perceptual", False, bool)
+    perceptual_distance = Option("dedup/perceptual_distance", 4, int)
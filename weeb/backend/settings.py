@@ -17,11 +17,11 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-import enum, json, logging, pathlib
+import contextlib, enum, json, logging, os, pathlib, threading
 from collections import defaultdict
-from typing import Any, Callable, Optional
+from typing import Any, Callable, Generic, Iterator, Optional, TypeVar
 
-from gi.repository import Gio, Gtk
+from gi.repository import Gio, GLib, Gtk
 
 from weeb.backend.constants import app_id
 from weeb.backend.utils.paths import Paths
@@ -50,33 +50,54 @@ class _PartialGSettings:
 
 class Settings(_PartialGSettings, metaclass=Singleton):
 
-    def __init__(self) -> None:
-        super().__init__()
-        
+    def __init__(self, config: Optional[dict] = None) -> None:
+        """
+        With config given the settings are kept in memory only, without GSettings
+        or the config file, for places like benchmarks where the schema isn't installed
+        """
+
+        if config is None: super().__init__()
+        else: self._settings = None
+
         self.subscribers: dict[str, list[Callable]] = defaultdict(list)
-        self.config_path = Paths.get("config/settings.json", parents=True)
-        self.config: dict = self.read(self.config_path)
+        self.config_path: Optional[pathlib.Path] = Paths.get("config/settings.json", parents=True) if config is None else None
+        self.config: dict = self.read(self.config_path) if config is None else config
+
+        self.lock = threading.Lock()
+        self.write_timer: Optional[int] = None
+
+        # Changes made inside a transaction, dispatched once it ends
+        self.depth = 0
+        self.pending: dict[str, Any] = {}
 
-        file = Gio.File.new_for_path(self.config_path.as_posix())
-        self.launcher = Gtk.FileLauncher(file=file)
+        self.launcher: Optional[Gtk.FileLauncher] = None
+
+        if self.config_path is not None:
+            file = Gio.File.new_for_path(self.config_path.as_posix())
+            self.launcher = Gtk.FileLauncher(file=file)
 
         self._is_closed = False
 
+    @property
+    def is_in_memory(self) -> bool:
+        return self.config_path is None
+
     def open_file(self, parent: Optional[Gtk.Window] = None) -> None:
-        if self.config_path.exists():
+        if not self.is_in_memory and self.config_path.exists():
             self.launcher.launch(parent)
 
     def open_folder(self, parent: Optional[Gtk.Window] = None) -> None:
-        if self.config_path.exists():
+        if not self.is_in_memory and self.config_path.exists():
             self.launcher.open_containing_folder(parent)
 
     def delete_file(self) -> None:
+        self.cancel_write()
         self.config = dict()
-        self.config_path.unlink()
+        if not self.is_in_memory: self.config_path.unlink()
 
     def close(self) -> None:
         if not self._is_closed:
-            self.write(self.config_path)
+            self.flush()
             self._is_closed = True
 
     def read(self, path: pathlib.Path) -> dict:
@@ -96,14 +117,84 @@ class Settings(_PartialGSettings, metaclass=Singleton):
         return config
 
     def write(self, path: pathlib.Path) -> None:
-        
+        """Writes to a temporary file first, so a crash never leaves a truncated config behind"""
+
+        temp_path = path.with_suffix(".json.tmp")
+
         try:
-            with open(path, "w") as file:
-                json.dump(self.config, file, indent=4)
+            with self.lock:
+                data = json.dumps(self.config, indent=4)
+
+            with open(temp_path, "w") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+
+            temp_path.replace(path)
 
         except OSError as e:
             logging.error(f"Failed to write config file: {e}")
 
+    def cancel_write(self) -> None:
+        if self.write_timer is not None:
+            GLib.source_remove(self.write_timer)
+            self.write_timer = None
+
+    def schedule_write(self) -> None:
+        """Changes within "settings/write_delay" milliseconds of each other end up in one write"""
+
+        if self.write_timer is not None or self.is_in_memory: return
+
+        delay = self.get("settings/write_delay", 500)
+        self.write_timer = GLib.timeout_add(delay, self.on_write_timeout)
+
+    def on_write_timeout(self) -> None:
+        self.write_timer = None
+        self.write(self.config_path)
+
+    def flush(self) -> None:
+        """Writes pending changes right away"""
+        self.cancel_write()
+        if not self.is_in_memory: self.write(self.config_path)
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator["Settings"]:
+        """
+        Groups several changes, subscribers are notified and the file
+        is written once, after the outermost transaction ends:
+
+        >>> with settings.transaction():
+        ...     settings.set("board/tile/size", 200)
+        ...     settings.set("board/tile/min_preview", 100)
+        """
+
+        self.depth += 1
+
+        try: yield self
+        finally:
+
+            self.depth -= 1
+
+            if self.depth == 0 and self.pending:
+
+                pending, self.pending = self.pending, {}
+                self.schedule_write()
+
+                for key, value in pending.items():
+                    self.dispatch(key, value)
+
+    def dispatch(self, changed_key: str, changed_value: Any) -> None:
+        """Calls the subscribers of changed_key and of every key above it"""
+
+        parts = changed_key.split('/')
+
+        for i in range(1, len(parts) + 1):
+            key = '/'.join(parts[:i])
+            if key not in self.subscribers: continue
+
+            for callback in self.subscribers[key]:
+                callback(changed_value)
+
     def on_changed(self, changed_key: str, changed_value: Any) -> None:
         """
         Allows for partial subs like this:
@@ -113,13 +204,12 @@ class Settings(_PartialGSettings, metaclass=Singleton):
         The callback will trigger if any of proxy subfields are changed
         """
 
-        self.write(self.config_path)
+        if self.depth > 0:
+            self.pending[changed_key] = changed_value
+            return
 
-        for key, callbacks in self.subscribers.items():
-            if key not in changed_key: continue
-
-            for callback in callbacks:
-                callback(changed_value)
+        self.schedule_write()
+        self.dispatch(changed_key, changed_value)
 
 
     def _get_path(self, path: str, default: Any) -> Optional[Any]:
@@ -158,9 +248,10 @@ class Settings(_PartialGSettings, metaclass=Singleton):
 
         if old_value != value:
         
-            if '/' in key: 
-                self._set_path(key, value) 
-            else: self.config[key] = value
+            with self.lock:
+                if '/' in key: 
+                    self._set_path(key, value) 
+                else: self.config[key] = value
 
             self.on_changed(key, value)
 
@@ -171,3 +262,59 @@ class Settings(_PartialGSettings, metaclass=Singleton):
             self.subscribers[key].insert(0, callback)
         else: self.subscribers[key].append(callback)
 
+
+
+T = TypeVar('T')
+class Option(Generic[T]):
+    """
+    A setting declared on a Schema.
+
+    The first read goes through Settings.get and stores the value on the schema
+    instance, which shadows this descriptor, so later reads are plain attribute lookups.
+    """
+
+    def __init__(self, path: str, default: T, kind: Optional[Callable[[Any], T]] = None) -> None:
+        self.path = path
+        self.default = default
+        self.kind = kind
+
+    def __set_name__(self, owner: type, name: str) -> None:
+        self.name = name
+
+    def __get__(self, instance: Optional["Schema"], owner: type) -> T:
+
+        if instance is None: return self
+
+        value = Settings().get(self.path, self.default)
+        if self.kind is not None and value is not None: value = self.kind(value)
+
+        instance.__dict__[self.name] = value
+
+        return value
+
+
+class Schema:
+    """
+    Typed, cached view of a group of settings, meant for code that reads them per item:
+
+    >>> class BoardSettings(Schema, metaclass=Singleton):
+    ...     tile_size = Option("board/tile/size", 180)
+    >>> BoardSettings().tile_size
+
+    Cached values are dropped whenever anything under their top level key changes.
+    """
+
+    def __init__(self) -> None:
+
+        settings = Settings()
+
+        for prefix in {option.path.split('/')[0] for option in self.get_options()}:
+            settings.connect(prefix, self.invalidate, Priority.HIGH)
+
+    @classmethod
+    def get_options(cls) -> list[Option]:
+        return [value for klass in cls.__mro__ for value in vars(klass).values() if isinstance(value, Option)]
+
+    def invalidate(self, *args) -> None:
+        for option in self.get_options():
+            self.__dict__.pop(option.name, None)
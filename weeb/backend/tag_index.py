@@ -0,0 +1,205 @@
+# tag_index.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import bisect, csv, functools, heapq, logging, pathlib, threading, time
+from typing import Iterable
+
+from weeb.backend.primitives import Tag
+from weeb.backend.utils.paths import Paths
+from weeb.backend.utils.singleton import Singleton
+
+
+class TagIndex(metaclass=Singleton):
+    """
+    Local prefix index of tag names and aliases ranked by post count.
+
+    Names and aliases are kept in sorted arrays, so the candidates for
+    a prefix are one bisect away. The index is filled from tag responses,
+    can bulk import a tag dump and is persisted as a tab separated file.
+
+    A refresh that returned every tag matching its query covers all longer
+    queries as well, they don't have to be asked for again.
+    """
+
+    def __init__(self) -> None:
+
+        self.path = Paths.get("tags.tsv", parents=True)
+        self.lock = threading.Lock()
+
+        self.counts: dict[str, int] = {}
+        self.aliases: dict[str, str] = {}
+
+        # Sorted keys (tag names and aliases) and the tag each one points to
+        self.keys: list[str] = []
+        self.targets: list[str] = []
+
+        # Query -> time it was last refreshed from the network, complete holds the ones that got every match
+        self.refreshed: dict[str, float] = {}
+        self.complete: dict[str, float] = {}
+
+        self.load(self.path)
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def rebuild(self) -> None:
+
+        entries = sorted([(name, name) for name in self.counts] + list(self.aliases.items()))
+
+        self.keys, self.targets = [key for key, _ in entries], [target for _, target in entries]
+
+        self.search.cache_clear()
+
+    def insert(self, key: str, target: str) -> None:
+        index = bisect.bisect_left(self.keys, key)
+        self.keys.insert(index, key)
+        self.targets.insert(index, target)
+
+    def retarget(self, key: str, old: str, new: str) -> None:
+
+        index = bisect.bisect_left(self.keys, key)
+
+        while index < len(self.keys) and self.keys[index] == key:
+            if self.targets[index] == old:
+                self.targets[index] = new
+                return
+            index += 1
+
+    def update(self, tags: Iterable[Tag]) -> None:
+        """Merges tags into the index, a refresh only touches the keys it adds, big imports sort everything again"""
+
+        with self.lock:
+
+            added: list[tuple[str, str]] = []
+            moved: list[tuple[str, str, str]] = []
+
+            for tag in tags:
+
+                if tag.name not in self.counts: added.append((tag.name, tag.name))
+                self.counts[tag.name] = tag.count
+
+                for alias in tag.aliases:
+                    previous = self.aliases.get(alias)
+                    if previous == tag.name: continue
+                    if previous is None: added.append((alias, tag.name))
+                    else: moved.append((alias, previous, tag.name))
+                    self.aliases[alias] = tag.name
+
+            # Every insert shifts the arrays, past a point one sort is cheaper
+            if len(added) * 16 > len(self.keys):
+                self.rebuild()
+                return
+
+            for key, target in added:
+                self.insert(key, target)
+
+            for key, old, new in moved:
+                self.retarget(key, old, new)
+
+            self.search.cache_clear()
+
+    @functools.lru_cache(maxsize=1024)
+    def search(self, prefix: str, limit: int = 20) -> tuple[Tag, ...]:
+
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + "\uffff", start)
+
+        names = set(self.targets[start:end])
+        best = heapq.nlargest(limit, names, key=self.counts.__getitem__)
+
+        return tuple(Tag(name=name, count=self.counts[name]) for name in best)
+
+    def is_stale(self, query: str, max_age: float) -> bool:
+
+        now = time.monotonic()
+
+        if now - self.refreshed.get(query, float("-inf")) < max_age: return False
+
+        # A complete answer for a shorter prefix holds every tag this one could match
+        return not any(now - self.complete.get(query[:length], float("-inf")) < max_age for length in range(1, len(query)))
+
+    def mark_refreshed(self, query: str, complete: bool = False) -> None:
+        self.refreshed[query] = time.monotonic()
+        if complete: self.complete[query] = self.refreshed[query]
+
+    def load(self, path: pathlib.Path) -> None:
+
+        skipped = 0
+
+        try:
+            with open(path, "r", newline="") as file:
+                for row in csv.reader(file, delimiter="\t"):
+                    try:
+                        name, count, aliases = row
+                        self.counts[name] = int(count)
+                    except ValueError:
+                        skipped += 1
+                        continue
+                    for alias in filter(None, aliases.split(",")):
+                        self.aliases[alias] = name
+
+        except (OSError, csv.Error) as e:
+            logging.info(f"Tag index not loaded: {e}")
+
+        if skipped: logging.warning(f"Skipped {skipped} malformed rows of the tag index")
+
+        self.rebuild()
+
+    def save(self) -> None:
+
+        with self.lock:
+            counts, aliases = dict(self.counts), dict(self.aliases)
+
+        by_tag: dict[str, list[str]] = {name: [] for name in counts}
+        for alias, name in aliases.items():
+            if name in by_tag: by_tag[name].append(alias)
+
+        temp_path = self.path.with_suffix(".part")
+
+        try:
+            with open(temp_path, "w", newline="") as file:
+                writer = csv.writer(file, delimiter="\t")
+                for name, count in counts.items():
+                    writer.writerow((name, count, ",".join(by_tag[name])))
+            temp_path.replace(self.path)
+
+        except OSError as e:
+            logging.error(f"Failed to write tag index: {e}")
+
+    def import_dump(self, path: pathlib.Path) -> int:
+        """
+        Imports a tag dump in the usual autocomplete CSV layout:
+
+        >>> name,category,post_count,"alias1,alias2"
+
+        Returns the number of imported tags
+        """
+
+        tags: list[Tag] = []
+
+        with open(path, "r", newline="") as file:
+            for row in csv.reader(file):
+                if len(row) < 3 or not row[2].isdigit(): continue
+                aliases = row[3].split(",") if len(row) > 3 and row[3] else []
+                tags.append(Tag(name=row[0], count=int(row[2]), aliases=aliases))
+
+        self.update(tags)
+        self.save()
+
+        return len(tags)
@@ -0,0 +1,277 @@
+# transfer.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import collections, hashlib, logging, pathlib, shutil, threading, time, weakref
+from typing import Any, Callable, Optional
+
+import httpx
+
+from weeb.backend.http_cache import UNCACHED
+from weeb.backend.settings import Settings
+from weeb.backend.utils.expected import CancellationToken, Expected
+from weeb.backend.utils.paths import Paths
+from weeb.backend.utils.threading import Deferred, Job, Lane, WorkerPool, get_current_job
+
+
+CHUNK_SIZE = 64 * 1024
+
+# How long a transfer waits before checking again whether its .part file is free
+BUSY_DELAY = 1.0
+
+
+class TransferCancelled(Exception):
+    pass
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+class RangedDownload:
+    """
+    Downloads url to a file without holding it in memory.
+
+    Bytes go to a .part file under the cache directory, a dropped connection
+    is resumed with a Range request from where it stopped, and the partial
+    file survives cancellation so a later attempt picks it up as well.
+    Files bigger than "downloader/segments/min_size" are split into
+    "downloader/segments/count" ranges fetched in parallel, if the server allows it.
+
+    The md5 of the content is computed while it is written and checked against md5, if given.
+    Transfers of the same file share the .part file, so only one of them runs at a time.
+    """
+
+    settings = Settings()
+
+    # One lock per .part file, gone once no transfer holds it
+    locks: weakref.WeakValueDictionary[str, threading.Lock] = weakref.WeakValueDictionary()
+    locks_guard = threading.Lock()
+
+    def __init__(self, client: httpx.Client, url: str, md5: Optional[str] = None, on_progress: Optional[Callable[[int, Optional[int]], Any]] = None, token: Optional[CancellationToken] = None) -> None:
+
+        self.client = client
+        self.url = url
+        self.md5 = md5
+
+        self.on_progress = on_progress or (lambda *args: None)
+        self.token = token or CancellationToken()
+
+        self.root = Paths.get("cache/downloads")
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        self.key = md5 or hashlib.sha1(url.encode()).hexdigest()
+        self.part_path = self.root / f"{self.key}.part"
+
+        self.size: Optional[int] = None
+        self.received = 0
+
+        # Only kept up to date when the file is fetched in one piece
+        self.hasher: Optional[Any] = None
+
+    def get_segment_path(self, index: int) -> pathlib.Path:
+        return self.part_path.with_suffix(f".part{index}")
+
+    def probe(self) -> bool:
+        """Finds out the size and whether ranges are supported"""
+
+        try: response = self.client.head(self.url, extensions=UNCACHED, follow_redirects=True)
+        except httpx.HTTPError: return False
+
+        if response.status_code != 200: return False
+
+        if length := response.headers.get("Content-Length"):
+            self.size = int(length)
+
+        return response.headers.get("Accept-Ranges") == "bytes"
+
+    def report(self, count: int) -> None:
+        self.received += count
+        self.on_progress(self.received, self.size)
+
+    def fetch(self, path: pathlib.Path, start: int = 0, end: Optional[int] = None) -> None:
+        """Appends bytes start..end (inclusive) of the file to path, resuming whatever path already holds"""
+
+        retries = self.settings.get("downloader/segments/retries", 5)
+        attempt = 0
+
+        while True:
+
+            offset = path.stat().st_size if path.exists() else 0
+            if end is not None and start + offset > end: return
+
+            headers = {}
+            if start + offset > 0 or end is not None:
+                headers["Range"] = f"bytes={start + offset}-{'' if end is None else end}"
+
+            try:
+                # Around the HTTP cache, which would hold the whole file in memory and store it twice
+                with self.client.stream("GET", self.url, headers=headers, extensions=UNCACHED, follow_redirects=True) as response:
+
+                    if response.status_code == 416 and end is None: return
+                    if response.status_code not in (200, 206): response.raise_for_status()
+
+                    mode = "ab"
+
+                    if response.status_code == 200 and "Range" in headers:
+                        # The server ignored the range, only recoverable when the whole file was asked for
+                        if start != 0 or end is not None:
+                            raise RuntimeError(f"Server ignored the range request for {self.url}")
+                        if self.hasher is not None: self.hasher = hashlib.md5()
+                        self.report(-offset)
+                        mode = "wb"
+
+                    remove = self.token.add_callback(response.close)
+
+                    try:
+                        with open(path, mode) as file:
+                            for chunk in response.iter_bytes(CHUNK_SIZE):
+                                if self.token.is_cancelled(): raise TransferCancelled()
+                                file.write(chunk)
+                                if self.hasher is not None: self.hasher.update(chunk)
+                                self.report(len(chunk))
+                    finally: remove()
+
+                    # A read aborted by the cancellation may have ended the loop quietly
+                    if self.token.is_cancelled(): raise TransferCancelled()
+
+                return
+
+            except (httpx.TransportError, httpx.HTTPStatusError, httpx.StreamClosed) as e:
+
+                if self.token.is_cancelled(): raise TransferCancelled() from e
+                if isinstance(e, httpx.HTTPStatusError) and e.response.status_code < 500: raise
+
+                attempt += 1
+                if attempt > retries: raise
+
+                logging.warning(f"Transfer of {self.url} interrupted ({e}), resuming in {2 ** attempt}s")
+                time.sleep(2 ** attempt)
+
+    def fetch_whole(self) -> str:
+
+        self.hasher = hashlib.md5()
+
+        # Bytes left over from an earlier attempt have to be hashed as well
+        if self.part_path.exists():
+            with open(self.part_path, "rb") as file:
+                while chunk := file.read(CHUNK_SIZE):
+                    self.hasher.update(chunk)
+            self.report(self.part_path.stat().st_size)
+
+        self.fetch(self.part_path)
+
+        return self.hasher.hexdigest()
+
+    def fetch_segments(self, count: int) -> str:
+
+        step = -(-self.size // count)
+        ranges = [(index, start, min(start + step, self.size) - 1) for index, start in enumerate(range(0, self.size, step))]
+
+        for index, _, _ in ranges:
+            path = self.get_segment_path(index)
+            if path.exists(): self.report(path.stat().st_size)
+
+        # Ranges go to whoever is free first, this thread included, so segments
+        # queued behind a busy pool are fetched here instead of being waited for
+        pending = collections.deque(ranges)
+        segments = {index: Expected() for index, _, _ in ranges}
+
+        def work() -> None:
+            while True:
+                try: index, start, end = pending.popleft()
+                except IndexError: return
+                e_segment = segments[index]
+                try: self.fetch(self.get_segment_path(index), start, end)
+                except Exception as e:
+                    e_segment.set_error(e)
+                    e_segment.fail()
+                else: e_segment.finish()
+
+        job = get_current_job()
+        lane = job.lane if job is not None else Lane.PREFETCH
+
+        helpers = [Expected() for _ in ranges[1:]]
+        for e_helper in helpers: WorkerPool().submit(Job(work, e_helper), lane)
+
+        try:
+            work()
+            for e_segment in segments.values():
+                e_segment.wait()
+                if e_segment.is_failed(): raise e_segment.get_error()
+        finally:
+            # Helpers that haven't started yet have nothing left to take
+            for e_helper in helpers: e_helper.cancel()
+
+        hasher = hashlib.md5()
+
+        # Segments are joined in order, which is also when they get hashed
+        with open(self.part_path, "wb") as output:
+            for index, _, _ in ranges:
+                path = self.get_segment_path(index)
+                with open(path, "rb") as file:
+                    while chunk := file.read(CHUNK_SIZE):
+                        output.write(chunk)
+                        hasher.update(chunk)
+                path.unlink()
+
+        return hasher.hexdigest()
+
+    def discard(self) -> None:
+        self.part_path.unlink(missing_ok=True)
+        for path in self.root.glob(f"{self.part_path.stem}.part*"):
+            path.unlink(missing_ok=True)
+
+    def lock(self) -> threading.Lock:
+        """Takes the lock of the .part file, deferring the job or waiting while another transfer holds it"""
+
+        with self.locks_guard:
+            lock = self.locks.setdefault(self.key, threading.Lock())
+
+        while not lock.acquire(blocking=False):
+            if get_current_job() is not None: raise Deferred(BUSY_DELAY)
+            if self.token.wait(BUSY_DELAY): raise TransferCancelled()
+
+        return lock
+
+    def run(self, destination: pathlib.Path) -> pathlib.Path:
+        """Downloads to destination, raises TransferCancelled if cancelled and ChecksumMismatch on corrupt content"""
+
+        lock = self.lock()
+        try: return self.transfer(destination)
+        finally: lock.release()
+
+    def transfer(self, destination: pathlib.Path) -> pathlib.Path:
+
+        count = self.settings.get("downloader/segments/count", 4)
+        min_size = self.settings.get("downloader/segments/min_size", 16 * 1024 * 1024)
+
+        is_ranged = self.probe()
+
+        # An unfinished single stream download is resumed as such
+        if count > 1 and is_ranged and self.size and self.size >= min_size and not self.part_path.exists():
+            digest = self.fetch_segments(count)
+        else: digest = self.fetch_whole()
+
+        if self.md5 is not None and digest != self.md5:
+            self.discard()
+            raise ChecksumMismatch(f"{self.url} has md5 {digest}, expected {self.md5}")
+
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(self.part_path, destination)
+
+        return destination
@@ -0,0 +1,120 @@
+# disk_cache.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import logging, os, pathlib, threading
+from typing import Optional
+
+from weeb.backend.utils.paths import Paths
+
+
+class DiskCache:
+    """
+    Content-addressed store of encoded bytes under the cache directory.
+
+    Least recently used files are evicted once the total size exceeds max_size,
+    reads refresh the file's mtime, which serves as the LRU order.
+    The total is only measured on the first write, which happens on a worker.
+    """
+
+    def __init__(self, name: str, max_size: int) -> None:
+
+        self.root = Paths.get(f"cache/{name}")
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        # Scanning a large directory would stall whoever constructs the cache
+        self.size: Optional[int] = None
+
+    def files(self) -> list[pathlib.Path]:
+        return [path for path in self.root.glob("*/*") if path.is_file()]
+
+    def measure(self) -> int:
+
+        size = 0
+
+        for path in self.files():
+            try: size += path.stat().st_size
+            except OSError: continue
+
+        return size
+
+    def get_path(self, key: str) -> pathlib.Path:
+        return self.root / key[:2] / key
+
+    def contains(self, key: str) -> bool:
+        return self.get_path(key).exists()
+
+    def get(self, key: str) -> Optional[bytes]:
+
+        path = self.get_path(key)
+
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except OSError: return None
+
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+
+        path = self.get_path(key)
+        temp_path = path.with_suffix(".part")
+
+        with self.lock:
+
+            if path.exists(): return
+
+            if self.size is None: self.size = self.measure()
+
+            try:
+                path.parent.mkdir(exist_ok=True)
+                temp_path.write_bytes(data)
+                temp_path.replace(path)
+            except OSError as e:
+                logging.error(f"Failed to write cache entry {key}: {e}")
+                return
+
+            self.size += len(data)
+
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self) -> None:
+        """Removes oldest entries until the cache is back under 90% of its budget"""
+
+        target = self.max_size * 0.9
+        entries: list[tuple[float, int, pathlib.Path]] = []
+
+        # Files may vanish meanwhile, removed by an external cleaner
+        for path in self.files():
+            try: stat = path.stat()
+            except OSError: continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort(key=lambda entry: entry[0])
+
+        for _, size, path in entries:
+            if self.size <= target: break
+
+            try: path.unlink()
+            except OSError: continue
+
+            self.size -= size
@@ -17,8 +17,8 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-import enum
-from typing import Callable, Generic, Optional, TypeVar
+import enum, heapq, itertools, logging, threading, time
+from typing import Any, Callable, Generic, Iterable, Optional, TypeVar
 
 
 class Status(enum.Enum):
@@ -28,11 +28,129 @@ class Status(enum.Enum):
     FAILED = "failed"
 
 
+class CancellationToken:
+    """
+    Thread-safe cancellation flag shared between an Expected and the work behind it.
+
+    Workers poll it between steps, resources that can't be polled,
+    like an open response, register a callback that releases them.
+    """
+
+    def __init__(self) -> None:
+
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.callbacks: list[Callable[[], None]] = []
+
+    def is_cancelled(self) -> bool:
+        return self.cancelled
+
+    def add_callback(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """Callback runs on cancel, right away if that already happened. Returns a function that unregisters it"""
+
+        with self.lock:
+            if not self.cancelled:
+                self.callbacks.append(callback)
+                return lambda: self.remove_callback(callback)
+
+        callback()
+        return lambda: None
+
+    def remove_callback(self, callback: Callable[[], None]) -> None:
+        with self.lock:
+            if callback in self.callbacks: self.callbacks.remove(callback)
+
+    def wait(self, timeout: float) -> bool:
+        """Sleeps for timeout seconds unless cancelled first, returns whether it was"""
+
+        event = threading.Event()
+        remove = self.add_callback(event.set)
+
+        try: return event.wait(timeout)
+        finally: remove()
+
+    def cancel(self) -> None:
+
+        with self.lock:
+            if self.cancelled: return
+            self.cancelled = True
+            callbacks, self.callbacks = self.callbacks, []
+
+        for callback in callbacks:
+            try: callback()
+            except Exception as e: logging.error(f"Cancellation callback failed: {e}")
+
+
+def run_callback(callback: Callable, *args) -> None:
+    """A failing callback is logged, it must not take down the thread or the callbacks after it"""
+    try: callback(*args)
+    except Exception as e: logging.exception(f"Callback {callback} failed: {e}")
+
+
+class TimerThread:
+    """One daemon thread firing every Expected timeout, so a timeout doesn't cost a thread of its own"""
+
+    def __init__(self) -> None:
+
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+
+        # [deadline, sequence, callback], the callback is cleared when cancelled
+        self.heap: list[list] = []
+        self.thread: Optional[threading.Thread] = None
+
+    def schedule(self, delay: float, callback: Callable[[], Any]) -> list:
+
+        entry = [time.monotonic() + delay, next(self.counter), callback]
+
+        with self.condition:
+
+            heapq.heappush(self.heap, entry)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+            self.condition.notify()
+
+        return entry
+
+    @staticmethod
+    def cancel(entry: list) -> None:
+        entry[2] = None
+
+    def run(self) -> None:
+
+        while True:
+
+            with self.condition:
+
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+
+                _, _, callback = heapq.heappop(self.heap)
+
+            if callback is not None: run_callback(callback)
+
+timers = TimerThread()
+
+
 T = TypeVar('T')
 class Expected(Generic[T]):
+    """
+    Result of an asynchronous operation, safe to settle and observe from any thread.
+
+    Only the first of finish(), fail() and cancel() counts. Callbacks added with
+    add_done_callback() run exactly once, on the thread that settles the Expected,
+    or right away if it already is settled.
+    """
+
+    __slots__ = ("__lock", "__status", "__value", "__error", "__callbacks", "__event", "__token", "__on_cancel_cb", "__on_fail_cb", "__on_finish_cb")
 
     def __init__(self, value: Optional[T] = None, on_cancel: Optional[Callable] = None, on_fail: Optional[Callable] = None,  on_finish: Optional[Callable] = None) -> None:
 
+        self.__lock = threading.Lock()
+
         self.__on_cancel_cb = on_cancel
         self.__on_fail_cb = on_fail
         self.__on_finish_cb = on_finish
@@ -42,22 +160,59 @@ class Expected(Generic[T]):
 
         self.__status = Status.RUNNING
 
-    def cancel(self) -> None:
-        self.__status = Status.CANCELLED
-        self.on_cancel()
+        # Created on first use, most instances never need them
+        self.__callbacks: Optional[list[Callable[["Expected[T]"], Any]]] = None
+        self.__event: Optional[threading.Event] = None
+        self.__token: Optional[CancellationToken] = None
+
+    def __settle(self, status: Status, source: Optional["Expected"] = None) -> bool:
+
+        with self.__lock:
+            if self.__status != Status.RUNNING: return False
+            if source is not None: self.__value, self.__error = source.value, source.get_error()
+            self.__status = status
+            callbacks, self.__callbacks = self.__callbacks, None
+            event, token = self.__event, self.__token
+
+        if token is not None and status == Status.CANCELLED: token.cancel()
+
+        match status:
+            case Status.CANCELLED: handler = self.__on_cancel_cb
+            case Status.FAILED: handler = self.__on_fail_cb
+            case _: handler = self.__on_finish_cb
 
-    def fail(self) -> None:
-        self.__status = Status.FAILED
-        self.on_fail()
+        if handler is not None: run_callback(handler)
 
-    def finish(self) -> None:
-        self.__status = Status.FINISHED
-        self.on_finish()
+        if event is not None: event.set()
+
+        for callback in callbacks or ():
+            run_callback(callback, self)
+
+        return True
+
+    def cancel(self) -> bool:
+        return self.__settle(Status.CANCELLED)
+
+    def fail(self) -> bool:
+        return self.__settle(Status.FAILED)
+
+    def finish(self) -> bool:
+        return self.__settle(Status.FINISHED)
 
     @property
     def status(self) -> Status:
         return self.__status
 
+    @property
+    def token(self) -> CancellationToken:
+
+        with self.__lock:
+            if self.__token is None:
+                self.__token = CancellationToken()
+                if self.__status == Status.CANCELLED: self.__token.cancel()
+
+        return self.__token
+
     def is_running(self) -> bool:
         return self.__status == Status.RUNNING
 
@@ -116,3 +271,168 @@ class Expected(Generic[T]):
 
     def set_on_finish(self, on_finish: Callable) -> None:
         self.__on_finish_cb = on_finish
+
+    def add_done_callback(self, callback: Callable[["Expected[T]"], Any]) -> None:
+
+        with self.__lock:
+            if self.__status == Status.RUNNING:
+                if self.__callbacks is None: self.__callbacks = []
+                self.__callbacks.append(callback)
+                return
+
+        run_callback(callback, self)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until settled, returns False if the timeout ran out first. Never call it on the main loop"""
+
+        with self.__lock:
+            if self.__status != Status.RUNNING: return True
+            if self.__event is None: self.__event = threading.Event()
+            event = self.__event
+
+        return event.wait(timeout)
+
+    def copy_from(self, other: "Expected") -> bool:
+        """Settles this one the same way as other, which has to be settled already"""
+
+        return self.__settle(other.status, other)
+
+    def then(self, function: Callable[[T], Any]) -> "Expected":
+        """
+        Expected of function(value), run once this one finishes.
+        If function returns an Expected, the result follows that one instead.
+        Failures and cancellations are passed on, cancelling the result cancels this one.
+        """
+
+        e_result: Expected = Expected()
+        e_result.token.add_callback(self.cancel)
+
+        def on_done(expected: Expected[T]) -> None:
+
+            if not expected.is_finished():
+                e_result.copy_from(expected)
+                return
+
+            try: value = function(expected.value)
+            except Exception as e:
+                e_result.set_error(e)
+                e_result.fail()
+                return
+
+            if isinstance(value, Expected):
+                e_result.token.add_callback(value.cancel)
+                value.add_done_callback(e_result.copy_from)
+            else:
+                e_result.value = value
+                e_result.finish()
+
+        self.add_done_callback(on_done)
+
+        return e_result
+
+    def with_timeout(self, seconds: float) -> "Expected[T]":
+        """Same result as this one, unless it takes longer than seconds, then this one is cancelled and the result fails with TimeoutError"""
+
+        e_result: Expected[T] = Expected()
+        e_result.token.add_callback(self.cancel)
+
+        def on_timeout() -> None:
+            # Settled together with its error, a result that finished meanwhile keeps its own
+            e_timeout: Expected[T] = Expected()
+            e_timeout.set_error(TimeoutError(f"Timed out after {seconds}s"))
+            e_timeout.fail()
+            if e_result.copy_from(e_timeout): self.cancel()
+
+        entry = timers.schedule(seconds, on_timeout)
+
+        def on_done(expected: Expected[T]) -> None:
+            TimerThread.cancel(entry)
+            e_result.copy_from(expected)
+
+        self.add_done_callback(on_done)
+
+        return e_result
+
+    @staticmethod
+    def gather(expecteds: Iterable["Expected"], tolerate_failures: bool = False) -> "Expected[list]":
+        """
+        Finishes with the values of all expecteds, in order, once every one of them is done.
+
+        The first failure fails the result and cancels the rest, unless tolerate_failures
+        is set, then failed and cancelled ones contribute None. Cancelling the result cancels all of them.
+        """
+
+        expecteds = list(expecteds)
+        e_result: Expected[list] = Expected([None] * len(expecteds))
+
+        lock = threading.Lock()
+        remaining = len(expecteds)
+
+        def cancel_all() -> None:
+            for expected in expecteds:
+                expected.cancel()
+
+        e_result.token.add_callback(cancel_all)
+
+        def get_handler(index: int) -> Callable[[Expected], None]:
+
+            def on_done(expected: Expected) -> None:
+                nonlocal remaining
+
+                if expected.is_finished(): e_result.value[index] = expected.value
+                elif not tolerate_failures:
+                    if e_result.copy_from(expected): cancel_all()
+                    return
+
+                with lock:
+                    remaining -= 1
+                    is_last = remaining == 0
+
+                if is_last: e_result.finish()
+
+            return on_done
+
+        for index, expected in enumerate(expecteds):
+            expected.add_done_callback(get_handler(index))
+
+        if not expecteds: e_result.finish()
+
+        return e_result
+
+    @staticmethod
+    def race(expecteds: Iterable["Expected"]) -> "Expected":
+        """Follows the first of expecteds to finish and cancels the others, fails only if all of them fail"""
+
+        expecteds = list(expecteds)
+        e_result: Expected = Expected()
+
+        lock = threading.Lock()
+        remaining = len(expecteds)
+
+        def cancel_all() -> None:
+            for expected in expecteds:
+                expected.cancel()
+
+        e_result.token.add_callback(cancel_all)
+
+        def on_done(expected: Expected) -> None:
+            nonlocal remaining
+
+            if expected.is_finished():
+                if e_result.copy_from(expected): cancel_all()
+                return
+
+            with lock:
+                remaining -= 1
+                is_last = remaining == 0
+
+            if is_last: e_result.copy_from(expected)
+
+        for expected in expecteds:
+            expected.add_done_callback(on_done)
+
+        if not expecteds:
+            e_result.set_error(ValueError("Nothing to race"))
+            e_result.fail()
+
+        return e_result
@@ -0,0 +1,88 @@
+# json_stream.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import codecs, json, re
+from typing import Any, Callable
+
+try: import orjson
+except ImportError: orjson = None
+
+
+def get_loads(fast: bool = True) -> Callable[[bytes], Any]:
+    """orjson.loads if it's installed and wanted, json.loads otherwise"""
+    if fast and orjson is not None: return orjson.loads
+    return json.loads
+
+
+SEPARATORS = re.compile(r"[\s,]*")
+
+
+class JSONArrayStream:
+    """
+    Incremental parser for a top-level JSON array.
+
+    Bytes are fed as they arrive and every element is decoded as soon
+    as it is complete, so the array is never held whole. json's raw_decode
+    parses an element and reports where it ends in one pass of C code,
+    an element cut by the chunk boundary is parsed again once more arrives.
+    """
+
+    def __init__(self) -> None:
+
+        self.raw_decode = json.JSONDecoder().raw_decode
+
+        # Characters split between chunks are held back until they are whole
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+
+        self.text = ""
+        self.started = False
+
+    def feed(self, data: bytes) -> list[Any]:
+
+        items: list[Any] = []
+
+        text = self.text + self.decoder.decode(data)
+        i = SEPARATORS.match(text).end()
+
+        if not self.started and i < len(text):
+            if text[i] != "[": raise ValueError(f"Expected a JSON array, got {text[i:i + 20]!r}")
+            self.started = True
+            i += 1
+
+        while self.started:
+
+            i = SEPARATORS.match(text, i).end()
+            if i >= len(text) or text[i] == "]": break
+
+            # Incomplete and malformed elements look the same until the input ends, close() tells them apart
+            try: item, i = self.raw_decode(text, i)
+            except json.JSONDecodeError: break
+
+            items.append(item)
+
+        # Keep only the element that is still incomplete
+        self.text = text[i:]
+
+        return items
+
+    def close(self) -> None:
+        """Raises ValueError if the input ended inside an element or held one that doesn't parse"""
+
+        rest = (self.text + self.decoder.decode(b"", final=True)).strip()
+        if rest and rest != "]": raise ValueError(f"Malformed or truncated JSON array near {rest[:40]!r}")
@@ -0,0 +1,52 @@
+# perceptual.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Perceptual hashing of small decoded thumbnails.
+
+The image is expected to be scaled down to (HASH_SIZE + 1) x HASH_SIZE already,
+which the decoder does with the same pixbuf it just produced.
+"""
+
+HASH_SIZE = 8
+
+
+def to_grayscale(pixels: bytes, width: int, height: int, rowstride: int, channels: int) -> list[int]:
+
+    gray = []
+
+    for y in range(height):
+        row = y * rowstride
+        for x in range(row, row + width * channels, channels):
+            gray.append((pixels[x] * 299 + pixels[x + 1] * 587 + pixels[x + 2] * 114) // 1000)
+
+    return gray
+
+def dhash(gray: list[int], size: int = HASH_SIZE) -> int:
+    """Difference hash, one bit per horizontally adjacent pixel pair of a (size + 1) x size image"""
+
+    row_length = size + 1
+
+    lefts = [value for i, value in enumerate(gray) if i % row_length != size]
+    rights = [value for i, value in enumerate(gray) if i % row_length != 0]
+
+    return sum(1 << bit for bit, (left, right) in enumerate(zip(lefts, rights)) if left < right)
+
+def distance(first: int, second: int) -> int:
+    return (first ^ second).bit_count()
@@ -17,43 +17,257 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-import functools, threading, traceback
-from typing import Callable, Optional
+import asyncio, enum, functools, itertools, queue, threading, traceback
+from collections import defaultdict, deque
+from typing import Awaitable, Callable, Optional
 
 from gi.repository import GLib
 
-from weeb.backend.utils.expected import Expected
+from weeb.backend.settings import Settings
+from weeb.backend.utils.expected import Expected, timers
+from weeb.backend.utils.singleton import Singleton
 
 
-class GThread(threading.Thread):
-    """A Thread class that can be used in GTK+ applications to run functions in a background thread"""
+class Lane(enum.IntEnum):
+    """Priority lanes of the worker pool, lower value is served first"""
+    INTERACTIVE = 0
+    VISIBLE = 1
+    PREFETCH = 2
+
+
+class Deferred(Exception):
+    """Raised by a job's target that can't make progress for a while, the job runs again after delay seconds"""
+
+    def __init__(self, delay: float) -> None:
+        super().__init__(f"Deferred for {delay:.1f}s")
+        self.delay = delay
+
+
+# The job running on the current worker, if any
+local = threading.local()
+
+def get_current_job() -> Optional["Job"]:
+    return getattr(local, "job", None)
+
+def fail_expected(expected: Expected, error: Exception) -> None:
+    traceback.print_exception(error)
+    expected.set_error(error)
+    expected.fail()
+
+def settle_expected(expected: Expected, callback: Optional[Callable] = None) -> None:
+    """Finishes a still running expected and hands it to the callback on the main loop"""
+
+    if not expected.is_cancelled() and not expected.is_failed():
+        expected.finish()
+
+    if callback and not expected.is_cancelled():
+        GLib.idle_add(callback, expected)
+
+
+class Job:
 
     def __init__(self, target: Callable, expected: Expected, callback: Optional[Callable] = None, *args, **kwargs) -> None:
 
-        def handler(*args, **kwargs) -> None:
-            try: expected.value = target(*args, **kwargs)
-            except Exception as e: 
-                traceback.print_exception(e)
-                expected.set_error(e)
-                expected.fail()
+        self.target = target
+        self.expected = expected
+        self.callback = callback
+
+        self.args = args
+        self.kwargs = kwargs
+
+        # Set by WorkerPool.submit, a deferred job goes back to the same lane
+        self.lane = Lane.INTERACTIVE
+
+    def run(self) -> None:
+
+        expected = self.expected
+
+        if expected.is_cancelled(): return
+
+        local.job = self
+
+        try: expected.value = self.target(*self.args, **self.kwargs)
+        except Deferred as e:
+            # Gives the worker back instead of sleeping on it
+            if not expected.is_cancelled(): WorkerPool().submit_later(self, e.delay)
+            return
+        except Exception as e:
+            # Targets may bail out with an error once they notice the cancellation
+            if not expected.is_cancelled(): fail_expected(expected, e)
+        finally: local.job = None
+
+        settle_expected(expected, self.callback)
+
+
+class WorkerPool(metaclass=Singleton):
+    """
+    A fixed set of daemon threads serving jobs from a shared priority queue.
+
+    Lanes only order the queue and a running job is never preempted, so at most
+    "threading/prefetch_limit" PREFETCH jobs run at once, long transfers included.
+    The rest of the workers stay free for interactive and visible work.
+    """
+
+    def __init__(self) -> None:
+
+        self.settings = Settings()
+
+        self.queue: queue.PriorityQueue[tuple[int, int, Optional[Job]]] = queue.PriorityQueue()
+        self.counter = itertools.count()
+
+        self.lock = threading.Lock()
+        self.workers: list[threading.Thread] = []
+
+        # Jobs of a lane at its limit wait here, in order, until one of that lane is done
+        self.limits: dict[Lane, int] = {}
+        self.active: defaultdict[Lane, int] = defaultdict(int)
+        self.parked: defaultdict[Lane, deque] = defaultdict(deque)
+
+        self.set_prefetch_limit(self.settings.get("threading/prefetch_limit", 2))
+        self.settings.connect("threading/prefetch_limit", self.set_prefetch_limit)
+
+        self.resize(self.settings.get("threading/workers", 8))
+        self.settings.connect("threading/workers", self.resize)
+
+    def resize(self, count: int) -> None:
+
+        count = max(1, int(count))
+
+        with self.lock:
+
+            while len(self.workers) < count:
+                worker = threading.Thread(target=self.worker_loop, daemon=True)
+                self.workers.append(worker)
+                worker.start()
+
+            while len(self.workers) > count:
+                self.workers.pop()
+                # A None job is served before any real one and stops exactly one worker
+                self.queue.put((-1, next(self.counter), None))
 
-            if not expected.is_cancelled() and not expected.is_failed():
-                expected.finish()
+    def set_prefetch_limit(self, limit: int) -> None:
 
-            if callback and not expected.is_cancelled():
-                GLib.idle_add(callback, expected)
+        with self.lock:
+            self.limits[Lane.PREFETCH] = max(1, int(limit))
+            self.unpark(Lane.PREFETCH)
 
-        super().__init__(target=handler, args=args, kwargs=kwargs, daemon=True)
+    def unpark(self, lane: Lane) -> None:
+        """Queues parked jobs of lane again while it has free slots, called with the lock held"""
 
-        self.start()
+        free = self.limits.get(lane, 0) - self.active[lane]
 
+        while self.parked[lane] and free > 0:
+            # The original entry keeps the job's place among the others of its lane
+            self.queue.put(self.parked[lane].popleft())
+            free -= 1
 
-def run_in_thread(target: Callable,  callback: Optional[Callable] = None, *args, **kwargs) -> Expected:
+    def claim(self, entry: tuple[int, int, "Job"]) -> bool:
+        """Takes a slot of the job's lane, or parks the job if the lane is at its limit"""
+
+        lane = entry[2].lane
+
+        with self.lock:
+            if lane in self.limits and self.active[lane] >= self.limits[lane]:
+                self.parked[lane].append(entry)
+                return False
+            self.active[lane] += 1
+
+        return True
+
+    def release(self, lane: Lane) -> None:
+
+        with self.lock:
+            self.active[lane] -= 1
+            self.unpark(lane)
+
+    def worker_loop(self) -> None:
+
+        while True:
+            entry = self.queue.get()
+            job = entry[2]
+            if job is None: break
+            if not self.claim(entry): continue
+            try: job.run()
+            finally: self.release(job.lane)
+
+    def submit(self, job: Job, lane: Lane = Lane.INTERACTIVE) -> None:
+        job.lane = lane
+        self.queue.put((int(lane), next(self.counter), job))
+
+    def submit_later(self, job: Job, delay: float) -> None:
+        """Queues job on its lane after delay seconds, without holding a worker meanwhile"""
+        entry = timers.schedule(delay, lambda: self.submit(job, job.lane))
+        # A cancelled job doesn't need to come back
+        job.expected.token.add_callback(lambda: timers.cancel(entry))
+
+    def pending(self) -> int:
+        return self.queue.qsize()
+
+
+class EventLoopThread(metaclass=Singleton):
+    """A single daemon thread running an asyncio event loop forever"""
+
+    def __init__(self) -> None:
+
+        self.loop = asyncio.new_event_loop()
+
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def submit(self, coroutine: Awaitable):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+
+def run_in_thread(target: Callable,  callback: Optional[Callable] = None, *args, lane: Lane = Lane.INTERACTIVE, **kwargs) -> Expected:
 
     expected = Expected()
-    GThread(target, expected, callback, *args, **kwargs)
+    WorkerPool().submit(Job(target, expected, callback, *args, **kwargs), lane)
     return expected
 
+def run_in_loop(target: Callable[..., Awaitable],  callback: Optional[Callable] = None, *args, lane: Optional[Lane] = None, **kwargs) -> Expected:
+    """
+    Runs the coroutine on the event loop thread.
+    With a lane, the expected is settled on a worker of that lane, so finish handlers don't block the loop.
+    """
+
+    expected = Expected()
+
+    async def handler() -> None:
+
+        try: expected.value = await target(*args, **kwargs)
+        except asyncio.CancelledError: return
+        except Exception as e: fail_expected(expected, e)
+
+        if lane is None: settle_expected(expected, callback)
+        else: await run_in_pool(settle_expected, expected, callback, lane=lane)
+
+    future = EventLoopThread().submit(handler())
+    expected.set_on_cancel(future.cancel)
+
+    return expected
+
+async def run_in_pool(target: Callable, *args, lane: Lane = Lane.INTERACTIVE, **kwargs):
+    """Awaits target run on the worker pool, for blocking work started from a coroutine"""
+
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def on_done(expected: Expected) -> None:
+        if future.done(): return
+        if expected.is_failed(): future.set_exception(expected.get_error())
+        elif expected.is_cancelled(): future.cancel()
+        else: future.set_result(expected.value)
+
+    expected = Expected()
+    expected.add_done_callback(lambda expected: loop.call_soon_threadsafe(on_done, expected))
+
+    WorkerPool().submit(Job(target, expected, None, *args, **kwargs), lane)
+
+    try: return await future
+    except asyncio.CancelledError:
+        expected.cancel()
+        raise
+
 def glib_idle(func: Callable) -> Callable:
     """Wraps a function in a GLib.idle_add() call"""
 
@@ -62,4 +276,4 @@ def glib_idle(func: Callable) -> Callable:
         if kwargs: args += tuple([value for _, value in kwargs])
         GLib.idle_add(func, *args)
 
-    return wrapper
\ No newline at end of file
+    return wrapper
@@ -17,13 +17,17 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+from typing import Optional
+
 from gi.repository import Adw, GLib, Gtk
 
 from weeb.backend.constants import root
-from weeb.backend.primitives import Asset
-from weeb.backend.providers_manager import ProvidersManager
+from weeb.backend.primitives import Asset, Booru
+from weeb.backend.providers_manager import ProviderStatus, ProvidersManager, Search
+from weeb.backend.schema import BoardSettings
 from weeb.backend.utils.expected import Expected
 from weeb.frontend.views.tile import Tile
+from weeb.frontend.widgets.fetch_scheduler import FetchScheduler
 from weeb.frontend.widgets.flow_grid import FlowGrid
 
 
@@ -35,35 +39,122 @@ class Board(Adw.Bin):
     scroll: Gtk.ScrolledWindow = Gtk.Template.Child()
     flow: FlowGrid = Gtk.Template.Child()
 
+    board_settings = BoardSettings()
+
     def __init__(self, **kwargs):
 
         self.assets: set[Asset] = set()
         self.e_search: Expected[set[Asset]] = None
+        self.search: Search = None
+
+        # New assets the running page brought, and the back-off after one that brought none
+        self.page_assets = 0
+        self.retry_timer: Optional[int] = None
+        self.retry_delay = 0.0
 
         super().__init__(**kwargs)
 
         self.manager = ProvidersManager()
+        self.scheduler = FetchScheduler()
+
+        self.flow.set_factory(self.create_tile, lambda tile, placement:
+            tile.bind(placement.asset, placement.variant, (placement.width, placement.height)))
+
+        for adjustment in (self.scroll.get_hadjustment(), self.scroll.get_vadjustment()):
+            adjustment.connect("value-changed", self.on_viewport_changed)
+            adjustment.connect("changed", self.on_viewport_changed)
 
         GLib.timeout_add_seconds(2, self.search_by_tags, ["1girl", "1boy", "rating:sensitive"])
 
-    def search_by_tags(self, tags: list[str]) -> None:
+    def create_tile(self) -> Tile:
+        tile = Tile()
+        tile.connect("fingerprinted", self.on_tile_fingerprinted)
+        return tile
+
+    def on_tile_fingerprinted(self, tile: Tile, fingerprint: int) -> None:
+        """Hides tiles that turned out to be a re-encode of an image already on the board"""
+
+        if self.search is None or tile.asset is None: return
+
+        if self.search.deduplicator.add_fingerprint(tile.asset, fingerprint) is not None:
+            self.flow.remove({tile.asset})
+
+    def get_scroll_adjustment(self) -> Gtk.Adjustment:
+        if self.board_settings.orientation == Gtk.Orientation.HORIZONTAL:
+            return self.scroll.get_hadjustment()
+        return self.scroll.get_vadjustment()
+
+    def on_viewport_changed(self, *args) -> None:
+
+        adjustment = self.get_scroll_adjustment()
+
+        start = adjustment.get_value()
+        end = start + adjustment.get_page_size()
+
+        self.flow.set_viewport(start, end)
 
-        def run_search() -> None:
-            self.e_search = self.manager.search_assets_async(tags, self.populate_board)
+        self.scheduler.set_viewport(self.flow, self.board_settings.orientation, start, end)
 
+        lookahead = adjustment.get_page_size() * self.board_settings.lookahead_screens
+        if end + lookahead >= adjustment.get_upper(): self.load_next_page()
+
+    def search_by_tags(self, tags: list[str]) -> None:
+
+        # A new search supersedes the running one, which is cancelled all the way down
         if self.e_search is not None and self.e_search.is_running():
-            self.e_search.on_finish(run_search)
-        else: run_search()
+            self.e_search.cancel()
+
+        self.assets.clear()
+        self.flow.clear()
+
+        self.cancel_retry()
+        self.retry_delay = 0.0
+
+        self.search = self.manager.create_search(tags)
+        self.load_next_page()
+
+    def load_next_page(self) -> None:
+
+        if self.search is None or self.search.is_exhausted(): return
+        if self.e_search is not None and self.e_search.is_running(): return
+        if self.retry_timer is not None: return
+
+        self.page_assets = 0
+        self.e_search = self.search.next_page_async(self.on_page_finished, self.populate_board)
+
+    def cancel_retry(self) -> None:
+        if self.retry_timer is not None: GLib.source_remove(self.retry_timer)
+        self.retry_timer = None
+
+    def on_retry_timeout(self) -> bool:
+        self.retry_timer = None
+        self.on_viewport_changed()
+        return False
+
+    def populate_board(self, provider: Booru, assets: set[Asset]) -> None:
+
+        assets = assets - self.assets
+        self.assets |= assets
+        self.page_assets += len(assets)
+
+        self.flow.extend(assets)
 
-    def populate_board(self, e_assets: Expected[set[Asset]]) -> None:
+        self.placeholder.set_visible(len(self.assets) == 0)
+        self.scroll.set_visible(len(self.assets) != 0)
 
-        assets = e_assets.value
+    def on_page_finished(self, e_assets: Expected[set[Asset]]) -> None:
 
-        for asset in assets:
-            tile = Tile(asset)
-            self.flow.append(tile)
+        if e_assets is not self.e_search: return
 
-        self.placeholder.set_visible(len(assets) == 0)
-        self.scroll.set_visible(len(assets) != 0)
+        finished = ProviderStatus.FINISHED in self.search.statuses.values()
 
+        if finished and self.page_assets > 0:
+            self.retry_delay = 0.0
+            # A short page may not fill the look-ahead, so check again
+            self.on_viewport_changed()
+            return
 
+        # Nobody answered, or only with assets already on the board, paging right away would spin
+        initial = self.board_settings.retry_delay
+        self.retry_delay = min(self.retry_delay * 2 or initial, self.board_settings.max_retry_delay)
+        self.retry_timer = GLib.timeout_add(int(self.retry_delay * 1000), self.on_retry_timeout)
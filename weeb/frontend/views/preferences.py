@@ -112,9 +112,10 @@ class Preferences(Adw.PreferencesDialog):
     @Gtk.Template.Callback()
     def on_general_board_apply(self, *args) -> None:
 
-        self.settings.set("board/orientation", self.board_orientation_row.get_selected())
-        self.settings.set("board/tile/size", self.board_tile_size_row.get_value())
-        self.settings.set("board/tile/min_preview", self.board_tile_min_preview_row.get_value())
+        with self.settings.transaction():
+            self.settings.set("board/orientation", self.board_orientation_row.get_selected())
+            self.settings.set("board/tile/size", self.board_tile_size_row.get_value())
+            self.settings.set("board/tile/min_preview", self.board_tile_min_preview_row.get_value())
 
         self.general_board_apply_btn.set_sensitive(False)
 
@@ -157,24 +158,24 @@ class Preferences(Adw.PreferencesDialog):
     @Gtk.Template.Callback()
     def on_proxy_general_apply(self, *args) -> None:
 
-        self.settings.set("proxy/type", self.proxy_type_row.get_selected())
-        self.settings.set("proxy/host", self.proxy_host_row.get_text())
-        self.settings.set("proxy/port", self.proxy_port_btn.get_value_as_int())
+        with self.settings.transaction():
+            self.settings.set("proxy/type", self.proxy_type_row.get_selected())
+            self.settings.set("proxy/host", self.proxy_host_row.get_text())
+            self.settings.set("proxy/port", self.proxy_port_btn.get_value_as_int())
+            self.update_proxy_uri()
 
         self.proxy_general_apply_btn.set_sensitive(False)
 
-        self.update_proxy_uri()
-
     @Gtk.Template.Callback()
     def on_proxy_credentials_apply(self, *args) -> None:
 
-        self.settings.set("proxy/credentials/username", self.proxy_username_row.get_text())
-        self.settings.set("proxy/credentials/password", self.proxy_password_row.get_text())
+        with self.settings.transaction():
+            self.settings.set("proxy/credentials/username", self.proxy_username_row.get_text())
+            self.settings.set("proxy/credentials/password", self.proxy_password_row.get_text())
+            self.update_proxy_uri()
 
         self.proxy_credentials_apply_btn.set_sensitive(False)
 
-        self.update_proxy_uri()
-
     def update_proxy_uri(self) -> None:
 
         logging.info("Updating proxy URI...")
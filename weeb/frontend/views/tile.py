@@ -17,14 +17,17 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-import logging, math
+import logging
+from typing import Optional
 
-from gi.repository import Gtk
+from gi.repository import GObject, Gtk
 
 from weeb.backend.constants import root
 from weeb.backend.primitives import Asset, Variant
-from weeb.backend.settings import Settings
+from weeb.backend.schema import BoardSettings
+from weeb.frontend.widgets.masonry_layout import choose_variant, measure
 from weeb.frontend.widgets.stream_image import StreamImage
+from weeb.frontend.widgets.texture_cache import TextureCache
 
 
 @Gtk.Template(resource_path=f"{root}/ui/tile.ui")
@@ -33,47 +36,44 @@ class Tile(Gtk.Button):
 
     picture: Gtk.Picture = Gtk.Template.Child()
 
-    settings = Settings()
+    __gsignals__ = {
+        "fingerprinted": (GObject.SignalFlags.RUN_FIRST, None, (GObject.TYPE_UINT64,))
+    }
 
-    def __init__(self, asset: Asset, **kwargs):
-        super().__init__(**kwargs)
-
-        self.asset = asset
-        self.variant = self.get_preferred_variant(asset)
-
-        self.set_size_request(*self.get_preferred_size(self.variant))
-        self.picture.set_paintable(StreamImage(self.variant, preload=False))
+    board_settings = BoardSettings()
 
-    def get_preferred_variant(self, asset: Asset) -> Variant:
-
-        variant_index = 0
+    def __init__(self, asset: Optional[Asset] = None, **kwargs):
+        super().__init__(**kwargs)
 
-        image_orientation = int(asset.preview.width < asset.preview.height)
-        board_orientation = self.settings.get("board/orientation", 0)
+        self.asset: Asset = None
+        self.variant: Variant = None
+        self.image: StreamImage = None
 
-        min_preview = self.settings.get("board/tile/min_preview", 120)
+        if asset is not None: self.bind(asset)
 
-        if image_orientation == board_orientation:
+    def bind(self, asset: Asset, variant: Optional[Variant] = None, size: Optional[tuple[int, int]] = None) -> None:
+        """Shows another asset, reusing the tile and its image"""
 
-            for variant in asset.variants:
-                axis = variant.width if image_orientation else variant.height
-                if axis < min_preview and not variant.url.endswith((".mp4", ".gif")):
-                   variant_index += 1
-                else: break
+        self.asset = asset
+        self.variant = variant or self.get_preferred_variant(asset)
 
-        return asset.variants[variant_index]
+        self.set_size_request(*(size or self.get_preferred_size(self.variant)))
 
-    def get_preferred_size(self, variant: Variant) -> tuple[int, int]:
+        key = TextureCache.make_key(asset, self.variant)
 
-        width = height = self.settings.get("board/tile/size", 180)
-        board_orientation = self.settings.get("board/orientation", 0)
+        if self.image is None:
+            self.image = StreamImage(self.variant, preload=False, anchor=self, key=key)
+            self.image.connect("fingerprinted", lambda image, fingerprint: self.emit("fingerprinted", fingerprint))
+            self.picture.set_paintable(self.image)
+        else: self.image.bind(self.variant, key)
 
-        if board_orientation == Gtk.Orientation.HORIZONTAL:
-            width = math.floor((variant.width / variant.height) * height)
-        elif board_orientation == Gtk.Orientation.VERTICAL:
-            height = math.floor((variant.height / variant.width) * width)
+    @classmethod
+    def get_preferred_variant(cls, asset: Asset) -> Variant:
+        return choose_variant(asset, cls.board_settings.orientation, cls.board_settings.min_preview)
 
-        return width, height
+    @classmethod
+    def get_preferred_size(cls, variant: Variant) -> tuple[int, int]:
+        return measure(variant, cls.board_settings.orientation, cls.board_settings.tile_size)
 
     @Gtk.Template.Callback()
     def on_clicked(self, *args) -> None:
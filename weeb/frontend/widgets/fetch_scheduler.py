@@ -0,0 +1,135 @@
+# fetch_scheduler.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import math
+from typing import Optional, Protocol
+
+from gi.repository import Gtk
+
+from weeb.backend.schema import BoardSettings
+from weeb.backend.utils.singleton import Singleton
+from weeb.backend.utils.threading import Lane
+
+
+class Fetchable(Protocol):
+
+    anchor: Optional[Gtk.Widget]
+
+    def fetch(self, lane: Lane) -> None: ...
+    def abort(self) -> None: ...
+
+
+class FetchScheduler(metaclass=Singleton):
+    """
+    Orders image downloads by distance to the board viewport.
+
+    Images ask for a fetch with request() and report back with finished()
+    or drop out with cancel(),
+    the board keeps the viewport current with set_viewport().
+    Anything that leaves the prefetch window is aborted or dropped,
+    it will be requested again once it gets drawn.
+    """
+
+    board_settings = BoardSettings()
+
+    def __init__(self) -> None:
+
+        self.pending: list[Fetchable] = []
+        self.in_flight: set[Fetchable] = set()
+
+        self.origin: Optional[Gtk.Widget] = None
+        self.orientation = Gtk.Orientation.HORIZONTAL
+        self.viewport: tuple[float, float] = (0.0, 0.0)
+
+    def set_viewport(self, origin: Gtk.Widget, orientation: Gtk.Orientation, start: float, end: float) -> None:
+
+        self.origin = origin
+        self.orientation = orientation
+        self.viewport = (start, end)
+
+        self.update()
+
+    def request(self, image: Fetchable) -> None:
+
+        if image in self.in_flight or image in self.pending:
+            return
+
+        self.pending.append(image)
+        self.update()
+
+    def cancel(self, image: Fetchable) -> None:
+
+        if image in self.pending:
+            self.pending.remove(image)
+
+        self.in_flight.discard(image)
+        image.abort()
+
+        self.update()
+
+    def finished(self, image: Fetchable) -> None:
+        self.in_flight.discard(image)
+        self.update()
+
+    def distance(self, image: Fetchable) -> float:
+        """Distance along the scroll axis between image and viewport, 0 if visible"""
+
+        if self.origin is None or image.anchor is None:
+            return 0.0
+
+        is_valid, rect = image.anchor.compute_bounds(self.origin)
+        if not is_valid: return math.inf
+
+        if self.orientation == Gtk.Orientation.HORIZONTAL:
+            low, high = rect.get_x(), rect.get_x() + rect.get_width()
+        else: low, high = rect.get_y(), rect.get_y() + rect.get_height()
+
+        start, end = self.viewport
+
+        return max(0.0, start - high, low - end)
+
+    def update(self) -> None:
+
+        max_in_flight = self.board_settings.max_in_flight
+        prefetch_screens = self.board_settings.prefetch_screens
+
+        start, end = self.viewport
+        window = (end - start) * prefetch_screens
+
+        for image in list(self.in_flight):
+            if self.distance(image) > window:
+                self.in_flight.discard(image)
+                image.abort()
+
+        distances = {image: self.distance(image) for image in self.pending}
+
+        for image in self.pending:
+            if distances[image] > window:
+                image.abort()
+
+        self.pending = [image for image in self.pending if distances[image] <= window]
+        self.pending.sort(key=distances.get)
+
+        while self.pending and len(self.in_flight) < max_in_flight:
+
+            image = self.pending.pop(0)
+            lane = Lane.VISIBLE if distances[image] == 0 else Lane.PREFETCH
+
+            self.in_flight.add(image)
+            image.fetch(lane)
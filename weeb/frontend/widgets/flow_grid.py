@@ -17,57 +17,186 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import bisect
+from typing import Callable, Iterable, Optional
+
 from gi.repository import Gtk
 
-from weeb.backend.settings import Settings
+from weeb.backend.primitives import Asset
+from weeb.backend.schema import BoardSettings
+from weeb.frontend.widgets.masonry_layout import MasonryLayout, Placement
+
 
+class FlowGrid(Gtk.Fixed):
+    """
+    Virtualized masonry grid.
 
-class FlowGridChild(Gtk.Box):
-    __gtype_name__ = "FlowGridChild"
+    Assets are placed into lanes by MasonryLayout and only their placements
+    are kept, widgets exist just for the items within the viewport plus
+    a margin and get recycled as they scroll out.
+    The grid requests its full size, so the scrollbar stays correct.
+    """
+    __gtype_name__ = "FlowGrid"
 
-    settings = Settings()
+    board_settings = BoardSettings()
 
     def __init__(self, **kwargs):
+        super().__init__(**kwargs)
 
-        orientation = self.settings.get("board/orientation", 0)
-        tile_size = self.settings.get("board/tile/size", 180)
+        self.create: Optional[Callable[[], Gtk.Widget]] = None
+        self.bind: Optional[Callable[[Gtk.Widget, Placement], None]] = None
 
-        super().__init__(**kwargs, spacing=10,
-            margin_bottom=5, margin_top=5, margin_start=5, margin_end=5,
-            halign=Gtk.Align.START, valign=Gtk.Align.START,
-            orientation=orientation,
-            width_request=tile_size if orientation == Gtk.Orientation.VERTICAL else 0,
-            height_request=tile_size if orientation == Gtk.Orientation.HORIZONTAL else 0
-        )
+        self.viewport: tuple[float, float] = (0.0, 0.0)
 
-    def append(self, widget: Gtk.Widget) -> None:
+        # Item index -> widget currently showing it, and hidden widgets ready for reuse
+        self.active: dict[int, Gtk.Widget] = {}
+        self.pool: list[Gtk.Widget] = []
 
-        parent_width, parent_height = self.get_size_request()
-        widget_width, widget_height = widget.get_size_request()
+        self.clear()
 
-        if self.get_orientation() == Gtk.Orientation.VERTICAL:
-            self.set_size_request(parent_width, parent_height + widget_height)
-        elif self.get_orientation() == Gtk.Orientation.HORIZONTAL: 
-            self.set_size_request(parent_width + widget_width, parent_height)
+    def set_factory(self, create: Callable[[], Gtk.Widget], bind: Callable[[Gtk.Widget, Placement], None]) -> None:
+        self.create = create
+        self.bind = bind
 
-        super().append(widget)
+    def clear(self) -> None:
 
-class FlowGrid(Gtk.Box):
-    __gtype_name__ = "FlowGrid"
+        for widget in self.active.values():
+            widget.set_visible(False)
+            self.pool.append(widget)
 
-    settings = Settings()
+        self.active.clear()
 
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
+        self.layout = MasonryLayout()
+        self.orientation = self.layout.orientation
+        # Removed items leave None behind, so the indices of the others stay valid
+        self.placements: list[Optional[Placement]] = []
+        self.indices: dict[Asset, int] = {}
+
+        # Item indices of every lane in placement order, with their start and end along the scroll axis
+        lane_count = self.layout.lane_count
+        self.lanes: list[list[int]] = [[] for _ in range(lane_count)]
+        self.lane_starts: list[list[float]] = [[] for _ in range(lane_count)]
+        self.lane_ends: list[list[float]] = [[] for _ in range(lane_count)]
+
+        self.update_size_request()
+
+    def update_size_request(self) -> None:
+
+        length, breadth = self.layout.get_length(), self.layout.get_breadth()
+
+        if self.orientation == Gtk.Orientation.HORIZONTAL:
+            self.set_size_request(length, breadth)
+        else: self.set_size_request(breadth, length)
+
+    def append(self, asset: Asset) -> None:
+        self.extend([asset])
+
+    def extend(self, assets: Iterable[Asset]) -> None:
+
+        is_horizontal = self.orientation == Gtk.Orientation.HORIZONTAL
+        index = len(self.placements)
+
+        for placement in self.layout.place(assets):
+
+            if is_horizontal: start, size = placement.x, placement.width
+            else: start, size = placement.y, placement.height
+
+            self.lanes[placement.lane].append(index)
+            self.lane_starts[placement.lane].append(start)
+            self.lane_ends[placement.lane].append(start + size)
+
+            self.placements.append(placement)
+            self.indices[placement.asset] = index
+            index += 1
+
+        self.update_size_request()
+        self.update()
+
+    def remove(self, assets: set[Asset]) -> None:
+        """Drops assets from the grid, only the items after each one in its lane move back to close the gap"""
+
+        is_horizontal = self.orientation == Gtk.Orientation.HORIZONTAL
+
+        for asset in assets:
+
+            index = self.indices.pop(asset, None)
+            if index is None: continue
+
+            placement, self.placements[index] = self.placements[index], None
+
+            if (widget := self.active.pop(index, None)) is not None:
+                widget.set_visible(False)
+                self.pool.append(widget)
+
+            lane, starts, ends = self.lanes[placement.lane], self.lane_starts[placement.lane], self.lane_ends[placement.lane]
+            position = bisect.bisect_left(lane, index)
+
+            shift = (placement.width if is_horizontal else placement.height) + self.layout.spacing
+
+            del lane[position], starts[position], ends[position]
+
+            for i in range(position, len(lane)):
+
+                starts[i] -= shift
+                ends[i] -= shift
+
+                moved = self.placements[lane[i]]
+                if is_horizontal: moved.x -= shift
+                else: moved.y -= shift
+
+                if (widget := self.active.get(lane[i])) is not None:
+                    self.move(widget, moved.x, moved.y)
+
+            self.layout.shrink(placement.lane, shift)
+
+        self.update_size_request()
+        self.update()
+
+    def set_viewport(self, start: float, end: float) -> None:
+        self.viewport = (start, end)
+        self.update()
+
+    def get_visible_items(self) -> set[int]:
+
+        start, end = self.viewport
+        margin = (end - start) * self.board_settings.virtual_margin
+        low, high = start - margin, end + margin
+
+        visible = set()
+
+        for lane, starts, ends in zip(self.lanes, self.lane_starts, self.lane_ends):
+            i = bisect.bisect_left(ends, low)
+            while i < len(lane) and starts[i] <= high:
+                visible.add(lane[i])
+                i += 1
+
+        return visible
+
+    def update(self) -> None:
+
+        if self.create is None or self.bind is None: return
+
+        visible = self.get_visible_items()
+
+        for index in list(self.active):
+            if index in visible: continue
+            widget = self.active.pop(index)
+            widget.set_visible(False)
+            self.pool.append(widget)
+
+        for index in visible:
+            if index in self.active: continue
 
-        self.set_orientation(not self.settings.get("board/orientation", 0))
+            placement = self.placements[index]
 
-        self.children: list[FlowGridChild] = [FlowGridChild() for _ in range(3)]
-        for child in self.children: super().append(child)
+            if self.pool:
+                widget = self.pool.pop()
+                self.move(widget, placement.x, placement.y)
+            else:
+                widget = self.create()
+                self.put(widget, placement.x, placement.y)
 
-    def get_shortest_child(self) -> FlowGridChild:
-        return min(self.children, key=lambda child: child.get_size_request()[not self.get_orientation()])
+            self.bind(widget, placement)
+            widget.set_visible(True)
 
-    def append(self, widget: Gtk.Widget) -> None:
-        child = self.get_shortest_child()
-        child.append(widget)
\ No newline at end of file
+            self.active[index] = widget
@@ -0,0 +1,98 @@
+# image_decoder.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import threading
+from typing import Optional
+
+from gi.repository import Gdk, GdkPixbuf, GLib
+
+from weeb.backend.utils.perceptual import HASH_SIZE, dhash, to_grayscale
+
+
+class ImageDecoder:
+    """
+    Incremental image decoder meant to be driven from worker threads.
+
+    Encoded chunks go through a PixbufLoader guarded by a lock,
+    while snapshot() and close() copy the decoded pixels into an immutable
+    Gdk.MemoryTexture, the only thing that should be handed to the main loop.
+    """
+
+    def __init__(self) -> None:
+
+        self.lock = threading.Lock()
+
+        self.loader = GdkPixbuf.PixbufLoader()
+        self.loader.connect("area-prepared", self.area_prepared)
+        self.loader.connect("area-updated", self.area_updated)
+
+        self.can_read = False
+        # Set when there are decoded pixels newer than the last snapshot
+        self.has_update = False
+
+        self.fingerprint: Optional[int] = None
+
+    def area_prepared(self, *args) -> None:
+        self.can_read = True
+
+    def area_updated(self, *args) -> None:
+        self.has_update = True
+
+    @staticmethod
+    def to_texture(pixbuf: GdkPixbuf.Pixbuf) -> Gdk.MemoryTexture:
+
+        if pixbuf.get_has_alpha(): memory_format = Gdk.MemoryFormat.R8G8B8A8
+        else: memory_format = Gdk.MemoryFormat.R8G8B8
+
+        # read_pixel_bytes() copies the pixels of a mutable pixbuf
+        return Gdk.MemoryTexture.new(pixbuf.get_width(), pixbuf.get_height(),
+            memory_format, pixbuf.read_pixel_bytes(), pixbuf.get_rowstride())
+
+    def write(self, data: bytes) -> None:
+        with self.lock:
+            self.loader.write_bytes(GLib.Bytes.new(data))
+
+    def snapshot(self) -> Optional[Gdk.MemoryTexture]:
+        """Returns the partially decoded image, if any"""
+
+        with self.lock:
+            if not self.can_read: return None
+            self.has_update = False
+            return self.to_texture(self.loader.get_pixbuf())
+
+    @staticmethod
+    def get_fingerprint(pixbuf: GdkPixbuf.Pixbuf) -> int:
+
+        small = pixbuf.scale_simple(HASH_SIZE + 1, HASH_SIZE, GdkPixbuf.InterpType.BILINEAR)
+        pixels = small.get_pixels()
+
+        return dhash(to_grayscale(pixels, small.get_width(), small.get_height(), small.get_rowstride(), small.get_n_channels()))
+
+    def close(self, fingerprint: bool = False) -> Optional[Gdk.MemoryTexture]:
+        """Flushes the loader and returns the complete image, optionally fingerprinting it as well"""
+
+        with self.lock:
+            self.loader.close()
+            self.has_update = False
+            if not self.can_read: return None
+
+            pixbuf = self.loader.get_pixbuf()
+            if fingerprint: self.fingerprint = self.get_fingerprint(pixbuf)
+
+            return self.to_texture(pixbuf)
@@ -0,0 +1,131 @@
+# masonry_layout.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import heapq, math
+from dataclasses import dataclass
+from typing import Iterable
+
+from gi.repository import Gtk
+
+from weeb.backend.primitives import Asset, Variant
+from weeb.backend.schema import BoardSettings
+
+
+@dataclass(init=True)
+class Placement:
+
+    asset: Asset
+    variant: Variant
+
+    lane: int
+
+    x: float
+    y: float
+    width: int
+    height: int
+
+
+def choose_variant(asset: Asset, board_orientation: int, min_preview: int) -> Variant:
+    """Smallest variant whose size along the tile's fixed axis is at least min_preview"""
+
+    variants = asset.variants
+    variant_index = 0
+
+    image_orientation = int(asset.preview.width < asset.preview.height)
+
+    if image_orientation == board_orientation:
+
+        for variant in variants:
+            axis = variant.width if image_orientation else variant.height
+            if axis < min_preview and not variant.url.endswith((".mp4", ".gif")):
+                variant_index += 1
+            else: break
+
+    return variants[min(variant_index, len(variants) - 1)]
+
+def measure(variant: Variant, board_orientation: int, tile_size: int) -> tuple[int, int]:
+
+    width = height = tile_size
+
+    if board_orientation == Gtk.Orientation.HORIZONTAL:
+        width = math.floor((variant.width / variant.height) * height)
+    elif board_orientation == Gtk.Orientation.VERTICAL:
+        height = math.floor((variant.height / variant.width) * width)
+
+    return width, height
+
+
+class MasonryLayout:
+    """
+    Places batches of assets into masonry lanes.
+
+    Settings are read once per layout and lane lengths live in a heap,
+    so placing a page costs one pass over its assets.
+    """
+
+    board_settings = BoardSettings()
+
+    spacing = 10
+    margin = 5
+
+    def __init__(self) -> None:
+
+        self.orientation = self.board_settings.orientation
+        self.tile_size = self.board_settings.tile_size
+        self.min_preview = self.board_settings.min_preview
+        self.lane_count = self.board_settings.lanes
+
+        # (length along the scroll axis, lane), the shortest lane is always on top
+        self.heap: list[tuple[float, int]] = [(self.margin, lane) for lane in range(self.lane_count)]
+
+    def get_length(self) -> float:
+        return max(length for length, _ in self.heap) + self.margin
+
+    def get_breadth(self) -> float:
+        return self.margin * 2 + self.lane_count * self.tile_size + (self.lane_count - 1) * self.spacing
+
+    def shrink(self, lane: int, amount: float) -> None:
+        """Shortens lane after an item was taken out of it"""
+        self.heap = [(length - amount if index == lane else length, index) for length, index in self.heap]
+        heapq.heapify(self.heap)
+
+    def place(self, assets: Iterable[Asset]) -> list[Placement]:
+
+        orientation, tile_size, min_preview = self.orientation, self.tile_size, self.min_preview
+        is_horizontal = orientation == Gtk.Orientation.HORIZONTAL
+        lane_step, margin, spacing = tile_size + self.spacing, self.margin, self.spacing
+
+        heap = self.heap
+        placements: list[Placement] = []
+
+        for asset in assets:
+
+            variant = choose_variant(asset, orientation, min_preview)
+            width, height = measure(variant, orientation, tile_size)
+
+            main, lane = heap[0]
+            cross = margin + lane * lane_step
+
+            if is_horizontal: x, y, size = main, cross, width
+            else: x, y, size = cross, main, height
+
+            heapq.heapreplace(heap, (main + size + spacing, lane))
+            placements.append(Placement(asset, variant, lane, x, y, width, height))
+
+        return placements
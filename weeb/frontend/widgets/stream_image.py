@@ -17,68 +17,212 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from gi.repository import Gdk, GdkPixbuf, GLib, GObject, Graphene, Gtk
+import logging, threading
+from typing import Optional
+
+from gi.repository import Gdk, GLib, GObject, Graphene, Gtk
 
 from weeb.backend.downloader import Downloader
 from weeb.backend.primitives import Variant
+from weeb.backend.schema import DedupSettings
+from weeb.backend.utils.expected import Expected
+from weeb.backend.utils.threading import Lane, run_in_thread
+from weeb.frontend.widgets.fetch_scheduler import FetchScheduler
+from weeb.frontend.widgets.image_decoder import ImageDecoder
+from weeb.frontend.widgets.texture_cache import TextureCache
 
 
 class StreamImage(GObject.GObject, Gdk.Paintable):
     __gtype_name__ = "StreamImage"
 
-    def __init__(self, variant: Variant, early_init: bool = False, preload: bool = False) -> None:
+    __gsignals__ = {
+        # Perceptual hash of the decoded image, emitted only with dedup/perceptual enabled
+        "fingerprinted": (GObject.SignalFlags.RUN_FIRST, None, (GObject.TYPE_UINT64,))
+    }
+
+    dedup_settings = DedupSettings()
+
+    def __init__(self, variant: Variant, early_init: bool = False, preload: bool = False, anchor: Optional[Gtk.Widget] = None, key: Optional[str] = None) -> None:
         super().__init__()
 
         self.downloader = Downloader()
+        self.scheduler = FetchScheduler()
+        self.cache = TextureCache()
 
-        self.loader = GdkPixbuf.PixbufLoader()
-        self.loader.connect("area-updated", self.area_updated)
-        self.loader.connect("area-prepared", self.area_prepared)
+        self.decoder: ImageDecoder = None
+        self.e_bytes: Expected[bytes] = None
 
-        self.width = variant.width
-        self.height = variant.height
-        self.url = variant.url
+        # The widget this image is shown in, used to find its place in the viewport
+        self.anchor = anchor
 
-        self.can_read = False
         self.initialized = False
         self.loaded = False
 
+        # Set when the decoder has pixels that are not presented yet
+        self.is_dirty = False
+        self.tick_id: Optional[int] = None
+
         self.texture: Gdk.Texture = None
 
-        if preload:
+        self.bind(variant, key)
+
+        if preload and not self.loaded:
             buffer = GLib.Bytes.new(self.downloader.download(self.url))
             self.texture = Gdk.Texture.new_from_bytes(buffer)
             self.initialized = self.loaded = True
 
         if early_init: self._lazy_init()
 
-    def area_prepared(self, *args) -> None:
-        self.can_read = True
+    def bind(self, variant: Variant, key: Optional[str] = None) -> None:
+        """Points the image at another variant, dropping any transfer in progress"""
+
+        self.scheduler.cancel(self)
+
+        self.width = variant.width
+        self.height = variant.height
+        self.url = variant.url
+
+        # Texture cache key, images without one are never cached
+        self.key = key
+
+        self.texture = None
+        self.initialized = self.loaded = False
+
+        if key is not None and (texture := self.cache.get(key)):
+            self.texture = texture
+            self.initialized = self.loaded = True
+
+        self.invalidate_size()
+        self.invalidate_contents()
+
+    def area_updated(self, decoder: ImageDecoder) -> None: 
+        """Called from the decoding thread, can fire once per written chunk"""
+
+        if not decoder.has_update or decoder is not self.decoder: return
+
+        if not self.is_dirty:
+            self.is_dirty = True
+            GLib.idle_add(self.schedule_update)
+
+    def schedule_update(self) -> None:
+
+        if self.loaded or self.tick_id is not None: return
+
+        if self.anchor is not None:
+            self.tick_id = self.anchor.add_tick_callback(self.on_tick)
+        else: self.update_texture()
+
+    def cancel_update(self) -> None:
+
+        if self.tick_id is not None:
+            self.anchor.remove_tick_callback(self.tick_id)
+            self.tick_id = None
+
+    def on_tick(self, widget: Gtk.Widget, frame_clock: Gdk.FrameClock) -> bool:
 
-    def area_updated(self, *args) -> None: 
-        if self.can_read: 
-            pixbuf = self.loader.get_pixbuf()
-            self.texture = Gdk.Texture.new_for_pixbuf(pixbuf)
+        self.tick_id = None
+
+        # Off screen tiles are not drawn, do_snapshot picks the update up once they are
+        if self.is_dirty and self.anchor.get_mapped() and self.scheduler.distance(self) == 0:
+            self.update_texture()
+
+        return GLib.SOURCE_REMOVE
+
+    def update_texture(self) -> None:
+        """Copies the partially decoded image on a worker and presents it when ready"""
+
+        if self.decoder is None: return
+
+        decoder = self.decoder
+        self.is_dirty = False
+
+        def present(e_texture: Expected[Gdk.Texture]) -> None:
+            if decoder is not self.decoder or self.loaded: return
+            if e_texture.value is None: return
+            self.texture = e_texture.value
             self.invalidate_contents()
 
+        run_in_thread(decoder.snapshot, present, lane=Lane.VISIBLE)
+
     def _lazy_init(self) -> None:
 
         if self.initialized:
             return
 
-        def finalize() -> None: 
-            self.loader.close()
+        self.scheduler.request(self)
+        self.initialized = True
+
+    def fetch(self, lane: Lane = Lane.VISIBLE) -> None:
+
+        decoder = self.decoder = ImageDecoder()
+
+        chunks: list[bytes] = []
+        is_cached = self.key is not None and self.cache.disk.contains(self.key)
+
+        fingerprint = self.dedup_settings.perceptual
+
+        def finalize(texture: Optional[Gdk.Texture]) -> None:
+            if decoder is not self.decoder: return
+            self.cancel_update()
+            if texture is not None: self.texture = texture
             self.invalidate_contents()
             self.loaded = True
+            self.scheduler.finished(self)
+            self.store(b"".join(chunks) if not is_cached else None)
+            if decoder.fingerprint is not None: self.emit("fingerprinted", decoder.fingerprint)
+
+        def on_finish() -> None:
+            # Runs on the worker that finished the transfer, so the last decode stays off the main thread
+            try: texture = decoder.close(fingerprint)
+            except GLib.Error as e:
+                logging.error(f"Failed to decode {self.url}: {e}")
+                texture = None
+            GLib.idle_add(finalize, texture)
+
+        def on_done(e_bytes: Expected[bytes]) -> None:
+            if e_bytes.is_failed(): GLib.idle_add(self.scheduler.finished, self)
+            elif not e_bytes.is_finished(): return
+            # Settled before the callback was added, which runs it here, the decode still belongs on a worker
+            elif threading.current_thread() is threading.main_thread(): run_in_thread(on_finish, lane=lane)
+            else: on_finish()
 
         def update_data(data: bytes) -> None:    
-            buffer = GLib.Bytes.new(data)
-            self.loader.write_bytes(buffer)
+            chunks.append(data)
+            decoder.write(data)
+            self.area_updated(decoder)
 
-        e_bytes = self.downloader.download_async(self.url, update_data, stream=True)
-        e_bytes.set_on_finish(finalize)
+        def read_cached(key: str) -> None:
+            data = self.cache.disk.get(key)
+            if data is None: raise KeyError(f"Cache entry {key} is gone")
+            update_data(data)
 
-        self.initialized = True
+        if is_cached: self.e_bytes = run_in_thread(read_cached, None, self.key, lane=lane)
+        else: self.e_bytes = self.downloader.download_async(self.url, update_data, stream=True, lane=lane)
+
+        # A fast read can settle before this line, done callbacks still run then
+        self.e_bytes.add_done_callback(on_done)
+
+    def store(self, data: Optional[bytes]) -> None:
+
+        if self.key is None or self.texture is None:
+            return
+
+        self.cache.put(self.key, self.texture)
+        if data: run_in_thread(self.cache.disk.put, None, self.key, data, lane=Lane.PREFETCH)
+
+    def abort(self) -> None:
+        """Stops the transfer, the image will be fetched again next time it's drawn"""
+
+        if self.e_bytes is not None:
+            self.e_bytes.cancel()
+
+        self.e_bytes = None
+        self.decoder = None
+
+        self.cancel_update()
+        self.is_dirty = False
+
+        self.initialized = False
 
     def do_get_intrinsic_width(self) -> int: return self.width
     def do_get_intrinsic_height(self) -> int: return self.height
@@ -96,6 +240,7 @@ class StreamImage(GObject.GObject, Gdk.Paintable):
 
         if self.texture is not None:
             snapshot.append_texture(self.texture, rect)
-        else: 
-            self._lazy_init()
-            snapshot.append_color(Gdk.RGBA(), rect)
\ No newline at end of file
+        else: snapshot.append_color(Gdk.RGBA(), rect)
+
+        if not self.loaded: self._lazy_init()
+        if self.is_dirty: self.schedule_update()
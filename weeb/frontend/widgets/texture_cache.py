@@ -0,0 +1,80 @@
+# texture_cache.py
+#
+# Copyright 2024 RozeFound
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from collections import OrderedDict
+from typing import Optional
+
+from gi.repository import Gdk
+
+from weeb.backend.primitives import Asset, Variant
+from weeb.backend.settings import Settings
+from weeb.backend.utils.disk_cache import DiskCache
+from weeb.backend.utils.singleton import Singleton
+
+
+class TextureCache(metaclass=Singleton):
+    """
+    Process-wide cache of decoded textures keyed by asset hash and variant size.
+
+    The memory tier is an LRU of Gdk.Texture bounded by decoded byte size and
+    must only be touched from the main thread, the disk tier keeps the encoded
+    bytes so a texture evicted from memory costs a decode but no download.
+    """
+
+    settings = Settings()
+
+    def __init__(self) -> None:
+
+        self.textures: OrderedDict[str, Gdk.Texture] = OrderedDict()
+        self.memory_size = 0
+
+        self.memory_budget = self.settings.get("cache/textures/memory_budget", 256 * 1024 ** 2)
+        disk_budget = self.settings.get("cache/textures/disk_budget", 512 * 1024 ** 2)
+
+        self.disk = DiskCache("textures", disk_budget)
+
+    @staticmethod
+    def make_key(asset: Asset, variant: Variant) -> Optional[str]:
+        if not asset.hash: return None
+        return f"{asset.hash}_{variant.width}x{variant.height}"
+
+    @staticmethod
+    def get_texture_size(texture: Gdk.Texture) -> int:
+        return texture.get_width() * texture.get_height() * 4
+
+    def get(self, key: str) -> Optional[Gdk.Texture]:
+
+        texture = self.textures.get(key)
+        if texture is not None:
+            self.textures.move_to_end(key)
+
+        return texture
+
+    def put(self, key: str, texture: Gdk.Texture) -> None:
+
+        if key in self.textures:
+            self.textures.move_to_end(key)
+            return
+
+        self.textures[key] = texture
+        self.memory_size += self.get_texture_size(texture)
+
+        while self.memory_size > self.memory_budget and len(self.textures) > 1:
+            _, evicted = self.textures.popitem(last=False)
+            self.memory_size -= self.get_texture_size(evicted)